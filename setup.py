@@ -35,7 +35,19 @@ def c_ext():
 
 
 def cython_ext():
-    return cythonize("**/*.pyx")
+    extensions = cythonize("**/*.pyx")
+    if os.name == 'nt':
+        return extensions
+    for ext in extensions:
+        if ext.name == 'skbeam.core._correlation':
+            # the correlation kernels must not contract multiply-adds so that
+            # they match the numpy implementation bit for bit
+            ext.extra_compile_args += ['-ffp-contract=off']
+            # run in parallel over lags, no openmp on MacOS (see c_ext)
+            if sys.platform != 'darwin':
+                ext.extra_compile_args += ['-fopenmp']
+                ext.extra_link_args += ['-lgomp']
+    return extensions
 
 
 setup(
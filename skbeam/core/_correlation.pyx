@@ -0,0 +1,70 @@
+"""
+Compiled kernels for the multi-tau correlators in skbeam.core.correlation
+
+The functions in here are drop-in accelerators for the pure-numpy inner
+loops of `skbeam.core.correlation`. They accumulate in exactly the same
+order as ``np.bincount`` so the results are bitwise identical to the
+reference implementation.
+"""
+cimport cython
+from cython.parallel cimport prange
+from libc.math cimport isnan
+import numpy as np
+cimport numpy as np
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def lag_sums(double[:, ::1] level_buf, Py_ssize_t[::1] label_array,
+             Py_ssize_t buf_no, Py_ssize_t[::1] delay_nos,
+             Py_ssize_t num_rois):
+    """Per-lag ROI sums of I(t)I(t + tau), I(t) and I(t + tau)
+
+    The product of the past and future frames and the reduction onto the
+    ROI labels is done in one pass over the pixels. Lags are processed in
+    parallel (OpenMP) when the extension was compiled with OpenMP support.
+
+    Parameters
+    ----------
+    level_buf : array
+        ring buffer of one multi-tau level, shape (num_bufs, num_pixels)
+    label_array : array
+        ROI label (1 -> num_rois) of every pixel in the ring buffer
+    buf_no : int
+        index of the current (future) frame in `level_buf`
+    delay_nos : array
+        index of the past frame in `level_buf` for every lag
+    num_rois : int
+        number of ROIs
+
+    Returns
+    -------
+    sums : array
+        shape (len(delay_nos), 3, num_rois). ``sums[:, 0]`` is the binned
+        product, ``sums[:, 1]`` the binned past intensity and
+        ``sums[:, 2]`` the binned future intensity
+    bad : array
+        boolean array, True where either frame of the lag contains np.nan
+    """
+    cdef Py_ssize_t num_lags = delay_nos.shape[0]
+    cdef Py_ssize_t num_pixels = label_array.shape[0]
+    sums = np.zeros((num_lags, 3, num_rois + 1), dtype=np.float64)
+    bad = np.zeros(num_lags, dtype=np.uint8)
+    cdef double[:, :, ::1] s = sums
+    cdef np.uint8_t[::1] b = bad
+    cdef Py_ssize_t k, n, lab, delay_no
+    cdef double past, future
+
+    with nogil:
+        for k in prange(num_lags, schedule='static'):
+            delay_no = delay_nos[k]
+            for n in range(num_pixels):
+                past = level_buf[delay_no, n]
+                future = level_buf[buf_no, n]
+                if isnan(past) or isnan(future):
+                    b[k] = 1
+                lab = label_array[n]
+                s[k, 0, lab] += past * future
+                s[k, 1, lab] += past
+                s[k, 2, lab] += future
+    return sums[:, :, 1:], bad.astype(bool)
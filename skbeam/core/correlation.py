@@ -45,9 +45,14 @@ This module is for functions specific to time correlation
 from __future__ import absolute_import, division, print_function
 from .utils import multi_tau_lags
 from .roi import extract_label_indices
-from collections import namedtuple
+from collections import namedtuple, deque
+import copy
+import multiprocessing
+import os
+import threading
 import numpy as np
 from scipy.signal import fftconvolve
+from scipy.fftpack import next_fast_len
 # for a convenient status bar
 try:
     from tqdm import tqdm
@@ -55,6 +60,11 @@ except ImportError:
     def tqdm(iterator):
         return iterator
 
+# compiled inner loops, see _correlation.pyx
+try:
+    from . import _correlation
+except ImportError:
+    _correlation = None
 
 import logging
 logger = logging.getLogger(__name__)
@@ -139,6 +149,185 @@ def _one_time_process(buf, G, past_intensity_norm, future_intensity_norm,
     return None  # modifies arguments in place!
 
 
+def _binned_lag_sums(buf, label_array, num_rois, num_bufs, level, buf_no,
+                     lags):
+    """Compute the binned products and intensities of several lags at once
+    with the compiled kernel
+
+    Parameters
+    ----------
+    buf : array
+        image data array to use for correlation
+    label_array : array
+        labeled array where all nonzero values are ROIs
+    num_rois : int
+        number of ROIs
+    num_bufs : int, even
+        number of buffers(channels)
+    level : int
+        the current multi-tau level
+    buf_no : int
+        the current buffer number
+    lags : array
+        the lag (in buffers) of every correlation to compute
+
+    Returns
+    -------
+    sums : array
+        binned product, past and future intensity for every lag
+        shape (len(lags), 3, num_rois)
+    bad : array
+        True for every lag that involves a bad (np.nan) image
+    """
+    # buf_no may be -1 (i.e. the last buffer), wrap it around explicitly
+    buf_no = buf_no % num_bufs
+    delay_nos = ((buf_no - lags) % num_bufs).astype(np.intp)
+    return _correlation.lag_sums(buf[level],
+                                 np.ascontiguousarray(label_array,
+                                                      dtype=np.intp),
+                                 buf_no, delay_nos, num_rois)
+
+
+def _one_time_update(G, past_intensity_norm, future_intensity_norm,
+                     num_pixels, img_per_level, level, num_bufs, norm, lev_len,
+                     lags, sums, bad):
+    """Fold binned sums of several lags into the running averages
+
+    This performs the same arithmetic as `_one_time_process` does for each
+    lag, vectorized over the lags. `img_per_level` must already have been
+    incremented for the current image.
+
+    .. warning :: This modifies inputs in place.
+
+    Parameters
+    ----------
+    G, past_intensity_norm, future_intensity_norm : array
+        see `_one_time_process`
+    num_pixels : array
+        number of pixels in certain ROI's
+    img_per_level : array
+        to track how many images processed in each level
+    level : int
+        the current multi-tau level
+    num_bufs : int, even
+        number of buffers(channels)
+    norm : dict
+        to track bad images
+    lev_len : array
+        length of each level
+    lags : array
+        the lag (in buffers) of every correlation
+    sums : array
+        binned product, past and future intensity for every lag
+        shape (len(lags), 3, num_rois)
+    bad : array
+        True for every lag that involves a bad (np.nan) image
+    """
+    t_index = level * num_bufs // 2 + lags
+    ind = t_index - lev_len[:level].sum()
+    normalize = (img_per_level[level] - lags -
+                 np.asarray(norm[level + 1])[ind])
+    good = ~bad
+    t_good = t_index[good]
+    for binned, arr in zip(sums[good].transpose(1, 0, 2),
+                           [G, past_intensity_norm, future_intensity_norm]):
+        arr[t_good] += ((binned / num_pixels - arr[t_good]) /
+                        normalize[good, np.newaxis])
+    for j in ind[bad]:
+        norm[level + 1][j] += 1
+    return None  # modifies arguments in place!
+
+
+def _one_time_process_cython(buf, G, past_intensity_norm,
+                             future_intensity_norm, label_array, num_bufs,
+                             num_pixels, img_per_level, level, buf_no, norm,
+                             lev_len):
+    """Compiled implementation of the inner loop of multi-tau one time
+    correlation
+
+    The products and the ROI reductions of all lags are computed in one
+    fused, parallel pass by ``_correlation.lag_sums``. The results are
+    identical to `_one_time_process`; see there for the parameters.
+
+    .. warning :: This modifies inputs in place.
+    """
+    img_per_level[level] += 1
+    i_min = num_bufs // 2 if level else 0
+    lags = np.arange(i_min, min(img_per_level[level], num_bufs))
+    sums, bad = _binned_lag_sums(buf, label_array, G.shape[1], num_bufs,
+                                 level, buf_no, lags)
+    _one_time_update(G, past_intensity_norm, future_intensity_norm,
+                     num_pixels, img_per_level, level, num_bufs, norm, lev_len,
+                     lags, sums, bad)
+    return None  # modifies arguments in place!
+
+
+def _one_time_block_sums(buf, label_array, num_rois, num_bufs, img_per_level,
+                         buf_no, frames):
+    """Binned sums of the first (undownsampled) level for a block of frames
+
+    The lag products of every frame in the block are computed at once,
+    a single ``np.bincount`` per lag bins all of the frames. The sums are
+    identical to the ones `_one_time_process` computes frame by frame.
+
+    Parameters
+    ----------
+    buf : array
+        image data array to use for correlation, holds the frames before
+        the block
+    label_array : array
+        labeled array where all nonzero values are ROIs
+    num_rois : int
+        number of ROIs
+    num_bufs : int, even
+        number of buffers(channels)
+    img_per_level : array
+        to track how many images processed in each level
+    buf_no : int
+        the buffer number of the last frame before the block
+    frames : array
+        ROI pixels of the block, shape (n_frames, len(label_array))
+
+    Returns
+    -------
+    sums : array
+        binned product, past and future intensity for every frame and lag
+        shape (n_frames, num_bufs, 3, num_rois)
+    bad : array
+        True for every frame and lag that involves a bad (np.nan) image
+        shape (n_frames, num_bufs)
+    """
+    num_frames = len(frames)
+    num_processed = img_per_level[0]
+    # the frames before the block that can still be correlated with it,
+    # oldest first
+    num_history = min(num_processed, num_bufs - 1)
+    history = buf[0, (buf_no - np.arange(num_history)[::-1]) % num_bufs]
+    series = np.concatenate([history, frames])
+    is_nan = np.isnan(series).any(axis=1)
+
+    # shift the labels of every frame so that one bincount bins all of them
+    labels = (label_array[np.newaxis, :] +
+              (num_rois + 1) * np.arange(num_frames)[:, np.newaxis])
+
+    sums = np.zeros((num_frames, num_bufs, 3, num_rois))
+    bad = np.zeros((num_frames, num_bufs), dtype=bool)
+    for i in range(min(num_processed + num_frames, num_bufs)):
+        # the first frame of the block that has a partner at this lag
+        j_min = max(0, i - num_processed)
+        future = series[num_history + j_min:]
+        past = series[num_history + j_min - i:num_history + num_frames - i]
+        n = num_frames - j_min
+        for k, w in enumerate([past * future, past, future]):
+            binned = np.bincount(labels[:n].ravel(), weights=w.ravel(),
+                                 minlength=n * (num_rois + 1))
+            sums[j_min:, i, k] = binned.reshape(n, num_rois + 1)[:, 1:]
+        bad[j_min:, i] = (is_nan[num_history + j_min:] |
+                          is_nan[num_history + j_min - i:
+                                 num_history + num_frames - i])
+    return sums, bad
+
+
 results = namedtuple(
     'correlation_results',
     ['g2', 'lag_steps', 'internal_state']
@@ -158,7 +347,8 @@ _internal_state = namedtuple(
      'num_pixels',
      'lag_steps',
      'norm',
-     'lev_len']
+     'lev_len',
+     'per_pixel']
 )
 
 _two_time_internal_state = namedtuple(
@@ -176,11 +366,14 @@ _two_time_internal_state = namedtuple(
      'current_img_time',
      'time_ind',
      'norm',
-     'lev_len']
+     'lev_len',
+     'storage',
+     'max_lag']
 )
 
 
-def _init_state_one_time(num_levels, num_bufs, labels):
+def _init_state_one_time(num_levels, num_bufs, labels, per_pixel=False,
+                         memmap_dir=None):
     """Initialize a stateful namedtuple for the generator-based multi-tau
      for one time correlation
 
@@ -190,6 +383,10 @@ def _init_state_one_time(num_levels, num_bufs, labels):
     num_bufs : int
     labels : array
         Two dimensional labeled array that contains ROI information
+    per_pixel : bool, optional
+        correlate every ROI pixel on its own, see `lazy_one_time`
+    memmap_dir : str, optional
+        directory for memory-mapped G, past and future intensities
 
     Returns
     -------
@@ -202,14 +399,29 @@ def _init_state_one_time(num_levels, num_bufs, labels):
      img_per_level, track_level, cur, norm,
      lev_len) = _validate_and_transform_inputs(num_bufs, num_levels, labels)
 
+    dtype = np.float64
+    if per_pixel:
+        # every pixel is a ROI of its own
+        num_rois = len(pixel_list)
+        label_array = np.arange(1, num_rois + 1)
+        num_pixels = np.ones(num_rois, dtype=np.int64)
+        dtype = np.float32
+
     # G holds the un normalized auto- correlation result. We
     # accumulate computations into G as the algorithm proceeds.
-    G = np.zeros(((num_levels + 1) * num_bufs // 2, num_rois),
-                 dtype=np.float64)
-    # matrix for normalizing G into g2
-    past_intensity = np.zeros_like(G)
-    # matrix for normalizing G into g2
-    future_intensity = np.zeros_like(G)
+    # past_intensity and future_intensity are the matrices for
+    # normalizing G into g2
+    shape = ((num_levels + 1) * num_bufs // 2, num_rois)
+    if memmap_dir is None:
+        G, past_intensity, future_intensity = [
+            np.zeros(shape, dtype=dtype) for _ in range(3)]
+    else:
+        if not os.path.isdir(memmap_dir):
+            os.makedirs(memmap_dir)
+        G, past_intensity, future_intensity = [
+            np.lib.format.open_memmap(os.path.join(memmap_dir, name + '.npy'),
+                                      mode='w+', dtype=dtype, shape=shape)
+            for name in ['G', 'past_intensity', 'future_intensity']]
 
     return _internal_state(
         buf,
@@ -225,11 +437,13 @@ def _init_state_one_time(num_levels, num_bufs, labels):
         lag_steps,
         norm,
         lev_len,
+        per_pixel,
     )
 
 
 def lazy_one_time(image_iterable, num_levels, num_bufs, labels,
-                  internal_state=None):
+                  internal_state=None, backend=None, yield_every='auto',
+                  per_pixel=None, memmap_dir=None):
     """Generator implementation of 1-time multi-tau correlation
 
     If you do not want multi-tau correlation, set num_levels to 1 and
@@ -237,7 +451,11 @@ def lazy_one_time(image_iterable, num_levels, num_bufs, labels,
 
     Parameters
     ----------
-    image_iterable : iterable of 2D arrays
+    image_iterable : iterable of 2D or 3D arrays
+        images, or blocks of images with shape (n_frames, rr, cc). The
+        first level correlations of the frames of a block are computed
+        together, with either backend, which is much faster than feeding
+        them one by one.
     num_levels : int
         how many generations of downsampling to perform, i.e., the depth of
         the binomial tree of averaged frames
@@ -252,11 +470,41 @@ def lazy_one_time(image_iterable, num_levels, num_bufs, labels,
         internal_state is a bucket for all of the internal state of the
         generator. It is part of the `results` object that is yielded from
         this generator
+    backend : {'numpy', 'cython'}, optional
+        implementation of the inner correlation loop. 'numpy' is the
+        reference implementation, 'cython' the compiled, OpenMP parallel
+        kernel. Both give identical results. Defaults to 'cython' if the
+        compiled kernel is available and 'numpy' otherwise. The first
+        level of blocks of images is always vectorized with numpy, see
+        `image_iterable`.
+    yield_every : int, None or 'auto', optional
+        only normalize and yield the correlation after every `yield_every`
+        images (or blocks of images) and after the last one. The internal
+        state is still updated for every image. If None, only the final
+        result is yielded. Every yielded g2 is a new in-memory array of the
+        size of the correlation sums, which for memory-mapped sums (see
+        `memmap_dir`) means reading all of them from disk. 'auto' is None
+        for memory-mapped sums and 1 otherwise. Defaults to 'auto'
+    per_pixel : bool, optional
+        If True, keep the correlation of every ROI pixel instead of the
+        ROI averages, in float32. g2 then has the shape
+        (len(lag_steps), num_roi_pixels), in the order of the pixels in
+        the internal state's `pixel_list`; pixels without intensity are
+        np.nan. Use `roi_g2_from_pixels` to reduce the state to ROI
+        averages with standard errors. The mode is kept in the internal
+        state, so it does not have to be repeated when resuming; a
+        ValueError is raised if it does not match. Defaults to False
+    memmap_dir : str, optional
+        If given, the correlation sums (of size
+        (len(lag_steps), num_roi_pixels) for `per_pixel`) are memory-mapped
+        ``.npy`` files in this directory instead of in-memory arrays. Only
+        the final result is yielded by default, see `yield_every`
 
     Yields
     ------
     namedtuple
-        A `results` object is yielded after every image has been processed.
+        A `results` object is yielded after every image (or block of
+        images) has been processed, see `yield_every`.
         This `reults` object contains, in this order:
 
         - `g2`: the normalized correlation
@@ -294,28 +542,743 @@ def lazy_one_time(image_iterable, num_levels, num_bufs, labels,
     """
 
     if internal_state is None:
-        internal_state = _init_state_one_time(num_levels, num_bufs, labels)
+        internal_state = _init_state_one_time(num_levels, num_bufs, labels,
+                                              bool(per_pixel), memmap_dir)
+    elif per_pixel is not None and bool(per_pixel) != internal_state.per_pixel:
+        raise ValueError("per_pixel=%s does not match the internal state, "
+                         "which was created with per_pixel=%s" %
+                         (per_pixel, internal_state.per_pixel))
+    per_pixel = internal_state.per_pixel
     # create a shorthand reference to the results and state named tuple
     s = internal_state
+    one_time_process = _processing_funcs(backend)[0]
+    if isinstance(yield_every, str) and yield_every == 'auto':
+        # normalizing memory-mapped sums reads and copies all of them
+        yield_every = None if isinstance(s.G, np.memmap) else 1
+    if yield_every is not None and yield_every < 1:
+        raise ValueError("yield_every must be a positive integer or None. "
+                         "You provided %s" % yield_every)
+    # number of images (or blocks) processed and lags normalized so far
+    num_processed = 0
+    g_max = 0
 
     # iterate over the images to compute multi-tau correlation
     for image in image_iterable:
-        # Compute the correlations for all higher levels.
+        image = np.asarray(image)
+        if image.ndim == 3:
+            # a block of frames, gather the ROI pixels of all of them at once
+            frames = image.reshape(len(image), -1)[:, s.pixel_list]
+        else:
+            frames = np.ravel(image)[s.pixel_list][np.newaxis]
+
+        block_sums = None
+        if len(frames) > 1:
+            # vectorize the correlations of the first level over the block
+            block_sums, block_bad = _one_time_block_sums(
+                s.buf, s.label_array, s.G.shape[1], num_bufs,
+                s.img_per_level, s.cur[0] - 1, frames)
+
+        for n, frame in enumerate(frames):
+            level = 0
+
+            # increment buffer
+            s.cur[0] = (1 + s.cur[0]) % num_bufs
+
+            # Put the ROI pixels into the ring buffer.
+            s.buf[0, s.cur[0] - 1] = frame
+            buf_no = s.cur[0] - 1
+            # Compute the correlations between the first level
+            # (undownsampled) frames. This modifies G,
+            # past_intensity, future_intensity,
+            # and img_per_level in place!
+            if block_sums is None:
+                one_time_process(s.buf, s.G, s.past_intensity,
+                                 s.future_intensity, s.label_array, num_bufs,
+                                 s.num_pixels, s.img_per_level, level, buf_no,
+                                 s.norm, s.lev_len)
+            else:
+                s.img_per_level[level] += 1
+                lags = np.arange(min(s.img_per_level[level], num_bufs))
+                _one_time_update(s.G, s.past_intensity, s.future_intensity,
+                                 s.num_pixels, s.img_per_level, level,
+                                 num_bufs, s.norm, s.lev_len, lags,
+                                 block_sums[n, :len(lags)],
+                                 block_bad[n, :len(lags)])
+
+            # check whether the number of levels is one, otherwise
+            # continue processing the next level
+            processing = num_levels > 1
+
+            level = 1
+            while processing:
+                if not s.track_level[level]:
+                    s.track_level[level] = True
+                    processing = False
+                else:
+                    prev = (1 + (s.cur[level - 1] - 2) % num_bufs)
+                    s.cur[level] = (
+                        1 + s.cur[level] % num_bufs)
+
+                    s.buf[level, s.cur[level] - 1] = ((
+                            s.buf[level - 1, prev - 1] +
+                            s.buf[level - 1, s.cur[level - 1] - 1]) / 2)
+
+                    # make the track_level zero once that level is processed
+                    s.track_level[level] = False
+
+                    # call processing_func for each multi-tau level greater
+                    # than one. This is modifying things in place. See
+                    # comment on previous call above.
+                    buf_no = s.cur[level] - 1
+                    one_time_process(s.buf, s.G, s.past_intensity,
+                                     s.future_intensity, s.label_array,
+                                     num_bufs, s.num_pixels, s.img_per_level,
+                                     level, buf_no, s.norm, s.lev_len)
+                    level += 1
+
+                    # Checking whether there is next level for processing
+                    processing = level < num_levels
+
+        num_processed += 1
+        if yield_every is not None and num_processed % yield_every == 0:
+            result, g_max = _one_time_results(s, g_max, per_pixel)
+            yield result
+    # always yield the final result
+    if num_processed and (yield_every is None or num_processed % yield_every):
+        result, g_max = _one_time_results(s, g_max, per_pixel)
+        yield result
+
+
+def _one_time_results(state, g_max=0, per_pixel=False):
+    """Normalize the one time correlation state into g2
+
+    Parameters
+    ----------
+    state : namedtuple
+        The internal state of `lazy_one_time`
+    g_max : int, optional
+        all lags before `g_max` are known to have non-zero past
+        intensities, e.g. from a previous call
+    per_pixel : bool, optional
+        the state holds the correlation of every pixel, only the lags
+        without any intensity cannot be normalized
+
+    Returns
+    -------
+    results : namedtuple
+        see `lazy_one_time`
+    g_max : int
+        number of lags that could be normalized
+    """
+    # If any past intensities are zero, then g2 cannot be normalized at
+    # those levels. Lags get their first (non-zero) intensities in order,
+    # so instead of rescanning the whole array only move forward from the
+    # last lag that could be normalized.
+    past_intensity = state.past_intensity
+    while g_max < past_intensity.shape[0]:
+        row = past_intensity[g_max]
+        if not (row.any() if per_pixel else row.all()):
+            break
+        g_max += 1
+
+    # single pixels may never have seen any intensity
+    with np.errstate(divide='ignore', invalid='ignore'):
+        g2 = (state.G[:g_max] / (past_intensity[:g_max] *
+                                 state.future_intensity[:g_max]))
+    if per_pixel:
+        g2[past_intensity[:g_max] == 0] = np.nan
+    return results(g2, state.lag_steps[:g_max], state), g_max
+
+
+def roi_g2_from_pixels(internal_state, labels, block_size=65536):
+    """Reduce a per-pixel one time correlation to ROI averages
+
+    The state of a ``lazy_one_time(..., per_pixel=True)`` run is reduced in
+    one pass over blocks of pixels, so memory-mapped states do not have to
+    fit into memory.
+
+    Parameters
+    ----------
+    internal_state : namedtuple or list of namedtuple
+        the internal state of a per-pixel `lazy_one_time` run, or the states
+        of several runs over the same images with disjoint sets of pixels
+    labels : array
+        the labeled array of all of the pixels of the correlation
+    block_size : int, optional
+        number of pixels to reduce at once. Defaults to 65536
+
+    Returns
+    -------
+    g2 : array
+        the normalized correlation of each ROI, shape
+        (len(lag_steps), num_rois). It is the same as the one of
+        `lazy_one_time` without `per_pixel`
+    g2_err : array
+        standard error of g2, from the scatter of the g2 of the pixels of
+        each ROI. Pixels without intensity are left out.
+    lag_steps : array
+        the times at which the correlation was computed
+    """
+    if isinstance(internal_state, list):
+        states = internal_state
+    else:
+        states = [internal_state]
+    if not all(s.per_pixel for s in states):
+        raise ValueError("The internal state holds ROI averages, not the "
+                         "correlation of every pixel")
+    label_array, pixel_list = extract_label_indices(labels)
+    # the positions of the pixels of every state in pixel_list, every
+    # pixel has to be in exactly one state
+    covered = np.zeros(len(pixel_list), dtype=np.int64)
+    state_indices = []
+    for s in states:
+        if not np.all(np.in1d(s.pixel_list, pixel_list)):
+            raise ValueError("The labels do not match the pixels of the "
+                             "correlation")
+        state_indices.append(np.searchsorted(pixel_list, s.pixel_list))
+        covered[state_indices[-1]] += 1
+    if np.any(covered != 1):
+        raise ValueError("The labels do not match the pixels of the "
+                         "correlation")
+    u_labels = np.unique(label_array)
+    roi_index = np.searchsorted(u_labels, label_array)
+    num_lags = states[0].G.shape[0]
+    num_rois = len(u_labels)
+
+    # per ROI sums of G, past and future intensity and of the pixel g2 and
+    # g2**2
+    sums = np.zeros((5, num_lags, num_rois))
+    num_valid = np.zeros((num_lags, num_rois))
+    for ind, s in zip(state_indices, states):
+        for start in range(0, len(ind), block_size):
+            stop = start + block_size
+            G = np.asarray(s.G[:, start:stop], dtype=np.float64)
+            past = np.asarray(s.past_intensity[:, start:stop],
+                              dtype=np.float64)
+            future = np.asarray(s.future_intensity[:, start:stop],
+                                dtype=np.float64)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                pixel_g2 = G / (past * future)
+            valid = np.isfinite(pixel_g2)
+            pixel_g2[~valid] = 0
+
+            in_roi = np.zeros((G.shape[1], num_rois))
+            in_roi[np.arange(G.shape[1]), roi_index[ind[start:stop]]] = 1
+            for k, arr in enumerate([G, past, future, pixel_g2,
+                                     pixel_g2**2]):
+                sums[k] += np.dot(arr, in_roi)
+            num_valid += np.dot(valid, in_roi)
+
+    num_pixels = np.bincount(roi_index, minlength=num_rois)
+    G, past, future, g2_sum, g2_sum_sq = sums
+    # lags that could not be normalized for every ROI, as in lazy_one_time
+    g_max = np.argmin(np.r_[past.all(axis=1), False])
+    G, past, future = [arr[:g_max] / num_pixels for arr in [G, past, future]]
+    g2 = G / (past * future)
+
+    num_valid = num_valid[:g_max]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        variance = ((g2_sum_sq[:g_max] - g2_sum[:g_max]**2 / num_valid) /
+                    (num_valid - 1))
+        g2_err = np.sqrt(variance / num_valid)
+    return g2, g2_err, s.lag_steps[:g_max]
+
+
+preview_results = namedtuple(
+    'preview_results',
+    ['g2', 'g2_err', 'lag_steps', 'num_pixels', 'internal_state']
+)
+
+
+def lazy_one_time_preview(images, num_levels, num_bufs, labels,
+                          fractions=(0.01, 0.1), min_pixels=10, seed=None,
+                          yield_every=None, backend=None):
+    """Quick one time correlation estimates from subsets of the ROI pixels
+
+    The images are correlated in several passes. Every pass uses a
+    random subset of the pixels of each ROI, stratified by ROI label so
+    that every ROI is sampled with the same fraction. The subsets grow from
+    pass to pass (each one contains the previous one), so the estimates
+    are refined until, with a fraction of 1, all pixels are used. Each
+    pass only correlates the pixels it adds to the previous subset, so
+    all of the passes together cost about as much as a correlation of the
+    last subset. The per-pixel states of the passes are kept apart, each
+    with its own bookkeeping of bad frames, and reduced together.
+
+    Parameters
+    ----------
+    images : array or sequence of 2D arrays
+        dimensions are: (rr, cc). It is iterated once per pass, so it can
+        not be a generator if there is more than one fraction
+    num_levels : int
+        how many generations of downsampling to perform, i.e., the depth of
+        the binomial tree of averaged frames
+    num_bufs : int, must be even
+        maximum lag step to compute in each generation of downsampling
+    labels : array
+        Labeled array of the same shape as the image stack.
+        Each ROI is represented by sequential integers starting at one.  For
+        example, if you have four ROIs, they must be labeled 1, 2, 3,
+        4. Background is labeled as 0
+    fractions : sequence of float, optional
+        the increasing fraction of the pixels of each ROI to use in each
+        pass. Defaults to (0.01, 0.1)
+    min_pixels : int, optional
+        the smallest number of pixels to use per ROI (or all of them for
+        smaller ROIs). Defaults to 10
+    seed : int, optional
+        seed of the random pixel selection
+    yield_every : int, optional
+        also yield an estimate after every `yield_every` images within the
+        first pass. Later passes combine their pixels with the ones of the
+        previous passes once all images are correlated, so they only yield
+        at their end. By default, there is one estimate per pass
+    backend : {'numpy', 'cython'}, optional
+        implementation of the inner correlation loop, see `lazy_one_time`
+
+    Yields
+    ------
+    namedtuple
+        A ``preview_results`` object, that contains, in this order:
+
+        - ``g2``: the estimated normalized correlation, shape
+          (len(lag_steps), num_rois)
+        - ``g2_err``: the standard error of g2, from the scatter of the
+          correlations of the pixels in the subset
+        - ``lag_steps``: the times at which the correlation was computed
+        - ``num_pixels``: the number of pixels of each ROI in the subset
+        - ``internal_state``: the list of the per-pixel `lazy_one_time`
+          states of the passes so far, which together hold all of the
+          pixels of the subset
+
+    See Also
+    --------
+    roi_g2_from_pixels : the reduction of the pixels to ROI estimates
+    """
+    fractions = np.asarray(fractions, dtype=np.float64)
+    if (np.any(fractions <= 0) or np.any(fractions > 1) or
+            np.any(np.diff(fractions) <= 0)):
+        raise ValueError("fractions must increase and be in (0, 1]. You "
+                         "provided %s" % fractions)
+    if len(fractions) > 1 and iter(images) is images:
+        raise ValueError("The images are correlated in several passes, so "
+                         "they can not be an iterator")
+
+    label_array, pixel_list = extract_label_indices(labels)
+    # a random order of the pixels of each ROI, the subsets are the first
+    # pixels of each order
+    random = np.random.RandomState(seed)
+    orders = [pixel_list[label_array == label][
+        random.permutation(np.sum(label_array == label))]
+        for label in np.unique(label_array)]
+
+    flat_labels = np.ravel(labels)
+    states = []
+    estimate = None
+    for fraction in fractions:
+        subset = np.zeros(np.size(labels), dtype=flat_labels.dtype)
+        num_pixels = np.zeros(len(orders), dtype=np.int64)
+        for n, order in enumerate(orders):
+            num = min(max(int(np.ceil(fraction * len(order))), min_pixels),
+                      len(order))
+            subset[order[:num]] = flat_labels[order[:num]]
+            num_pixels[n] = num
+        # only correlate the pixels that were not in the previous subsets
+        added = subset.copy()
+        for state in states:
+            added[state.pixel_list] = 0
+        subset = subset.reshape(np.shape(labels))
+        added = added.reshape(np.shape(labels))
+
+        if states and not added.any():
+            # the subset did not grow (e.g. because of min_pixels)
+            yield estimate._replace(num_pixels=num_pixels)
+            continue
+
+        pass_state = None
+        for result in lazy_one_time(
+                images, num_levels, num_bufs, added, backend=backend,
+                yield_every=yield_every if not states else None,
+                per_pixel=True):
+            pass_state = result.internal_state
+            pass_states = states + [pass_state]
+            g2, g2_err, lag_steps = roi_g2_from_pixels(pass_states, subset)
+            estimate = preview_results(g2, g2_err, lag_steps, num_pixels,
+                                       pass_states)
+            yield estimate
+        if pass_state is not None:
+            states.append(pass_state)
+
+
+def multi_tau_auto_corr(num_levels, num_bufs, labels, images, backend=None):
+    """Wraps generator implementation of multi-tau
+
+    Original code(in Yorick) for multi tau auto correlation
+    author: Mark Sutton
+
+    For parameter description, please reference the docstring for
+    lazy_one_time. Note that there is an API difference between this function
+    and `lazy_one_time`. The `images` arugment is at the end of this function
+    signature here for backwards compatibility, but is the first argument in
+    the `lazy_one_time()` function. The semantics of the variables remain
+    unchanged.
+    """
+    gen = lazy_one_time(images, num_levels, num_bufs, labels,
+                        backend=backend, yield_every=None)
+    for result in gen:
+        pass
+    return result.g2, result.lag_steps
+
+
+def parallel_one_time_corr(images, num_levels, num_bufs, labels,
+                           num_workers=None, executor='process',
+                           backend=None):
+    """Multi-tau one time correlation with the ROIs split over workers
+
+    The correlation of every ROI is independent of the others, so the ROI
+    labels are partitioned (balanced by pixel count) over `num_workers`
+    workers. Every image is streamed to all of the workers, each of which
+    only receives and correlates the pixels of its own ROIs with
+    `lazy_one_time`. At the end, the partial states are merged into the
+    state of a single correlation of all ROIs.
+
+    Parameters
+    ----------
+    images : iterable of 2D or 3D arrays
+        images, or blocks of images, see `lazy_one_time`. Bad images have
+        to be arrays entirely filled with np.nan (see
+        `skbeam.core.mask.bad_to_nan_gen`); a ValueError is raised if the
+        partitions end up skipping different frames
+    num_levels : int
+        how many generations of downsampling to perform, i.e., the depth of
+        the binomial tree of averaged frames
+    num_bufs : int, must be even
+        maximum lag step to compute in each generation of downsampling
+    labels : array
+        labeled array of the same shape as the images; 0 is background.
+        Each ROI is represented by a distinct label (i.e., integer)
+    num_workers : int, optional
+        number of workers (partitions of the ROIs). Defaults to the number
+        of CPUs
+    executor : {'process', 'thread'}, optional
+        run the workers in processes or threads. Threads only run in
+        parallel with the compiled backend, which releases the GIL.
+        Defaults to 'process'
+    backend : {'numpy', 'cython'}, optional
+        implementation of the inner correlation loop, see `lazy_one_time`
+
+    Returns
+    -------
+    results : namedtuple
+        the same `results` as the final one of `lazy_one_time`; g2 has the
+        shape (len(lag_steps), num_rois). The merged internal state can be
+        passed back in to `lazy_one_time` to continue the correlation.
+    """
+    from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+    if executor == 'process':
+        executor_class = ProcessPoolExecutor
+    elif executor == 'thread':
+        executor_class = ThreadPoolExecutor
+    else:
+        raise ValueError("executor must be 'process' or 'thread'. You "
+                         "provided %s" % executor)
+    if num_workers is None:
+        num_workers = multiprocessing.cpu_count()
+
+    label_values, pixel_list = extract_label_indices(labels)
+    partitions = _partition_labels(label_values, num_workers)
+    # the positions of the pixels of each partition in pixel_list
+    part_indices = [np.flatnonzero(np.in1d(label_values, part))
+                    for part in partitions]
+
+    # one single-worker executor per partition runs the images of that
+    # partition in order and keeps its state between the tasks
+    workers = [executor_class(max_workers=1) for _ in partitions]
+    keys = ['%s-%s-%s' % (os.getpid(), id(workers), n)
+            for n in range(len(partitions))]
+    try:
+        for worker, key, ind in zip(workers, keys, part_indices):
+            worker.submit(_partition_one_time_init, key, num_levels, num_bufs,
+                          label_values[ind][np.newaxis], backend).result()
+
+        pending = deque()
+        for image in images:
+            image = np.asarray(image)
+            if image.ndim == 3:
+                flat = image.reshape(len(image), -1)
+            else:
+                flat = np.ravel(image)
+            for worker, key, ind in zip(workers, keys, part_indices):
+                # only ship the pixels of the partition, as a one row image
+                part_image = flat[..., pixel_list[ind]][..., np.newaxis, :]
+                pending.append(worker.submit(_partition_one_time_process,
+                                             key, part_image, num_levels,
+                                             num_bufs))
+            # do not let the images queue up faster than they are processed
+            while len(pending) > 2 * len(workers):
+                pending.popleft().result()
+        for future in pending:
+            future.result()
+
+        states = [_internal_state(*worker.submit(_partition_one_time_state,
+                                                 key).result())
+                  for worker, key in zip(workers, keys)]
+    finally:
+        for worker in workers:
+            worker.shutdown()
+
+    state = _merge_one_time_states(states, partitions, part_indices,
+                                   num_levels, num_bufs, labels)
+    return _one_time_results(state)[0]
+
+
+def _partition_labels(label_values, num_parts):
+    """Partition the ROI labels into groups with similar pixel counts
+
+    Parameters
+    ----------
+    label_values : array
+        the label of every ROI pixel
+    num_parts : int
+        the maximum number of partitions
+
+    Returns
+    -------
+    partitions : list of arrays
+        the sorted labels of each partition
+    """
+    u_labels, counts = np.unique(label_values, return_counts=True)
+    num_parts = max(1, min(num_parts, len(u_labels)))
+    parts = [[] for _ in range(num_parts)]
+    sizes = np.zeros(num_parts, dtype=np.int64)
+    # greedily give the largest remaining ROI to the smallest partition
+    for n in np.argsort(counts, kind='mergesort')[::-1]:
+        smallest = np.argmin(sizes)
+        parts[smallest].append(u_labels[n])
+        sizes[smallest] += counts[n]
+    return [np.sort(part) for part in parts]
+
+
+# the states of the ROI partitions of `parallel_one_time_corr`, kept in the
+# worker (process) that correlates the partition
+_partition_states = {}
+
+
+def _partition_one_time_init(key, num_levels, num_bufs, labels, backend):
+    """Create the state of a ROI partition in the worker"""
+    _partition_states[key] = (
+        _init_state_one_time(num_levels, num_bufs, labels), backend)
+
+
+def _partition_one_time_process(key, image, num_levels, num_bufs):
+    """Correlate an image (or block) of a ROI partition in the worker"""
+    state, backend = _partition_states[key]
+    for _ in lazy_one_time([image], num_levels, num_bufs, None,
+                           internal_state=state, backend=backend,
+                           yield_every=None):
+        pass
+
+
+def _partition_one_time_state(key):
+    """Hand the final state of a ROI partition back from the worker"""
+    # the state namedtuple class cannot be pickled, send a plain tuple
+    return tuple(_partition_states.pop(key)[0])
+
+
+def _merge_one_time_states(states, partitions, part_indices, num_levels,
+                           num_bufs, labels):
+    """Merge the one time states of ROI partitions into a single state
+
+    Parameters
+    ----------
+    states : list of namedtuple
+        the `lazy_one_time` internal state of every partition
+    partitions : list of arrays
+        the sorted labels of every partition
+    part_indices : list of arrays
+        the positions of the pixels of every partition among all of the
+        ROI pixels
+    num_levels : int
+    num_bufs : int
+    labels : array
+        labeled array of all ROIs
+
+    Returns
+    -------
+    internal_state : namedtuple
+        the state of `lazy_one_time` for all of the ROIs
+
+    Raises
+    ------
+    ValueError
+        if the partitions did not skip the same bad frames, i.e. a frame
+        was np.nan in only some of the ROI pixels
+    """
+    # the multi-tau bookkeeping and the bad frame counts are shared by all
+    # ROIs, so they have to be the same in every partition
+    first = states[0]
+    for part_state in states[1:]:
+        if part_state.norm != first.norm:
+            raise ValueError("The ROI partitions skipped different bad "
+                             "frames. Bad images have to be entirely np.nan "
+                             "(see skbeam.core.mask.bad_to_nan_gen)")
+        for name in ['img_per_level', 'track_level', 'cur']:
+            if not np.array_equal(getattr(part_state, name),
+                                  getattr(first, name)):
+                raise ValueError("The ROI partitions are not at the same "
+                                 "multi-tau step (%s differs)" % name)
+
+    state = _init_state_one_time(num_levels, num_bufs, labels)
+    u_labels = np.unique(np.concatenate(partitions))
+    for part_state, part, ind in zip(states, partitions, part_indices):
+        cols = np.searchsorted(u_labels, part)
+        for name in ['G', 'past_intensity', 'future_intensity']:
+            getattr(state, name)[:, cols] = getattr(part_state, name)
+        state.buf[..., ind] = part_state.buf
+    for name in ['img_per_level', 'track_level', 'cur']:
+        getattr(state, name)[:] = getattr(first, name)
+    state.norm.update(copy.deepcopy(first.norm))
+    return state
+
+
+_event_internal_state = namedtuple(
+    'event_correlation_state',
+    ['buf',
+     'G',
+     'past_intensity',
+     'future_intensity',
+     'img_per_level',
+     'label_array',
+     'track_level',
+     'cur',
+     'pixel_list',
+     'num_pixels',
+     'lag_steps',
+     'norm',
+     'lev_len',
+     'roi_index']
+)
+
+
+def _init_state_event_one_time(num_levels, num_bufs, labels):
+    """Initialize a stateful namedtuple for the event mode one time
+    correlation
+
+    Parameters
+    ----------
+    num_levels : int
+    num_bufs : int
+    labels : array
+        Two dimensional labeled array that contains ROI information
+
+    Returns
+    -------
+    internal_state : namedtuple
+        The namedtuple that contains all the state information that
+        `lazy_one_time_events` requires so that it can be used to pick up
+        processing after it was interrupted
+    """
+    # the dense ring buffer is not needed
+    (label_array, pixel_list, num_rois, num_pixels, lag_steps, _,
+     img_per_level, track_level, cur, norm,
+     lev_len) = _validate_and_transform_inputs(num_bufs, num_levels, labels)
+
+    G = np.zeros(((num_levels + 1) * num_bufs // 2, num_rois),
+                 dtype=np.float64)
+    past_intensity = np.zeros_like(G)
+    future_intensity = np.zeros_like(G)
+
+    # Ring buffer of sparse frames: the (sorted) positions of the non-zero
+    # pixels in pixel_list, their counts and the total counts of each ROI
+    empty = (np.zeros(0, dtype=np.intp), np.zeros(0),
+             np.zeros(num_rois))
+    buf = [[empty] * num_bufs for _ in range(num_levels)]
+
+    # position of every image pixel in pixel_list, -1 outside the ROIs
+    roi_index = np.full(np.size(labels), -1, dtype=np.intp)
+    roi_index[pixel_list] = np.arange(len(pixel_list))
+
+    return _event_internal_state(
+        buf,
+        G,
+        past_intensity,
+        future_intensity,
+        img_per_level,
+        label_array,
+        track_level,
+        cur,
+        pixel_list,
+        num_pixels,
+        lag_steps,
+        norm,
+        lev_len,
+        roi_index,
+    )
+
+
+def lazy_one_time_events(event_iterable, num_levels, num_bufs, labels,
+                         internal_state=None, yield_every=1):
+    """Generator implementation of 1-time multi-tau correlation of sparse
+    (event mode) data
+
+    At low count rates most pixels are zero. Here every frame is given as
+    the list of its non-zero pixels and only the pixels that are non-zero
+    in both frames of a lag contribute to the correlation. The ring
+    buffers only hold the non-zero pixels. The results are identical to
+    the ones of `lazy_one_time` with the equivalent dense images.
+
+    Parameters
+    ----------
+    event_iterable : iterable of (pixel_indices, counts) tuples
+        for every frame, the indices of the non-zero pixels into the
+        raveled image and their counts. Bad frames have np.nan counts.
+    num_levels : int
+        how many generations of downsampling to perform, i.e., the depth of
+        the binomial tree of averaged frames
+    num_bufs : int, must be even
+        maximum lag step to compute in each generation of downsampling
+    labels : array
+        Labeled array of the same shape as the images.
+        Each ROI is represented by a distinct label (i.e., integer).
+        Background is labeled as 0
+    internal_state : namedtuple, optional
+        internal_state is a bucket for all of the internal state of the
+        generator. It is part of the `results` object that is yielded from
+        this generator
+    yield_every : int or None, optional
+        only normalize and yield the correlation after every `yield_every`
+        frames and after the last one. If None, only the final result is
+        yielded. Defaults to 1
+
+    Yields
+    ------
+    namedtuple
+        A `results` object, see `lazy_one_time`
+    """
+    if internal_state is None:
+        internal_state = _init_state_event_one_time(num_levels, num_bufs,
+                                                    labels)
+    s = internal_state
+    if yield_every is not None and yield_every < 1:
+        raise ValueError("yield_every must be a positive integer or None. "
+                         "You provided %s" % yield_every)
+    num_rois = s.G.shape[1]
+    num_processed = 0
+    g_max = 0
+
+    for pixel_indices, counts in event_iterable:
         level = 0
 
         # increment buffer
         s.cur[0] = (1 + s.cur[0]) % num_bufs
 
-        # Put the ROI pixels into the ring buffer.
-        s.buf[0, s.cur[0] - 1] = np.ravel(image)[s.pixel_list]
-        buf_no = s.cur[0] - 1
-        # Compute the correlations between the first level
-        # (undownsampled) frames. This modifies G,
-        # past_intensity, future_intensity,
-        # and img_per_level in place!
-        _one_time_process(s.buf, s.G, s.past_intensity, s.future_intensity,
-                          s.label_array, num_bufs, s.num_pixels,
-                          s.img_per_level, level, buf_no, s.norm, s.lev_len)
+        # Put the sparse ROI pixels into the ring buffer.
+        s.buf[0][s.cur[0] - 1] = _events_to_frame(
+            pixel_indices, counts, s.roi_index, s.label_array, num_rois)
+        _one_time_process_events(s.buf, s.G, s.past_intensity,
+                                 s.future_intensity, s.label_array, num_bufs,
+                                 s.num_pixels, s.img_per_level, level,
+                                 s.cur[0] - 1, s.norm, s.lev_len)
 
         # check whether the number of levels is one, otherwise
         # continue processing the next level
@@ -328,59 +1291,391 @@ def lazy_one_time(image_iterable, num_levels, num_bufs, labels,
                 processing = False
             else:
                 prev = (1 + (s.cur[level - 1] - 2) % num_bufs)
-                s.cur[level] = (
-                    1 + s.cur[level] % num_bufs)
+                s.cur[level] = (1 + s.cur[level] % num_bufs)
 
-                s.buf[level, s.cur[level] - 1] = ((
-                        s.buf[level - 1, prev - 1] +
-                        s.buf[level - 1, s.cur[level - 1] - 1]) / 2)
+                s.buf[level][s.cur[level] - 1] = _average_frames(
+                    s.buf[level - 1][prev - 1],
+                    s.buf[level - 1][s.cur[level - 1] - 1],
+                    s.label_array, num_rois)
 
                 # make the track_level zero once that level is processed
                 s.track_level[level] = False
 
-                # call processing_func for each multi-tau level greater
-                # than one. This is modifying things in place. See comment
-                # on previous call above.
-                buf_no = s.cur[level] - 1
-                _one_time_process(s.buf, s.G, s.past_intensity,
-                                  s.future_intensity, s.label_array, num_bufs,
-                                  s.num_pixels, s.img_per_level, level, buf_no,
-                                  s.norm, s.lev_len)
+                _one_time_process_events(s.buf, s.G, s.past_intensity,
+                                         s.future_intensity, s.label_array,
+                                         num_bufs, s.num_pixels,
+                                         s.img_per_level, level,
+                                         s.cur[level] - 1, s.norm, s.lev_len)
                 level += 1
 
                 # Checking whether there is next level for processing
                 processing = level < num_levels
 
-        # If any past intensities are zero, then g2 cannot be normalized at
-        # those levels. This if/else code block is basically preventing
-        # divide-by-zero errors.
-        if len(np.where(s.past_intensity == 0)[0]) != 0:
-            g_max = np.where(s.past_intensity == 0)[0][0]
-        else:
-            g_max = s.past_intensity.shape[0]
+        num_processed += 1
+        if yield_every is not None and num_processed % yield_every == 0:
+            result, g_max = _one_time_results(s, g_max)
+            yield result
+    # always yield the final result
+    if num_processed and (yield_every is None or num_processed % yield_every):
+        result, g_max = _one_time_results(s, g_max)
+        yield result
 
-        g2 = (s.G[:g_max] / (s.past_intensity[:g_max] *
-                             s.future_intensity[:g_max]))
-        yield results(g2, s.lag_steps[:g_max], s)
 
+def _events_to_frame(pixel_indices, counts, roi_index, label_array,
+                     num_rois):
+    """Convert the events of a frame into a sparse ring buffer entry
 
-def multi_tau_auto_corr(num_levels, num_bufs, labels, images):
-    """Wraps generator implementation of multi-tau
+    Parameters
+    ----------
+    pixel_indices : array
+        indices of the pixels into the raveled image. Repeated indices are
+        summed
+    counts : array
+        counts of the pixels
+    roi_index : array
+        position of every image pixel in the ROI pixel list, -1 outside
+    label_array : array
+        the ROI label of the pixels in the ROI pixel list
+    num_rois : int
+        number of ROIs
 
-    Original code(in Yorick) for multi tau auto correlation
-    author: Mark Sutton
+    Returns
+    -------
+    positions : array
+        sorted positions of the non-zero ROI pixels in the ROI pixel list
+    counts : array
+        the counts of these pixels
+    totals : array
+        the total counts in every ROI
+    """
+    positions = roi_index[np.asarray(pixel_indices, dtype=np.intp)]
+    in_roi = positions >= 0
+    positions, inverse = np.unique(positions[in_roi], return_inverse=True)
+    counts = np.bincount(inverse, minlength=len(positions),
+                         weights=np.asarray(counts, dtype=np.float64)[in_roi])
+    non_zero = counts != 0
+    positions = positions[non_zero]
+    counts = counts[non_zero]
+    totals = np.bincount(label_array[positions], weights=counts,
+                         minlength=num_rois + 1)[1:]
+    return positions, counts, totals
+
+
+def _average_frames(frame1, frame2, label_array, num_rois):
+    """The average of two sparse frames, as the dense (frame1 + frame2) / 2
 
-    For parameter description, please reference the docstring for
-    lazy_one_time. Note that there is an API difference between this function
-    and `lazy_one_time`. The `images` arugment is at the end of this function
-    signature here for backwards compatibility, but is the first argument in
-    the `lazy_one_time()` function. The semantics of the variables remain
-    unchanged.
+    Parameters
+    ----------
+    frame1, frame2 : tuple
+        sparse ring buffer entries, see `_events_to_frame`
+    label_array : array
+        the ROI label of the pixels in the ROI pixel list
+    num_rois : int
+        number of ROIs
+
+    Returns
+    -------
+    frame : tuple
+        sparse ring buffer entry of the average
     """
-    gen = lazy_one_time(images, num_levels, num_bufs, labels)
-    for result in gen:
-        pass
-    return result.g2, result.lag_steps
+    positions = np.union1d(frame1[0], frame2[0])
+    counts1 = np.zeros(len(positions))
+    counts1[np.searchsorted(positions, frame1[0])] = frame1[1]
+    counts2 = np.zeros(len(positions))
+    counts2[np.searchsorted(positions, frame2[0])] = frame2[1]
+    counts = (counts1 + counts2) / 2
+    non_zero = counts != 0
+    positions = positions[non_zero]
+    counts = counts[non_zero]
+    totals = np.bincount(label_array[positions], weights=counts,
+                         minlength=num_rois + 1)[1:]
+    return positions, counts, totals
+
+
+def _one_time_process_events(buf, G, past_intensity_norm,
+                             future_intensity_norm, label_array, num_bufs,
+                             num_pixels, img_per_level, level, buf_no, norm,
+                             lev_len):
+    """Event mode implementation of the inner loop of multi-tau one time
+    correlation
+
+    Same as `_one_time_process`, but `buf` is a ring buffer of sparse
+    frames. The products are only computed for the pixels that are
+    non-zero in both frames, the past and future intensities are the ROI
+    totals that are kept along with the frames.
+
+    .. warning :: This modifies inputs in place.
+    """
+    img_per_level[level] += 1
+    i_min = num_bufs // 2 if level else 0
+    lags = np.arange(i_min, min(img_per_level[level], num_bufs))
+    num_rois = G.shape[1]
+
+    future_pos, future_counts, future_totals = buf[level][buf_no]
+    sums = np.zeros((len(lags), 3, num_rois))
+    bad = np.zeros(len(lags), dtype=bool)
+    for k, i in enumerate(lags):
+        past_pos, past_counts, past_totals = buf[level][(buf_no - i) %
+                                                        num_bufs]
+        # the pixels that are non-zero in both frames
+        ind = np.searchsorted(past_pos, future_pos)
+        ind[ind == len(past_pos)] = 0
+        shared = (past_pos[ind] == future_pos if len(past_pos) else
+                  np.zeros(len(future_pos), dtype=bool))
+        sums[k, 0] = np.bincount(label_array[future_pos[shared]],
+                                 weights=(past_counts[ind[shared]] *
+                                          future_counts[shared]),
+                                 minlength=num_rois + 1)[1:]
+        sums[k, 1] = past_totals
+        sums[k, 2] = future_totals
+        bad[k] = np.isnan(past_totals).any() or np.isnan(future_totals).any()
+    _one_time_update(G, past_intensity_norm, future_intensity_norm,
+                     num_pixels, img_per_level, level, num_bufs, norm, lev_len,
+                     lags, sums, bad)
+    return None  # modifies arguments in place!
+
+
+_lags_internal_state = namedtuple(
+    'lags_correlation_state',
+    ['buf',
+     'roi_sums',
+     'bad',
+     'G',
+     'past_intensity',
+     'future_intensity',
+     'counts',
+     'label_array',
+     'pixel_list',
+     'num_pixels',
+     'lag_steps',
+     'num_frames']
+)
+
+
+def lazy_one_time_lags(image_iterable, lag_steps, labels, internal_state=None,
+                       yield_every=1):
+    """Generator implementation of one time correlation at chosen lags
+
+    Only the lags in `lag_steps` are computed, from a ring buffer of the
+    last ``max(lag_steps)`` images, so the cost per image is proportional
+    to the number of lags. Bad images (np.nan arrays, e.g. from
+    `skbeam.core.mask.bad_to_nan_gen`) are left out and the normalization
+    is the same as in `lazy_one_time`.
+
+    Parameters
+    ----------
+    image_iterable : iterable of 2D arrays
+    lag_steps : array
+        the lags (in images) to compute, non-negative integers
+    labels : array
+        Labeled array of the same shape as the image stack.
+        Each ROI is represented by sequential integers starting at one.  For
+        example, if you have four ROIs, they must be labeled 1, 2, 3,
+        4. Background is labeled as 0
+    internal_state : namedtuple, optional
+        internal_state is a bucket for all of the internal state of the
+        generator. It is part of the `results` object that is yielded from
+        this generator
+    yield_every : int, optional
+        see `lazy_one_time`. Defaults to 1
+
+    Yields
+    ------
+    namedtuple
+        A `results` object is yielded as in `lazy_one_time`. ``g2`` has the
+        shape (len(lag_steps), num_rois) and is np.nan for the lags that
+        have not been seen yet. ``lag_steps`` are the sorted lags.
+    """
+    if yield_every is not None and yield_every < 1:
+        raise ValueError("yield_every must be at least 1 or None. You "
+                         "provided %s" % yield_every)
+    if internal_state is None:
+        internal_state = _init_state_one_time_lags(lag_steps, labels)
+    s = internal_state
+    depth = s.buf.shape[0]
+    num_rois = len(s.num_pixels)
+    # the labels of the products of all lags, offset by lag
+    offsets = (np.arange(len(s.lag_steps))[:, np.newaxis] * (num_rois + 1) +
+               s.label_array)
+
+    num_processed = 0
+    for img in image_iterable:
+        t = s.num_frames
+        slot = t % depth
+        s.buf[slot] = np.ravel(img)[s.pixel_list]
+        s.roi_sums[slot] = np.bincount(s.label_array, weights=s.buf[slot])[1:]
+        s.bad[slot] = np.isnan(s.buf[slot]).any()
+        s = s._replace(num_frames=t + 1)
+
+        # the lags that have a past image
+        num_lags = np.searchsorted(s.lag_steps, t, side='right')
+        lags = s.lag_steps[:num_lags]
+        past = (t - lags) % depth
+        good = ~(s.bad[past] | s.bad[slot])
+        if good.any():
+            k = np.nonzero(good)[0]
+            products = np.bincount(
+                offsets[:len(k)].ravel(),
+                weights=(s.buf[past[k]] * s.buf[slot]).ravel(),
+                minlength=len(k) * (num_rois + 1))
+            binned = [products.reshape(len(k), num_rois + 1)[:, 1:],
+                      s.roi_sums[past[k]], s.roi_sums[slot]]
+            s.counts[k] += 1
+            normalize = s.counts[k, np.newaxis]
+            for w, arr in zip(binned, [s.G, s.past_intensity,
+                                       s.future_intensity]):
+                arr[k] += (w / s.num_pixels - arr[k]) / normalize
+
+        num_processed += 1
+        if yield_every is not None and num_processed % yield_every == 0:
+            yield _one_time_lags_results(s)
+    # always yield the final result
+    if num_processed and (yield_every is None or num_processed % yield_every):
+        yield _one_time_lags_results(s)
+
+
+def _one_time_lags_results(state):
+    """The normalized g2 of `lazy_one_time_lags`"""
+    with np.errstate(divide='ignore', invalid='ignore'):
+        g2 = state.G / (state.past_intensity * state.future_intensity)
+    g2[state.counts == 0] = np.nan
+    return results(g2, state.lag_steps, state)
+
+
+def _init_state_one_time_lags(lag_steps, labels):
+    """Initialize a stateful namedtuple for `lazy_one_time_lags`
+
+    Parameters
+    ----------
+    lag_steps : array
+        the lags to compute
+    labels : array
+        Two dimensional labeled array that contains ROI information
+
+    Returns
+    -------
+    internal_state : namedtuple
+        The namedtuple that contains all the state information that
+        `lazy_one_time_lags` requires so that it can be used to pick up
+        processing after it was interrupted
+    """
+    lag_steps = np.unique(np.asarray(lag_steps, dtype=np.int64))
+    if not len(lag_steps) or lag_steps[0] < 0:
+        raise ValueError("lag_steps must be non-negative integers. You "
+                         "provided %s" % lag_steps)
+    # only the labels and pixels are needed, there are no multi-tau buffers
+    (label_array, pixel_list, num_rois,
+     num_pixels) = _validate_and_transform_inputs(2, 1, labels)[:4]
+    depth = lag_steps[-1] + 1
+    num_lags = len(lag_steps)
+    return _lags_internal_state(
+        np.zeros((depth, len(pixel_list)), dtype=np.float64),
+        np.zeros((depth, num_rois), dtype=np.float64),
+        np.zeros(depth, dtype=bool),
+        np.zeros((num_lags, num_rois), dtype=np.float64),
+        np.zeros((num_lags, num_rois), dtype=np.float64),
+        np.zeros((num_lags, num_rois), dtype=np.float64),
+        np.zeros(num_lags, dtype=np.int64),
+        label_array,
+        pixel_list,
+        num_pixels,
+        lag_steps,
+        0,
+    )
+
+
+def linear_auto_corr(images, labels, num_lags=None, block_size=1024):
+    """One time correlation at every lag, computed with FFTs
+
+    This computes the same correlation as `lazy_one_time` with
+    ``num_levels=1`` and ``num_bufs=num_lags``, with the same symmetric
+    normalization, but the intensity autocorrelation of every pixel is
+    computed with an FFT along the time axis. This costs
+    O(N log N) instead of O(N * num_lags) per pixel for N images.
+
+    The pixels are processed in blocks of `block_size`, so `images` may be
+    a memory-mapped array that does not fit into memory.
+
+    Parameters
+    ----------
+    images : array
+        image stack, shape (num_images, rr, cc) or (num_images, rr * cc),
+        e.g. a `numpy.memmap`. Bad images are expected to be entirely
+        filled with np.nan (see `skbeam.core.mask.bad_to_nan_gen`)
+    labels : array
+        labeled array of the same shape as the images; 0 is background.
+        Each ROI is represented by a distinct label (i.e., integer)
+    num_lags : int, optional
+        number of lags to compute, i.e. lags 0 -> num_lags - 1. Defaults
+        to the number of images
+    block_size : int, optional
+        number of pixels to read and transform at once. Defaults to 1024
+
+    Returns
+    -------
+    g2 : array
+        the normalized correlation, shape (num_lags, num_rois). Lags
+        without any pair of good images are np.nan
+    lag_steps : array
+        the lags of g2, i.e. 0 -> num_lags - 1
+    """
+    images = np.asarray(images)
+    num_frames = len(images)
+    data = images.reshape(num_frames, -1)
+    if num_lags is None:
+        num_lags = num_frames
+    num_lags = min(num_lags, num_frames)
+
+    label_array, pixel_list = extract_label_indices(labels)
+    u_labels = np.unique(label_array)
+    roi_index = np.searchsorted(u_labels, label_array)
+    num_rois = len(u_labels)
+    num_pixels = np.bincount(roi_index, minlength=num_rois)
+
+    # zero pad to avoid the circular wrap around of the correlation
+    nfft = next_fast_len(2 * num_frames - 1)
+    G = np.zeros((num_lags, num_rois))
+    # intensity of each ROI in each image, bad images are zeroed
+    roi_intensity = np.zeros((num_frames, num_rois))
+    bad = np.zeros(num_frames, dtype=bool)
+    for start in range(0, len(pixel_list), block_size):
+        cols = pixel_list[start:start + block_size]
+        block_rois = roi_index[start:start + block_size]
+        block = np.array(data[:, cols], dtype=np.float64)
+        is_nan = np.isnan(block)
+        bad |= is_nan.any(axis=1)
+        block[is_nan] = 0
+
+        spectrum = np.fft.rfft(block, n=nfft, axis=0)
+        auto_corr = np.fft.irfft(spectrum * spectrum.conj(), n=nfft,
+                                 axis=0)[:num_lags]
+        # sum up the pixels of each ROI
+        roi_sum = np.zeros((len(cols), num_rois))
+        roi_sum[np.arange(len(cols)), block_rois] = 1
+        G += np.dot(auto_corr, roi_sum)
+        roi_intensity += np.dot(block, roi_sum)
+
+    # the number of pairs of good images and the past and future intensity
+    # at each lag
+    good_spectrum = np.fft.rfft((~bad).astype(np.float64), n=nfft)
+    intensity_spectrum = np.fft.rfft(roi_intensity, n=nfft, axis=0)
+    num_pairs = np.rint(np.fft.irfft(good_spectrum * good_spectrum.conj(),
+                                     n=nfft)[:num_lags])
+    past_intensity = np.fft.irfft(intensity_spectrum.conj() *
+                                  good_spectrum[:, np.newaxis], n=nfft,
+                                  axis=0)[:num_lags]
+    future_intensity = np.fft.irfft(intensity_spectrum *
+                                    good_spectrum[:, np.newaxis].conj(),
+                                    n=nfft, axis=0)[:num_lags]
+
+    # same normalization as lazy_one_time: averages over the image pairs of
+    # the ROI averages
+    norm = num_pairs[:, np.newaxis] * num_pixels
+    with np.errstate(divide='ignore', invalid='ignore'):
+        g2 = ((G / norm) /
+              ((past_intensity / norm) * (future_intensity / norm)))
+    g2[num_pairs == 0] = np.nan
+    return g2, np.arange(num_lags)
 
 
 def auto_corr_scat_factor(lags, beta, relaxation_rate, baseline=1):
@@ -430,10 +1725,184 @@ def auto_corr_scat_factor(lags, beta, relaxation_rate, baseline=1):
        J. Synchrotron Rad. vol 21, p 1288-1295, 2014
 
     """
-    return beta * np.exp(-2 * relaxation_rate * lags) + baseline
+    return beta * np.exp(-2 * relaxation_rate * lags) + baseline
+
+
+def fit_auto_corr_scat_factor(lags, g2, sigma=None, baseline=None,
+                              max_iter=100, tol=1e-10):
+    """Fit `auto_corr_scat_factor` to many g2 curves at once
+
+    All curves are fitted together with a batched Levenberg-Marquardt
+    minimization, using the analytic Jacobian of the model. The starting
+    values come from a linear fit of ``log(g2 - baseline)``.
+
+    Parameters
+    ----------
+    lags : array
+        delay times, shape (num_lags,)
+    g2 : array
+        normalized intensity-intensity time autocorrelations, with the lags
+        along the first axis, e.g. (num_lags, num_rois) from
+        `multi_tau_auto_corr` or (num_lags, num_rois, num_segments). np.nan
+        values are left out of the fits
+    sigma : array, optional
+        uncertainties of g2, of the same shape. If given, the covariances
+        are absolute, otherwise they are scaled by the reduced chi-square
+        of each fit (as in ``scipy.optimize.curve_fit``)
+    baseline : float, optional
+        If given, the baseline is not fitted but fixed to this value
+    max_iter : int, optional
+        the largest number of iterations. Defaults to 100
+    tol : float, optional
+        relative change of the chi-square of all fits at which to stop.
+        Defaults to 1e-10
+
+    Returns
+    -------
+    params : array
+        the fitted ``beta``, ``relaxation_rate`` and ``baseline`` of each
+        curve, shape ``g2.shape[1:] + (3,)``. Curves with no more valid
+        points than free parameters can not be fitted and are np.nan
+    covariance : array
+        the covariance of the parameters of each curve, shape
+        ``g2.shape[1:] + (3, 3)``. The rows and columns of a fixed baseline
+        are zero, the covariances of curves that can not be fitted np.nan
+    """
+    lags = np.asarray(lags, dtype=np.float64)
+    g2 = np.asarray(g2, dtype=np.float64)
+    if g2.shape[0] != len(lags):
+        raise ValueError("g2 must have one row per lag. Got {} lags and g2 "
+                         "of shape {}".format(len(lags), g2.shape))
+    out_shape = g2.shape[1:]
+    # one column per curve
+    y = g2.reshape(len(lags), -1).T
+    if sigma is None:
+        weights = np.ones_like(y)
+    else:
+        weights = 1 / np.asarray(sigma, dtype=np.float64).reshape(
+            len(lags), -1).T**2
+    weights[~np.isfinite(y)] = 0
+    y = np.where(weights > 0, y, 0)
+    num_points = (weights > 0).sum(axis=1)
+
+    params = _auto_corr_scat_factor_guess(lags, y, weights, baseline)
+    # only the free parameters are varied
+    free = [0, 1] if baseline is not None else [0, 1, 2]
+
+    def residuals_and_jacobian(params):
+        decay = np.exp(-2 * params[:, 1:2] * lags)
+        model = params[:, 0:1] * decay + params[:, 2:3]
+        jacobian = np.stack([decay, -2 * lags * params[:, 0:1] * decay,
+                             np.ones_like(decay)], axis=-1)[..., free]
+        return y - model, jacobian
+
+    residuals, jacobian = residuals_and_jacobian(params)
+    chi2 = np.sum(weights * residuals**2, axis=1)
+    damping = np.full(len(y), 1e-3)
+    for _ in range(max_iter):
+        # the normal equations of every curve
+        alpha = np.einsum('ml,mli,mlj->mij', weights, jacobian, jacobian)
+        beta = np.einsum('ml,ml,mli->mi', weights, residuals, jacobian)
+        diagonal = np.einsum('mii->mi', alpha)
+        # parameters without any effect (e.g. the rate of a curve without
+        # contrast) are not moved
+        scaled = alpha + (damping[:, np.newaxis] * diagonal +
+                          (diagonal == 0))[..., np.newaxis] * np.eye(len(free))
+        step = np.linalg.solve(scaled, beta[..., np.newaxis])[..., 0]
+
+        trial = params.copy()
+        trial[:, free] += step
+        trial_residuals, trial_jacobian = residuals_and_jacobian(trial)
+        trial_chi2 = np.sum(weights * trial_residuals**2, axis=1)
+        better = trial_chi2 < chi2
+        change = np.abs(chi2 - trial_chi2) / np.maximum(chi2, 1e-300)
+
+        params[better] = trial[better]
+        residuals[better] = trial_residuals[better]
+        jacobian[better] = trial_jacobian[better]
+        chi2_old, chi2 = chi2, np.where(better, trial_chi2, chi2)
+        damping = np.where(better, damping / 10, damping * 10)
+        if np.all((change < tol) | (chi2_old == 0)):
+            break
+
+    alpha = np.einsum('ml,mli,mlj->mij', weights, jacobian, jacobian)
+    covariance = np.zeros((len(y), 3, 3))
+    # the pseudo-inverses of all curves, as np.linalg.pinv (which only
+    # takes stacks of matrices from numpy 1.14 on)
+    u, singular, vt = np.linalg.svd(alpha)
+    cutoff = 1e-15 * singular.max(axis=-1, keepdims=True)
+    with np.errstate(divide='ignore'):
+        inverse = np.where(singular > cutoff, 1 / singular, 0)
+    covariance[:, np.array(free)[:, np.newaxis], free] = np.einsum(
+        'mji,mj,mkj->mik', vt, inverse, u)
+    # the underdetermined fits are exact, whatever their parameters
+    underdetermined = num_points <= len(free)
+    if sigma is None:
+        dof = np.maximum(num_points - len(free), 1)
+        covariance *= (chi2 / dof)[:, np.newaxis, np.newaxis]
+    params[underdetermined] = np.nan
+    covariance[underdetermined] = np.nan
+    return (params.reshape(out_shape + (3,)),
+            covariance.reshape(out_shape + (3, 3)))
+
+
+def _auto_corr_scat_factor_guess(lags, y, weights, baseline=None):
+    """Starting values of `fit_auto_corr_scat_factor`
+
+    The baseline is the last (valid) value of each curve, ``beta`` and the
+    relaxation rate come from a weighted linear fit of ``log(g2 - baseline)``
+    over the points clearly above the baseline.
 
+    Parameters
+    ----------
+    lags : array
+        shape (num_lags,)
+    y : array
+        the curves, shape (num_curves, num_lags)
+    weights : array
+        the weights of the points, 0 for missing points
+    baseline : float, optional
+        the fixed baseline
 
-def two_time_corr(labels, images, num_frames, num_bufs, num_levels=1):
+    Returns
+    -------
+    params : array
+        beta, relaxation rate and baseline of each curve
+    """
+    valid = weights > 0
+    if baseline is None:
+        last = len(lags) - 1 - np.argmax(valid[:, ::-1], axis=1)
+        base = y[np.arange(len(y)), last]
+    else:
+        base = np.full(len(y), float(baseline))
+    decay = y - base[:, np.newaxis]
+    above = valid & (decay > 0.1 * np.max(np.where(valid, decay, 0), axis=1,
+                                          keepdims=True))
+    # weighted least squares of log(decay) = log(beta) - 2 rate lag, with
+    # the weights decay**2 of the log transform
+    w = np.where(above, decay, 0)**2
+    log_decay = np.log(np.where(above, decay, 1))
+    sw = w.sum(axis=1)
+    sx = (w * lags).sum(axis=1)
+    sy = (w * log_decay).sum(axis=1)
+    sxx = (w * lags**2).sum(axis=1)
+    sxy = (w * lags * log_decay).sum(axis=1)
+    det = sw * sxx - sx**2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        slope = (sw * sxy - sx * sy) / det
+        intercept = (sy - slope * sx) / sw
+    # fall back to a decay over the median lag for ill defined curves
+    ok = np.isfinite(slope) & (slope < 0)
+    median_lag = np.median(lags[lags > 0]) if np.any(lags > 0) else 1.
+    rate = np.where(ok, -slope / 2, 1 / (2 * median_lag))
+    beta = np.where(ok, np.exp(np.where(ok, intercept, 0)),
+                    np.max(np.where(valid, decay, 0), axis=1))
+    return np.stack([beta, rate, base], axis=1)
+
+
+def two_time_corr(labels, images, num_frames, num_bufs, num_levels=1,
+                  backend=None, storage='dense', max_lag=None,
+                  memmap_dir=None):
     """Wraps generator implementation of multi-tau two time correlation
 
     This function computes two-time correlation
@@ -446,14 +1915,111 @@ def two_time_corr(labels, images, num_frames, num_bufs, num_levels=1):
     For parameter definition, see the docstring for the `lazy_two_time()`
     function in this module
     """
-    gen = lazy_two_time(labels, images, num_frames, num_bufs, num_levels)
+    gen = lazy_two_time(labels, images, num_frames, num_bufs, num_levels,
+                        backend=backend, storage=storage, max_lag=max_lag,
+                        memmap_dir=memmap_dir)
     for result in gen:
         pass
     return two_time_state_to_results(result)
 
 
+def blocked_two_time_corr(labels, images, num_frames=None, tile_size=512,
+                          storage='dense', max_lag=None, memmap_dir=None):
+    """Single level two time correlation from blocked matrix products
+
+    Without multi-tau downsampling, the two time correlation of a ROI is
+    the Gram matrix of its (frames x pixels) intensity matrix, normalized
+    by the average intensities of the frames. The frames are split into
+    tiles of `tile_size` frames and each (tile, tile) block of the two
+    time correlation is computed with one matrix product per ROI and
+    written straight into the chosen storage. Every tile is read once; the
+    ROI pixels of the tiles that are still within reach of `max_lag` are
+    kept in memory, i.e. up to (num_frames, num_roi_pixels) float64 values
+    for the 'dense' and 'packed' storage.
+
+    The results are the same as those of
+    ``two_time_corr(labels, images, num_frames, num_bufs=num_frames,
+    num_levels=1)``, up to round-off.
+
+    Parameters
+    ----------
+    labels : array
+        labeled array of the same shape as the image stack;
+        each ROI is represented by a distinct label (i.e., integer)
+    images : array
+        the image stack, dimensions are: (num_frames, rr, cc). It is read
+        tile by tile, so e.g. memory-mapped stacks are never loaded at once
+    num_frames : int, optional
+        number of images to use, default is the number of images
+    tile_size : int, optional
+        number of frames per tile. Defaults to 512
+    storage : {'dense', 'packed', 'banded'}, optional
+        layout of the two time correlation, see `lazy_two_time`. Tiles
+        that are entirely beyond the `max_lag` of the 'banded' storage are
+        not computed. Defaults to 'dense'
+    max_lag : int, optional
+        largest lag (in frames) kept by the 'banded' storage
+    memmap_dir : str, optional
+        If given, ``g2`` is a memory-mapped ``g2.npy`` file in this
+        directory instead of an in-memory array
+
+    Returns
+    -------
+    results : namedtuple
+        ``g2``, ``lag_steps`` and ``internal_state``, which is None since
+        there is no lazy state to pick up from. See `two_time_corr`
+    """
+    if num_frames is None:
+        num_frames = len(images)
+    if tile_size < 1:
+        raise ValueError("tile_size must be at least 1. You provided "
+                         "%s" % tile_size)
+    label_array, pixel_list = extract_label_indices(labels)
+    # sort the pixels by ROI so that every ROI is a contiguous slice
+    u_labels, roi_index = np.unique(label_array, return_inverse=True)
+    order = np.argsort(roi_index, kind='mergesort')
+    pixel_list = pixel_list[order]
+    num_pixels = np.bincount(roi_index)
+    bounds = np.r_[0, np.cumsum(num_pixels)]
+    num_rois = len(u_labels)
+
+    g2, max_lag = _two_time_storage(num_rois, num_frames, storage, max_lag,
+                                    memmap_dir)
+
+    def read_tile(start):
+        stop = min(start + tile_size, num_frames)
+        tile = np.asarray(images[start:stop], dtype=np.float64)
+        tile = tile.reshape(stop - start, -1)[:, pixel_list]
+        # the average intensity of each ROI in each frame
+        means = np.array([tile[:, b0:b1].mean(axis=1)
+                          for b0, b1 in zip(bounds[:-1], bounds[1:])])
+        return tile, means
+
+    # the ROI pixels and means of the tiles read so far, by first frame
+    tiles = {}
+    for t1_start in range(0, num_frames, tile_size):
+        tiles[t1_start] = read_tile(t1_start)
+        tile1, means1 = tiles[t1_start]
+        for t2_start in sorted(tiles):
+            # the smallest lag in this block
+            if t1_start - (t2_start + tile_size - 1) > max_lag:
+                # out of reach of all of the following tiles as well
+                del tiles[t2_start]
+                continue
+            tile2, means2 = tiles[t2_start]
+            block = np.empty((num_rois, len(tile1), len(tile2)))
+            for q, (b0, b1) in enumerate(zip(bounds[:-1], bounds[1:])):
+                block[q] = np.dot(tile1[:, b0:b1], tile2[:, b0:b1].T)
+                block[q] /= num_pixels[q] * np.outer(means1[q], means2[q])
+            _set_two_time_block(g2, storage, t1_start, t2_start, block)
+
+    # the lags of a single multi-tau level
+    return results(g2, np.arange(num_frames), None)
+
+
 def lazy_two_time(labels, images, num_frames, num_bufs, num_levels=1,
-                  two_time_internal_state=None):
+                  two_time_internal_state=None, backend=None,
+                  storage='dense', max_lag=None, memmap_dir=None):
     """Generator implementation of two-time correlation
 
     If you do not want multi-tau correlation, set num_levels to 1 and
@@ -486,6 +2052,30 @@ def lazy_two_time(labels, images, num_frames, num_bufs, num_levels=1,
         how many generations of downsampling to perform, i.e.,
         the depth of the binomial tree of averaged frames
         default is one
+    two_time_internal_state : namedtuple, optional
+        the state yielded by a previous run of this generator, to pick up
+        processing where it was interrupted
+    backend : {'numpy', 'cython'}, optional
+        implementation of the inner correlation loop, see `lazy_one_time`
+    storage : {'dense', 'packed', 'banded'}, optional
+        layout of the two time correlation ``g2`` of the state. Only
+        ``t1 >= t2`` is computed, so
+
+        - 'dense' is the full (num_rois, num_frames, num_frames) matrix,
+          filled in ``g2[:, t1, t2]``
+        - 'packed' is the lower triangle, packed row by row into shape
+          (num_rois, num_frames * (num_frames + 1) // 2). ``g2[:, t1, t2]``
+          is at ``g2[:, t1 * (t1 + 1) // 2 + t2]``
+        - 'banded' only keeps the lags up to `max_lag`, in shape
+          (num_rois, max_lag + 1, num_frames). ``g2[:, t1, t2]`` is at
+          ``g2[:, t1 - t2, t2]``
+
+        Defaults to 'dense'
+    max_lag : int, optional
+        largest lag (in frames) kept by the 'banded' storage
+    memmap_dir : str, optional
+        If given, ``g2`` is a memory-mapped ``g2.npy`` file in this
+        directory instead of an in-memory array
 
     Yields
     ------
@@ -528,9 +2118,12 @@ def lazy_two_time(labels, images, num_frames, num_bufs, num_levels=1,
     """
     if two_time_internal_state is None:
         two_time_internal_state = _init_state_two_time(num_levels, num_bufs,
-                                                       labels, num_frames)
+                                                       labels, num_frames,
+                                                       storage, max_lag,
+                                                       memmap_dir)
     # create a shorthand reference to the results and state named tuple
     s = two_time_internal_state
+    two_time_process = _processing_funcs(backend)[1]
 
     for img in images:
         s.cur[0] = (1 + s.cur[0]) % num_bufs  # increment buffer
@@ -545,10 +2138,10 @@ def lazy_two_time(labels, images, num_frames, num_bufs, num_levels=1,
 
         # Compute the two time correlations between the first level
         # (undownsampled) frames. two_time and img_per_level in place!
-        _two_time_process(s.buf, s.g2, s.label_array, num_bufs,
-                          s.num_pixels, s.img_per_level, s.lag_steps,
-                          s.current_img_time,
-                          level=0, buf_no=s.cur[0] - 1)
+        two_time_process(s.buf, s.g2, s.label_array, num_bufs,
+                         s.num_pixels, s.img_per_level, s.lag_steps,
+                         s.current_img_time,
+                         level=0, buf_no=s.cur[0] - 1, storage=s.storage)
 
         # time frame for each level
         s.time_ind[0].append(s.current_img_time)
@@ -587,10 +2180,11 @@ def lazy_two_time(labels, images, num_frames, num_bufs, num_levels=1,
                 # for multi-tau levels greater than one
                 # Again, this is modifying things in place. See comment
                 # on previous call above.
-                _two_time_process(s.buf, s.g2, s.label_array, num_bufs,
-                                  s.num_pixels, s.img_per_level, s.lag_steps,
-                                  current_img_time,
-                                  level=level, buf_no=s.cur[level]-1)
+                two_time_process(s.buf, s.g2, s.label_array, num_bufs,
+                                 s.num_pixels, s.img_per_level, s.lag_steps,
+                                 current_img_time,
+                                 level=level, buf_no=s.cur[level]-1,
+                                 storage=s.storage)
                 level += 1
 
                 # Checking whether there is next level for processing
@@ -598,6 +2192,169 @@ def lazy_two_time(labels, images, num_frames, num_bufs, num_levels=1,
         yield s
 
 
+_two_time_window_state = namedtuple(
+    'two_time_window_state',
+    ['buf',
+     'roi_means',
+     'label_array',
+     'pixel_list',
+     'num_pixels',
+     'rows',
+     'strip',
+     'num_in_strip',
+     'strip_start',
+     'num_frames']
+)
+
+two_time_window_results = namedtuple(
+    'two_time_window_results',
+    ['g2', 'ages', 'lag_steps', 'internal_state']
+)
+
+
+def lazy_two_time_window(labels, images, window, strip_size=None,
+                         internal_state=None):
+    """Streaming two time correlation within a sliding window of frames
+
+    Only the correlations between frames less than `window` frames apart
+    are computed. The last `window` frames (ROI pixels only) are kept in a
+    ring buffer, so the memory needed does not depend on the length of the
+    run, and the correlation is yielded in strips of fixed size as soon as
+    they are complete.
+
+    Parameters
+    ----------
+    labels : array
+        labeled array of the same shape as the image stack;
+        each ROI is represented by a distinct label (i.e., integer)
+    images : iterable of 2D arrays
+        dimensions are: (rr, cc)
+    window : int
+        number of lags, the correlation is computed for lags
+        ``0 -> window - 1`` frames
+    strip_size : int, optional
+        number of ages per yielded strip. Defaults to `window`
+    internal_state : namedtuple, optional
+        the state of a previous run of this generator, to pick up
+        processing where it was interrupted
+
+    Yields
+    ------
+    namedtuple
+        A ``two_time_window_results`` object is yielded for every
+        `strip_size` ages, and once more for the remaining ages at the end
+        of the images. These are yielded again, completed, when the
+        processing is resumed from the final internal state. It contains,
+        in this order:
+
+        - ``g2``: the normalized correlation ``C(age, age + lag)``,
+          shape (num_rois, len(ages), window). Lags beyond the last image
+          (in the final strip) are np.nan
+        - ``ages``: the frame number of the earlier frame of each row
+        - ``lag_steps``: the lags of the columns, ``0 -> window - 1``
+        - ``internal_state``: all of the internal state. Can be passed back
+          in as the ``internal_state`` parameter
+
+    See Also
+    --------
+    lazy_two_time : the full two time correlation
+    """
+    if window < 1:
+        raise ValueError("window must be at least 1. You provided "
+                         "%s" % window)
+    if internal_state is None:
+        internal_state = _init_state_two_time_window(labels, window,
+                                                     strip_size)
+    s = internal_state
+    window = s.buf.shape[0]
+    lag_steps = np.arange(window)
+    bounds = np.r_[0, np.cumsum(s.num_pixels)]
+
+    for img in images:
+        t = s.num_frames
+        frame = np.ravel(img)[s.pixel_list].astype(np.float64)
+        slot = t % window
+        s.buf[slot] = frame
+        s.roi_means[slot] = [frame[b0:b1].mean()
+                             for b0, b1 in zip(bounds[:-1], bounds[1:])]
+        # C(t - lag, t) for all lags that have a past frame
+        lags = np.arange(min(t + 1, window))
+        past = (t - lags) % window
+        for q, (b0, b1) in enumerate(zip(bounds[:-1], bounds[1:])):
+            products = (np.dot(s.buf[past, b0:b1], frame[b0:b1]) /
+                        s.num_pixels[q])
+            s.rows[q, past, lags] = products / (s.roi_means[past, q] *
+                                                s.roi_means[slot, q])
+        s = s._replace(num_frames=t + 1)
+
+        # the row of the age that has just seen its largest lag is complete
+        age = t - window + 1
+        if age >= 0:
+            s.strip[:, s.num_in_strip] = s.rows[:, age % window]
+            s = s._replace(num_in_strip=s.num_in_strip + 1)
+            if s.num_in_strip == s.strip.shape[1]:
+                ages = s.strip_start + np.arange(s.num_in_strip)
+                g2 = s.strip.copy()
+                s = s._replace(num_in_strip=0, strip_start=ages[-1] + 1)
+                yield two_time_window_results(g2, ages, lag_steps, s)
+
+    # The ages whose largest lags are past the end of the images are handed
+    # out with the complete ages that are left, without changing the state,
+    # so that processing can be resumed
+    incomplete = np.arange(max(s.num_frames - window + 1, 0), s.num_frames)
+    if s.num_in_strip or len(incomplete):
+        rows = s.rows[:, incomplete % window]
+        rows[:, lag_steps >= s.num_frames - incomplete[:, np.newaxis]] = np.nan
+        g2 = np.concatenate([s.strip[:, :s.num_in_strip], rows], axis=1)
+        ages = s.strip_start + np.arange(g2.shape[1])
+        yield two_time_window_results(g2, ages, lag_steps, s)
+
+
+def _init_state_two_time_window(labels, window, strip_size=None):
+    """Initialize a stateful namedtuple for `lazy_two_time_window`
+
+    Parameters
+    ----------
+    labels : array
+        Two dimensional labeled array that contains ROI information
+    window : int
+        number of lags
+    strip_size : int, optional
+        number of ages per yielded strip. Defaults to `window`
+
+    Returns
+    -------
+    internal_state : namedtuple
+        The namedtuple that contains all the state information that
+        `lazy_two_time_window` requires so that it can be used to pick up
+        processing after it was interrupted
+    """
+    if strip_size is None:
+        strip_size = window
+    if strip_size < 1:
+        raise ValueError("strip_size must be at least 1. You provided "
+                         "%s" % strip_size)
+    # only the labels and pixels are needed, there is a single level with
+    # `window` buffers of its own
+    (label_array, pixel_list, num_rois,
+     num_pixels) = _validate_and_transform_inputs(2, 1, labels)[:4]
+    # sort the pixels by ROI so that every ROI is a contiguous slice
+    order = np.argsort(label_array, kind='mergesort')
+
+    return _two_time_window_state(
+        np.zeros((window, len(pixel_list)), dtype=np.float64),
+        np.zeros((window, num_rois), dtype=np.float64),
+        label_array[order],
+        pixel_list[order],
+        num_pixels,
+        np.zeros((num_rois, window, window), dtype=np.float64),
+        np.zeros((num_rois, strip_size, window), dtype=np.float64),
+        0,
+        0,
+        0,
+    )
+
+
 def two_time_state_to_results(state):
     """Convert the internal state of the two time generator into usable results
 
@@ -610,8 +2367,12 @@ def two_time_state_to_results(state):
     -------
     results : namedtuple
         A results object that contains the two time correlation results
-        and the lag steps
+        and the lag steps. Dense results are symmetrized in place, 'packed'
+        and 'banded' results are returned as they are stored, see the
+        `storage` of `lazy_two_time`
     """
+    if state.storage != 'dense':
+        return results(state.g2, state.lag_steps, state)
     for q in range(np.max(state.label_array)):
         x0 = (state.g2)[q, :, :]
         (state.g2)[q, :, :] = (np.tril(x0) + np.tril(x0).T -
@@ -621,7 +2382,7 @@ def two_time_state_to_results(state):
 
 def _two_time_process(buf, g2, label_array, num_bufs, num_pixels,
                       img_per_level, lag_steps, current_img_time,
-                      level, buf_no):
+                      level, buf_no, storage='dense'):
     """
     Parameters
     ----------
@@ -630,6 +2391,7 @@ def _two_time_process(buf, g2, label_array, num_bufs, num_pixels,
     g2: array
         two time correlation matrix
         shape (number of labels(ROI), number of frames, number of frames)
+        or packed according to `storage`
     label_array: array
         Elements not inside any ROI are zero; elements inside each
         ROI are 1, 2, 3, etc. corresponding to the order they are specified
@@ -650,6 +2412,8 @@ def _two_time_process(buf, g2, label_array, num_bufs, num_pixels,
         the current multi-tau level
     buf_no : int
         the current buffer number
+    storage : {'dense', 'packed', 'banded'}, optional
+        layout of `g2`, see `lazy_two_time`
     """
     img_per_level[level] += 1
 
@@ -686,14 +2450,101 @@ def _two_time_process(buf, g2, label_array, num_bufs, num_pixels,
         if not isinstance(current_img_time, int):
             nshift = 2**(level-1)
             for i in range(-nshift+1, nshift+1):
-                g2[:, int(tind1+i),
-                   int(tind2+i)] = (tmp_binned/(pi_binned *
-                                                fi_binned))*num_pixels
+                _set_two_time(g2, storage, tind1+i, tind2+i,
+                              (tmp_binned/(pi_binned * fi_binned))*num_pixels)
+        else:
+            _set_two_time(g2, storage, tind1, tind2,
+                          tmp_binned/(pi_binned * fi_binned)*num_pixels)
+
+
+def _set_two_time(g2, storage, tind1, tind2, value):
+    """Store one element of the two time correlation of all ROIs
+
+    Parameters
+    ----------
+    g2 : array
+        two time correlation, laid out according to `storage`
+    storage : {'dense', 'packed', 'banded'}
+        see `lazy_two_time`
+    tind1, tind2 : int or float
+        the frame times, ``tind1 >= tind2``
+    value : array
+        the correlation of each ROI
+    """
+    tind1, tind2 = int(tind1), int(tind2)
+    if storage == 'dense':
+        g2[:, tind1, tind2] = value
+    elif tind2 < 0:
+        # times before the first frame (higher multi-tau levels) are outside
+        # of the packed matrices
+        return
+    elif storage == 'packed':
+        g2[:, tind1 * (tind1 + 1) // 2 + tind2] = value
+    elif tind1 - tind2 < g2.shape[1]:
+        g2[:, tind1 - tind2, tind2] = value
+
+
+def _two_time_process_cython(buf, g2, label_array, num_bufs, num_pixels,
+                             img_per_level, lag_steps, current_img_time,
+                             level, buf_no, storage='dense'):
+    """Compiled implementation of `_two_time_process`
+
+    The products and the ROI reductions of all lags are computed in one
+    fused, parallel pass by ``_correlation.lag_sums``. The results are
+    identical to `_two_time_process`; see there for the parameters.
+    """
+    img_per_level[level] += 1
+    i_min = num_bufs // 2 if level else 0
+    lags = np.arange(i_min, min(img_per_level[level], num_bufs))
+    sums, _ = _binned_lag_sums(buf, label_array, len(num_pixels), num_bufs,
+                               level, buf_no, lags)
+    for i, (tmp_binned, pi_binned, fi_binned) in zip(lags, sums):
+        t_index = level*num_bufs//2 + i
+        tind1 = (current_img_time - 1)
+        tind2 = (current_img_time - lag_steps[t_index] - 1)
+
+        if not isinstance(current_img_time, int):
+            nshift = 2**(level-1)
+            for j in range(-nshift+1, nshift+1):
+                _set_two_time(g2, storage, tind1+j, tind2+j,
+                              (tmp_binned/(pi_binned * fi_binned))*num_pixels)
         else:
-            g2[:, int(tind1), int(tind2)] = tmp_binned/(pi_binned * fi_binned)*num_pixels
+            _set_two_time(g2, storage, tind1, tind2,
+                          tmp_binned/(pi_binned * fi_binned)*num_pixels)
+
+
+def _processing_funcs(backend=None):
+    """Select the implementation of the correlation inner loops
 
+    Parameters
+    ----------
+    backend : {'numpy', 'cython'}, optional
+        Defaults to 'cython' if the compiled kernel is available and to
+        'numpy' otherwise
 
-def _init_state_two_time(num_levels, num_bufs, labels, num_frames):
+    Returns
+    -------
+    one_time_process : function
+        inner loop of the one time correlation
+    two_time_process : function
+        inner loop of the two time correlation
+    """
+    if backend is None:
+        backend = 'numpy' if _correlation is None else 'cython'
+    if backend == 'numpy':
+        return _one_time_process, _two_time_process
+    elif backend == 'cython':
+        if _correlation is None:
+            raise ImportError(
+                "The compiled correlation kernel (skbeam.core._correlation) "
+                "is not built. Build it or use backend='numpy' instead.")
+        return _one_time_process_cython, _two_time_process_cython
+    raise ValueError("backend must be 'numpy' or 'cython'. You provided "
+                     "%s" % backend)
+
+
+def _init_state_two_time(num_levels, num_bufs, labels, num_frames,
+                         storage='dense', max_lag=None, memmap_dir=None):
     """Initialize a stateful namedtuple for two time correlation
 
     Parameters
@@ -705,6 +2556,13 @@ def _init_state_two_time(num_levels, num_bufs, labels, num_frames):
     num_frames : int
         number of images to use
         default is number of images
+    storage : {'dense', 'packed', 'banded'}, optional
+        layout of the two time correlation, see `lazy_two_time`
+    max_lag : int, optional
+        largest lag kept by the 'banded' storage
+    memmap_dir : str, optional
+        directory for a memory-mapped two time correlation
+
     Returns
     -------
     internal_state : namedtuple
@@ -726,7 +2584,8 @@ def _init_state_two_time(num_levels, num_bufs, labels, num_frames):
     time_ind = {key: [] for key in range(num_levels)}
 
     # two time correlation results (array)
-    g2 = np.zeros((num_rois, num_frames, num_frames), dtype=np.float64)
+    g2, max_lag = _two_time_storage(num_rois, num_frames, storage, max_lag,
+                                    memmap_dir)
 
     return _two_time_internal_state(
         buf,
@@ -743,9 +2602,100 @@ def _init_state_two_time(num_levels, num_bufs, labels, num_frames):
         time_ind,
         norm,
         lev_len,
+        storage,
+        max_lag,
     )
 
 
+def _two_time_storage(num_rois, num_frames, storage, max_lag=None,
+                      memmap_dir=None):
+    """Allocate the two time correlation in one of the storage layouts
+
+    Parameters
+    ----------
+    num_rois : int
+    num_frames : int
+    storage : {'dense', 'packed', 'banded'}
+        see `lazy_two_time`
+    max_lag : int, optional
+        largest lag kept by the 'banded' storage
+    memmap_dir : str, optional
+        directory for a memory-mapped ``g2.npy``
+
+    Returns
+    -------
+    g2 : array
+        zero initialized two time correlation
+    max_lag : int
+        the largest lag that is stored
+    """
+    if storage == 'dense':
+        shape = (num_rois, num_frames, num_frames)
+        max_lag = num_frames - 1
+    elif storage == 'packed':
+        shape = (num_rois, num_frames * (num_frames + 1) // 2)
+        max_lag = num_frames - 1
+    elif storage == 'banded':
+        if max_lag is None or max_lag < 0:
+            raise ValueError("The 'banded' storage needs a non-negative "
+                             "`max_lag`. You provided %s" % max_lag)
+        max_lag = min(int(max_lag), num_frames - 1)
+        shape = (num_rois, max_lag + 1, num_frames)
+    else:
+        raise ValueError("storage must be 'dense', 'packed' or 'banded'. "
+                         "You provided %s" % storage)
+    if memmap_dir is None:
+        g2 = np.zeros(shape, dtype=np.float64)
+    else:
+        if not os.path.isdir(memmap_dir):
+            os.makedirs(memmap_dir)
+        g2 = np.lib.format.open_memmap(os.path.join(memmap_dir, 'g2.npy'),
+                                       mode='w+', dtype=np.float64,
+                                       shape=shape)
+    return g2, max_lag
+
+
+def _set_two_time_block(g2, storage, t1_start, t2_start, block):
+    """Store a block of the two time correlation of all ROIs
+
+    Parameters
+    ----------
+    g2 : array
+        two time correlation, laid out according to `storage`
+    storage : {'dense', 'packed', 'banded'}
+        see `lazy_two_time`
+    t1_start, t2_start : int
+        frame times of the first row and column of the block,
+        ``t1_start >= t2_start``
+    block : array
+        correlation ``C(t1, t2)`` of each ROI, shape (num_rois, n1, n2).
+        Only the elements with ``t1 >= t2`` are stored, except for the
+        'dense' storage which is filled symmetrically
+    """
+    num_rois, n1, n2 = block.shape
+    t1 = np.arange(t1_start, t1_start + n1)
+    t2 = np.arange(t2_start, t2_start + n2)
+    if storage == 'dense':
+        if t1_start == t2_start:
+            # mirror the lower triangle of the blocks on the diagonal
+            lower = np.tril(np.ones((n1, n2), dtype=bool))
+            block = np.where(lower, block, np.swapaxes(block, 1, 2))
+        g2[:, t1[0]:t1[-1] + 1, t2[0]:t2[-1] + 1] = block
+        g2[:, t2[0]:t2[-1] + 1, t1[0]:t1[-1] + 1] = np.swapaxes(block, 1, 2)
+    elif storage == 'packed':
+        # every row is contiguous in the packed triangle
+        for row, t in enumerate(t1):
+            num = min(n2, t - t2_start + 1)
+            if num > 0:
+                start = t * (t + 1) // 2 + t2_start
+                g2[:, start:start + num] = block[:, row, :num]
+    else:
+        lag = t1[:, np.newaxis] - t2
+        keep = (lag >= 0) & (lag < g2.shape[1])
+        rows, cols = np.nonzero(keep)
+        g2[:, lag[keep], t2[cols]] = block[:, rows, cols]
+
+
 def _validate_and_transform_inputs(num_bufs, num_levels, labels):
     """
     This is a helper function to validate inputs and create initial state
@@ -828,7 +2778,7 @@ def _validate_and_transform_inputs(num_bufs, num_levels, labels):
             norm, lev_len)
 
 
-def one_time_from_two_time(two_time_corr):
+def one_time_from_two_time(two_time_corr, storage='dense'):
     """
     This will provide the one-time correlation data from two-time
     correlation data.
@@ -838,21 +2788,134 @@ def one_time_from_two_time(two_time_corr):
     two_time_corr : array
         matrix of two time correlation
         shape (number of labels(ROI's), number of frames, number of frames)
+        or packed according to `storage`
+    storage : {'dense', 'packed', 'banded'}, optional
+        layout of `two_time_corr`, see `lazy_two_time`. The packed layouts
+        are read directly, e.g. from a memory-mapped file, without
+        expanding them to the full matrix. Defaults to 'dense'
 
     Returns
     -------
     one_time_corr : array
         matrix of one time correlation
-        shape (number of labels(ROI's), number of frames)
-    """
+        shape (number of labels(ROI's), number of frames), or
+        (number of labels(ROI's), max_lag + 1) for 'banded' storage
 
-    one_time_corr = np.zeros((two_time_corr.shape[0], two_time_corr.shape[2]))
-    for g in two_time_corr:
-        for j in range(two_time_corr.shape[2]):
-            one_time_corr[:, j] = np.trace(g, offset=j)/two_time_corr.shape[2]
+    See Also
+    --------
+    age_resolved_one_time : the average over ranges of ages
+    """
+    num_frames, num_lags = _two_time_shape(two_time_corr, storage)
+    one_time_corr = np.zeros((two_time_corr.shape[0], num_lags))
+    for j in range(num_lags):
+        diag = _two_time_diagonal(two_time_corr, storage, j, num_frames)
+        one_time_corr[:, j] = np.sum(diag, axis=-1)/num_frames
     return one_time_corr
 
 
+def age_resolved_one_time(two_time_corr, age_windows, storage='dense'):
+    """One time correlation averaged over windows of ages
+
+    For every lag, the diagonal of the two time correlation is read once
+    (a strided view for the 'dense' and 'banded' storages) and its
+    cumulative sum gives the averages over all age windows and ROIs at
+    once. Memory-mapped two time correlations are never loaded as a whole.
+
+    Parameters
+    ----------
+    two_time_corr : array
+        matrix of two time correlation
+        shape (number of labels(ROI's), number of frames, number of frames)
+        or packed according to `storage`. Only the ``t1 >= t2`` half is
+        read
+    age_windows : array
+        ``(age_start, age_end)`` pairs, shape (number of windows, 2). The
+        age is the frame number of the earlier frame ``t2``, the windows
+        include `age_start` and exclude `age_end`
+    storage : {'dense', 'packed', 'banded'}, optional
+        layout of `two_time_corr`, see `lazy_two_time`. Defaults to 'dense'
+
+    Returns
+    -------
+    g2 : array
+        the average of ``C(t2 + lag, t2)`` over the ages ``t2`` of each
+        window, shape (number of labels(ROI's), number of windows, number of
+        lags), where the lag (in frames) is the index of the last axis.
+        Bad (np.nan) elements are left out; g2 is np.nan where a window has
+        no age with the lag inside of the two time correlation.
+    """
+    num_frames, num_lags = _two_time_shape(two_time_corr, storage)
+    age_windows = np.asarray(age_windows, dtype=np.int64).reshape(-1, 2)
+    if np.any(age_windows[:, 1] < age_windows[:, 0]):
+        raise ValueError("The age windows must end after they start")
+    age_windows = np.clip(age_windows, 0, num_frames)
+    start = age_windows[:, 0]
+
+    g2 = np.zeros((two_time_corr.shape[0], len(age_windows), num_lags))
+    for j in range(num_lags):
+        diag = np.asarray(_two_time_diagonal(two_time_corr, storage, j,
+                                             num_frames), dtype=np.float64)
+        valid = np.isfinite(diag)
+        # sums over [0, t2) for t2 = 0 -> len(diag), so that the sum over a
+        # window is the difference of two of these
+        sums = np.zeros((diag.shape[0], diag.shape[1] + 1))
+        np.cumsum(np.where(valid, diag, 0), axis=-1, out=sums[:, 1:])
+        counts = np.zeros_like(sums)
+        np.cumsum(valid, axis=-1, out=counts[:, 1:])
+
+        stop = np.minimum(age_windows[:, 1], diag.shape[1])
+        begin = np.minimum(start, stop)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            g2[:, :, j] = ((sums[:, stop] - sums[:, begin]) /
+                           (counts[:, stop] - counts[:, begin]))
+    return g2
+
+
+def _two_time_shape(two_time_corr, storage):
+    """The number of frames and lags of a two time correlation
+
+    Parameters
+    ----------
+    two_time_corr : array
+        the two time correlation
+    storage : {'dense', 'packed', 'banded'}
+        layout of `two_time_corr`, see `lazy_two_time`
+
+    Returns
+    -------
+    num_frames : int
+    num_lags : int
+        the number of lags that are stored
+    """
+    if storage == 'dense':
+        num_frames = two_time_corr.shape[2]
+        return num_frames, num_frames
+    elif storage == 'packed':
+        # the packed triangle has num_frames * (num_frames + 1) / 2 elements
+        num_frames = (int(round(np.sqrt(8 * two_time_corr.shape[1] + 1))) -
+                      1) // 2
+        return num_frames, num_frames
+    elif storage == 'banded':
+        return two_time_corr.shape[2], two_time_corr.shape[1]
+    raise ValueError("storage must be 'dense', 'packed' or 'banded'. "
+                     "You provided %s" % storage)
+
+
+def _two_time_diagonal(two_time_corr, storage, lag, num_frames):
+    """``C(t2 + lag, t2)`` of all ROIs, for ``t2 = 0 -> num_frames - lag - 1``
+
+    The 'dense' and 'banded' diagonals are views, 'packed' diagonals are
+    gathered.
+    """
+    if storage == 'dense':
+        return np.diagonal(two_time_corr, offset=-lag, axis1=1, axis2=2)
+    elif storage == 'packed':
+        t2 = np.arange(num_frames - lag)
+        t1 = t2 + lag
+        return two_time_corr[:, t1 * (t1 + 1) // 2 + t2]
+    return two_time_corr[:, lag, :num_frames - lag]
+
+
 class CrossCorrelator:
     '''
         Compute a 1D or 2D cross-correlation on data.
@@ -888,7 +2951,7 @@ class CrossCorrelator:
 
 
     '''
-    def __init__(self, shape, mask=None, normalization=None):
+    def __init__(self, shape, mask=None, normalization=None, workers=1):
         '''
             Prepare the spatial correlator for various regions specified by the
             id's in the image.
@@ -910,7 +2973,26 @@ class CrossCorrelator:
                     'regular' : divide by pixel number
                     'symavg' : use symmetric averaging
                 Defaults to ['regular'] normalization
+
+            workers: int, optional
+                number of threads that correlate the ids in parallel. The
+                FFTs release the GIL, so masks with many ids are correlated
+                on several cores. The threads (and their work buffers) are
+                started on the first call and kept until `close` is called.
+                If None, use all CPUs. Defaults to 1
         '''
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+        if workers < 1:
+            raise ValueError("workers must be at least 1. You provided "
+                             "%s" % workers)
+        self.workers = workers
+        # the thread pool of the workers and the work buffers that are
+        # reused by each thread, created on the first call. Neither can be
+        # pickled, see __getstate__
+        self._executor = None
+        self._buffers = None
+
         if normalization is None:
             normalization = ['regular']
         elif not isinstance(normalization, list):
@@ -1004,6 +3086,12 @@ class CrossCorrelator:
         self.maskcorrs = list()
         # regions where the correlations are not zero
         self.pxlst_maskcorrs = list()
+        # the (fast) padded shapes of the FFTs of the subregions, the spectra
+        # of the submasks and the phase ramps that shift the circular
+        # correlations to the order of the full correlations
+        self.fft_shapes = list()
+        self.submask_ffts = list()
+        self.fft_shifts = list()
 
         # basically saving bunch of mask related stuff like indexing etc, just
         # to save some time when actually computing the cross correlations
@@ -1015,7 +3103,14 @@ class CrossCorrelator:
             submask[ppiis, ppjjs] = 1
             self.submasks.append(submask)
 
-            maskcorr = _cross_corr(submask)
+            fft_shape, fft_shift = _fft_corr_shape(submask.shape)
+            self.fft_shapes.append(fft_shape)
+            self.fft_shifts.append(fft_shift)
+            submask_fft = np.fft.rfftn(submask, fft_shape)
+            self.submask_ffts.append(submask_fft)
+
+            maskcorr = _fft_corr(submask_fft * fft_shift * submask_fft.conj(),
+                                 fft_shape, submask.shape)
             # choose some small value to threshold
             maskcorr *= maskcorr > .5
             maskcorr[np.where(maskcorr == 0)] = np.nan
@@ -1036,113 +3131,537 @@ class CrossCorrelator:
             self.positions = self.positions[0]
             self.centers = self.centers[0]
 
-    def __call__(self, img1, img2=None, normalization=None):
+    def __call__(self, img1, img2=None, normalization=None, average=False,
+                 batch_size=64):
         ''' Run the cross correlation on an image/curve or against two
                 images/curves
 
             Parameters
             ----------
             img1 : 1D or 2D np.ndarray
-                The image (or curve) to run the cross correlation on
+                The image (or curve) to run the cross correlation on. A stack
+                of images (or curves), with the frames along the first axis,
+                is correlated frame by frame.
 
             img2 : 1D or 2D np.ndarray
                 If not set to None, run cross correlation of this image (or
-                curve) against img1. Default is None.
+                curve) against img1. Default is None. Must be a stack of the
+                same length if img1 is a stack.
 
             normalization : string or list of strings
                 normalization types. If not set, use internally saved
                 normalization parameters
 
+            average : bool, optional
+                For stacks, return the average of the correlations of all
+                frames instead of one correlation per frame. Default is
+                False.
+
+            batch_size : int, optional
+                For stacks, the number of frames to transform at once.
+                Default is 64.
+
             Returns
             -------
             ccorrs : 1d or 2d np.ndarray
                 An image of the correlation. The zero correlation is
                 located at shape//2 where shape is the 1 or 2-tuple
-                shape of the array
+                shape of the array. For stacks, the correlations of the
+                frames are stacked along the first axis (unless `average`
+                is set).
 
         '''
         if normalization is None:
             normalization = self.normalization
 
-        if img1.shape != self.shape:
+        if img1.shape == self.shape:
+            stack = False
+        elif img1.shape[1:] == self.shape:
+            stack = True
+        else:
             raise ValueError("Image not expected shape." +
                              "Got {}, ".format(img1.shape) +
                              "expected {}".format(self.shape)
                              )
+        if not stack:
+            img1 = img1[np.newaxis]
         # reshape for 1D case
         if self.ndim == 1:
-            img1 = img1.reshape((1, self.shape[0]))
+            img1 = img1.reshape((-1, 1, self.shape[0]))
 
-        if img2 is None:
-            self_correlation = True
-        else:
-            self_correlation = False
-            if img2.shape != self.shape:
+        if img2 is not None:
+            if img2.shape != img1.shape[:1] * stack + self.shape:
                 raise ValueError("Second image not expected shape. " +
                                  "Got {}".format(img2.shape) +
-                                 " expected {}".format(self.shape))
-            if self.ndim == 1:
-                img2 = img2.reshape((1, self.shape[0]))
+                                 " expected {}".format(
+                                     img1.shape[:1] * stack + self.shape))
+            img2 = img2.reshape(img1.shape)
 
-        ccorrs = list()
-        rngiter = tqdm(range(self.nids))
+        num_frames = img1.shape[0]
+        batch_size = max(1, min(batch_size, num_frames))
 
-        idpos = self.idpos
-        for i in rngiter:
-            index_start, index_stop = idpos[i], idpos[i+1]
-            ppiis = self.ppii[index_start:index_stop]
-            ppjjs = self.ppjj[index_start:index_stop]
-            pis = self.pi[index_start:index_stop]
-            pjs = self.pj[index_start:index_stop]
-            tmpimg = np.zeros(self.shapes[i, :])
-            tmpimg[ppiis, ppjjs] = img1[pis, pjs]
+        if self._buffers is None:
+            self._buffers = threading.local()
 
-            if not self_correlation:
-                tmpimg2 = np.zeros_like(tmpimg)
-                tmpimg2[ppiis, ppjjs] = img2[pis, pjs]
-                tmpimg2[ppiis, ppjjs] = img2[pis, pjs]
+        def correlate(i):
+            return self._correlate_id(i, img1, img2, normalization, average,
+                                      batch_size, stack)
 
-            if self_correlation:
-                ccorr = _cross_corr(tmpimg)
-            else:
-                ccorr = _cross_corr(tmpimg, tmpimg2)
-
-            # Note, in this code, non-overlapping regions will now get np.nan
-            # also, for sym averaging, if Icorr*Icorr2==0, then we also get
-            # np.nan
-            if 'symavg' in normalization:
-                # do symmetric averaging
-                Icorr = _cross_corr(tmpimg * self.submasks[i],
-                                    self.submasks[i])
-                if self_correlation:
-                    Icorr2 = _cross_corr(self.submasks[i], tmpimg *
-                                         self.submasks[i])
-                else:
-                    Icorr2 = _cross_corr(self.submasks[i], tmpimg2 *
-                                         self.submasks[i])
-                ccorr *= self.maskcorrs[i]/Icorr/Icorr2
-
-            if 'regular' in normalization:
-                if self_correlation:
-                    ccorr /= self.maskcorrs[i] * \
-                             np.average(tmpimg[ppiis, ppjjs])**2
-                else:
-                    ccorr /= self.maskcorrs[i] *\
-                             np.average(tmpimg[ppiis, ppjjs]) *\
-                             np.average(tmpimg2[ppiis, ppjjs])
-            if self.ndim == 1:
-                ccorr = ccorr.reshape(-1)
-            ccorrs.append(ccorr)
+        if self.workers == 1:
+            ccorrs = [correlate(i) for i in tqdm(range(self.nids))]
+        else:
+            if self._executor is None:
+                # imported here for python 2 without the futures backport
+                from concurrent.futures import ThreadPoolExecutor
+                self._executor = ThreadPoolExecutor(max_workers=self.workers)
+            # map keeps the order of the ids
+            ccorrs = list(tqdm(self._executor.map(correlate,
+                                                  range(self.nids))))
 
         if len(ccorrs) == 1:
             ccorrs = ccorrs[0]
 
         return ccorrs
 
+    def close(self):
+        ''' Stop the worker threads and free their work buffers
+
+            The correlator can still be used afterwards, the threads are
+            started again on the next call.
+        '''
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+    def __enter__(self):
+        return self
+
+    def __getstate__(self):
+        # the threads and their buffers are started again after unpickling
+        state = self.__dict__.copy()
+        state['_executor'] = None
+        state['_buffers'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _work_buffer(self, name, shape, dtype=np.float64):
+        ''' A work buffer of the current thread, reused between calls
+
+            Parameters
+            ----------
+            name : str
+                the name of the buffer
+            shape : tuple
+                the shape of the buffer, it is reallocated if it does not fit
+            dtype : np.dtype, optional
+                Default is np.float64
+
+            Returns
+            -------
+            buf : np.ndarray
+                the buffer, its content is undefined
+        '''
+        buffers = self._buffers.__dict__
+        size = int(np.prod(shape))
+        if name not in buffers or buffers[name].size < size:
+            buffers[name] = np.empty(size, dtype=dtype)
+        return buffers[name][:size].reshape(shape)
+
+    def _correlate_id(self, i, img1, img2, normalization, average,
+                      batch_size, stack):
+        ''' The correlation of one id, see `__call__`
+
+            Parameters
+            ----------
+            i : int
+                the index of the id
+            img1, img2 : np.ndarray
+                the (2D) image stacks, img2 is None for self correlations
+            normalization : list of strings
+                normalization types
+            average : bool
+                average the correlations of the frames
+            batch_size : int
+                number of frames to transform at once
+            stack : bool
+                the images are stacks
+
+            Returns
+            -------
+            ccorr : np.ndarray
+                the correlation (of each frame)
+        '''
+        self_correlation = img2 is None
+        num_frames = img1.shape[0]
+        index_start, index_stop = self.idpos[i], self.idpos[i+1]
+        ppiis = self.ppii[index_start:index_stop]
+        ppjjs = self.ppjj[index_start:index_stop]
+        pis = self.pi[index_start:index_stop]
+        pjs = self.pj[index_start:index_stop]
+        # work buffers for the sub images, zero outside of the submask,
+        # and for the products of their spectra
+        tmpimg = self._work_buffer('tmpimg', (batch_size,) +
+                                   tuple(self.shapes[i, :]))
+        tmpimg.fill(0)
+        if not self_correlation:
+            tmpimg2 = self._work_buffer('tmpimg2', tmpimg.shape)
+            tmpimg2.fill(0)
+        num_spectra = 1
+        if 'symavg' in normalization:
+            num_spectra += 1 if self_correlation else 2
+        spectra = self._work_buffer('spectra', (num_spectra, batch_size) +
+                                    self.submask_ffts[i].shape,
+                                    dtype=np.complex128)
+
+        ccorr_shape = tuple(2 * self.shapes[i, :] - 1)
+        if average:
+            ccorr = np.zeros(ccorr_shape)
+        else:
+            ccorr = np.empty((num_frames,) + ccorr_shape)
+        for start in range(0, num_frames, batch_size):
+            stop = min(start + batch_size, num_frames)
+            num = stop - start
+            tmpimg[:num, ppiis, ppjjs] = img1[start:stop, pis, pjs]
+            if not self_correlation:
+                tmpimg2[:num, ppiis, ppjjs] = img2[start:stop, pis, pjs]
+            batch = self._correlate_subimages(
+                i, tmpimg[:num],
+                None if self_correlation else tmpimg2[:num],
+                normalization, spectra[:, :num])
+            if average:
+                ccorr += batch.sum(axis=0)
+            else:
+                ccorr[start:stop] = batch
+
+        if average:
+            ccorr /= num_frames
+        elif not stack:
+            ccorr = ccorr[0]
+        if self.ndim == 1:
+            ccorr = ccorr.reshape(ccorr.shape[:-2] + (-1,))
+        return ccorr
+
+    def _correlate_subimages(self, i, tmpimg, tmpimg2, normalization,
+                             spectra):
+        ''' Normalized correlations of a stack of sub images of one id
+
+            Parameters
+            ----------
+            i : int
+                the index of the id
+            tmpimg, tmpimg2 : np.ndarray
+                stacks of the sub images of the id, zero outside of the
+                submask. tmpimg2 is None for self correlations
+
+            normalization : list of strings
+                normalization types
+
+            spectra : np.ndarray
+                work buffer for the products of the spectra, 1 (regular), 2
+                (symavg) or 3 (symavg, not a self correlation) stacks of
+                spectra
+
+            Returns
+            -------
+            ccorr : np.ndarray
+                the correlation of each frame
+        '''
+        self_correlation = tmpimg2 is None
+        index_start, index_stop = self.idpos[i], self.idpos[i+1]
+        ppiis = self.ppii[index_start:index_stop]
+        ppjjs = self.ppjj[index_start:index_stop]
+
+        # The images are zero outside of the submask, so the image
+        # spectra serve all of the correlations: one forward and one
+        # inverse (batched) FFT per id
+        fft_shape = self.fft_shapes[i]
+        img_fft = np.fft.rfftn(tmpimg, fft_shape, axes=(-2, -1))
+        if self_correlation:
+            img2_fft_conj = img_fft.conj()
+        else:
+            img2_fft_conj = np.fft.rfftn(tmpimg2, fft_shape,
+                                         axes=(-2, -1)).conj()
+        # the shift is applied to the first spectrum of each product
+        img_fft *= self.fft_shifts[i]
+        np.multiply(img_fft, img2_fft_conj, out=spectra[0])
+        if 'symavg' in normalization:
+            submask_fft = self.submask_ffts[i]
+            np.multiply(img_fft, submask_fft.conj(), out=spectra[1])
+            if not self_correlation:
+                np.multiply(submask_fft * self.fft_shifts[i], img2_fft_conj,
+                            out=spectra[2])
+        corrs = _fft_corr(spectra, fft_shape, tmpimg.shape[-2:])
+        ccorr = corrs[0]
+
+        # Note, in this code, non-overlapping regions will now get np.nan
+        # also, for sym averaging, if Icorr*Icorr2==0, then we also get
+        # np.nan
+        if 'symavg' in normalization:
+            # do symmetric averaging
+            Icorr = corrs[1]
+            if self_correlation:
+                # the correlation of the mask with the image is the mirror
+                # image of the correlation of the image with the mask
+                Icorr2 = Icorr[..., ::-1, ::-1]
+            else:
+                Icorr2 = corrs[2]
+            ccorr *= self.maskcorrs[i]/Icorr/Icorr2
+
+        if 'regular' in normalization:
+            average1 = np.average(tmpimg[:, ppiis, ppjjs], axis=-1)
+            if self_correlation:
+                average2 = average1
+            else:
+                average2 = np.average(tmpimg2[:, ppiis, ppjjs], axis=-1)
+            ccorr /= self.maskcorrs[i] * \
+                (average1 * average2)[:, np.newaxis, np.newaxis]
+        return ccorr
+
+
+_cross_corr_state = namedtuple(
+    'cross_correlation_state',
+    ['spectra',
+     'icorrs',
+     'means',
+     'bad',
+     'ccorrs',
+     'counts',
+     'deltas',
+     'num_frames']
+)
+
+cross_corr_results = namedtuple(
+    'cross_correlation_results',
+    ['ccorrs', 'deltas', 'internal_state']
+)
+
+
+def lazy_cross_corr(image_iterable, cross_correlator, deltas,
+                    internal_state=None, yield_every=1):
+    """Time resolved spatial cross correlations, averaged over a series
+
+    The spatial cross correlation of the frames ``t`` and ``t + delta`` is
+    computed for every delta in `deltas`, with the ids and normalization of
+    `cross_correlator`, and averaged over all ``t``. The spectra of the
+    last ``max(deltas)`` frames are kept in a ring buffer, so every frame
+    is transformed once, no matter how many deltas there are. Bad frames
+    (containing np.nan, e.g. from `skbeam.core.mask.bad_to_nan_gen`) are
+    left out of the averages.
+
+    Parameters
+    ----------
+    image_iterable : iterable of 1D or 2D np.ndarray
+        the images (or curves), of the shape of `cross_correlator`
+    cross_correlator : CrossCorrelator
+        the ids and normalization to correlate with
+    deltas : array
+        the frame differences, non-negative integers
+    internal_state : namedtuple, optional
+        the state of a previous run of this generator, to pick up
+        processing where it was interrupted
+    yield_every : int, optional
+        see `lazy_one_time`. Defaults to 1
+
+    Yields
+    ------
+    namedtuple
+        A ``cross_correlation_results`` object, that contains, in this
+        order:
+
+        - ``ccorrs``: for every id, the average correlation of the frames
+          ``t`` (``img1`` of `CrossCorrelator`) and ``t + delta`` (``img2``)
+          for each delta, stacked along the first axis. np.nan for deltas
+          that have not been seen yet. A single array if there is one id
+        - ``deltas``: the sorted deltas
+        - ``internal_state``: all of the internal state. Can be passed back
+          in as the ``internal_state`` parameter
+    """
+    if yield_every is not None and yield_every < 1:
+        raise ValueError("yield_every must be at least 1 or None. You "
+                         "provided %s" % yield_every)
+    cc = cross_correlator
+    if internal_state is None:
+        internal_state = _init_state_cross_corr(cc, deltas)
+    s = internal_state
+    symavg = 'symavg' in cc.normalization
+    regular = 'regular' in cc.normalization
+    depth = len(s.bad)
+    num_processed = 0
+    for img in image_iterable:
+        if img.shape != cc.shape:
+            raise ValueError("Image not expected shape." +
+                             "Got {}, ".format(img.shape) +
+                             "expected {}".format(cc.shape))
+        if cc.ndim == 1:
+            img = img.reshape((1, cc.shape[0]))
+        t = s.num_frames
+        slot = t % depth
+        s.bad[slot] = np.isnan(img).any()
+        s = s._replace(num_frames=t + 1)
+
+        # the deltas with a past frame, if neither frame is bad
+        num_deltas = np.searchsorted(s.deltas, t, side='right')
+        past = (t - s.deltas[:num_deltas]) % depth
+        k = np.nonzero(~(s.bad[past] | s.bad[slot]))[0]
+        past = past[k]
+        s.counts[k] += 1
+
+        for i in range(cc.nids):
+            index_start, index_stop = cc.idpos[i], cc.idpos[i+1]
+            ppiis = cc.ppii[index_start:index_stop]
+            ppjjs = cc.ppjj[index_start:index_stop]
+            tmpimg = np.zeros(cc.shapes[i, :])
+            tmpimg[ppiis, ppjjs] = img[cc.pi[index_start:index_stop],
+                                       cc.pj[index_start:index_stop]]
+            fft_shape = cc.fft_shapes[i]
+            spectrum = np.fft.rfftn(tmpimg, fft_shape)
+            s.spectra[i][slot] = spectrum * cc.fft_shifts[i]
+            s.means[slot, i] = np.average(tmpimg[ppiis, ppjjs])
+            if symavg:
+                s.icorrs[i][slot] = _fft_corr(
+                    s.spectra[i][slot] * cc.submask_ffts[i].conj(), fft_shape,
+                    tmpimg.shape)
+            if not len(k):
+                continue
+
+            ccorr = _fft_corr(s.spectra[i][past] * spectrum.conj(), fft_shape,
+                              tmpimg.shape)
+            if symavg:
+                # the correlation of the mask with the new frame is the
+                # mirror image of the correlation of the frame with the mask
+                ccorr *= (cc.maskcorrs[i] / s.icorrs[i][past] /
+                          s.icorrs[i][slot][::-1, ::-1])
+            if regular:
+                ccorr /= cc.maskcorrs[i] * (s.means[past, i] *
+                                            s.means[slot, i])[:, np.newaxis,
+                                                              np.newaxis]
+            s.ccorrs[i][k] += ((ccorr - s.ccorrs[i][k]) /
+                               s.counts[k][:, np.newaxis, np.newaxis])
+
+        num_processed += 1
+        if yield_every is not None and num_processed % yield_every == 0:
+            yield _cross_corr_results(s, cc)
+    # always yield the final result
+    if num_processed and (yield_every is None or num_processed % yield_every):
+        yield _cross_corr_results(s, cc)
+
+
+def _cross_corr_results(state, cross_correlator):
+    """The averages of `lazy_cross_corr`, shaped like `CrossCorrelator`"""
+    ccorrs = list()
+    for ccorr in state.ccorrs:
+        ccorr = ccorr.copy()
+        ccorr[state.counts == 0] = np.nan
+        if cross_correlator.ndim == 1:
+            ccorr = ccorr.reshape(ccorr.shape[:-2] + (-1,))
+        ccorrs.append(ccorr)
+    if len(ccorrs) == 1:
+        ccorrs = ccorrs[0]
+    return cross_corr_results(ccorrs, state.deltas, state)
+
+
+def _init_state_cross_corr(cross_correlator, deltas):
+    """Initialize a stateful namedtuple for `lazy_cross_corr`
+
+    Parameters
+    ----------
+    cross_correlator : CrossCorrelator
+    deltas : array
+        the frame differences
+
+    Returns
+    -------
+    internal_state : namedtuple
+        The namedtuple that contains all the state information that
+        `lazy_cross_corr` requires so that it can be used to pick up
+        processing after it was interrupted
+    """
+    cc = cross_correlator
+    deltas = np.unique(np.asarray(deltas, dtype=np.int64))
+    if not len(deltas) or deltas[0] < 0:
+        raise ValueError("deltas must be non-negative integers. You "
+                         "provided %s" % deltas)
+    depth = deltas[-1] + 1
+    spectra, icorrs, ccorrs = [], [], []
+    for i in range(cc.nids):
+        ccorr_shape = tuple(2 * cc.shapes[i, :] - 1)
+        spectra.append(np.zeros((depth,) + cc.submask_ffts[i].shape,
+                                dtype=np.complex128))
+        if 'symavg' in cc.normalization:
+            icorrs.append(np.zeros((depth,) + ccorr_shape))
+        ccorrs.append(np.zeros((len(deltas),) + ccorr_shape))
+    return _cross_corr_state(
+        spectra,
+        icorrs,
+        np.zeros((depth, cc.nids)),
+        np.zeros(depth, dtype=bool),
+        ccorrs,
+        np.zeros(len(deltas), dtype=np.int64),
+        deltas,
+        0,
+    )
+
+
+def _fft_corr_shape(shape):
+    """The FFT shape and phase ramp for full correlations of `shape`
+
+    Parameters
+    ----------
+    shape : tuple
+        shape of the (2D) images to correlate
+
+    Returns
+    -------
+    fft_shape : tuple
+        the fast FFT lengths that hold the full correlation,
+        ``2 * shape - 1``, without wrapping around
+    fft_shift : array
+        the (real FFT) spectrum of a shift by ``shape - 1``, which moves the
+        lags ``-(n - 1) -> n - 1`` of the circular correlation to the start
+    """
+    fft_shape = tuple(next_fast_len(2 * n - 1) for n in shape)
+    freqs = [np.fft.fftfreq(fft_shape[0]), np.fft.rfftfreq(fft_shape[1])]
+    fft_shift = np.exp(-2j * np.pi * (freqs[0][:, np.newaxis] *
+                                      (shape[0] - 1) +
+                                      freqs[1] * (shape[1] - 1)))
+    return fft_shape, fft_shift
+
+
+def _fft_corr(spectra, fft_shape, shape):
+    """Full correlations from the products of the spectra of two images
+
+    Parameters
+    ----------
+    spectra : array
+        ``rfftn(img1) * fft_shift * rfftn(img2).conj()`` over the last two
+        axes, at the `fft_shape` of `_fft_corr_shape`. Leading axes are
+        batched
+    fft_shape : tuple
+        see `_fft_corr_shape`
+    shape : tuple
+        shape of the images
+
+    Returns
+    -------
+    corr : array
+        the correlation, the same as ``_cross_corr(img1, img2)``
+    """
+    corr = np.fft.irfftn(spectra, fft_shape, axes=(-2, -1))
+    return corr[..., :2 * shape[0] - 1, :2 * shape[1] - 1]
+
 
 def _cross_corr(img1, img2=None):
     ''' Compute the cross correlation of one (or two) images.
 
+        This is the direct (full ``fftconvolve``) correlation that
+        `CrossCorrelator` computes from its cached spectra. It is kept as
+        the reference the tests compare `CrossCorrelator` against.
+
         Parameters
         ----------
         img1 : np.ndarray
@@ -1168,7 +3687,7 @@ def _cross_corr(img1, img2=None):
     # need to reverse indices for second image
     # fftconvolve(A,B) = FFT^(-1)(FFT(A)*FFT(B))
     # but need FFT^(-1)(FFT(A(x))*conj(FFT(B(x)))) = FFT^(-1)(A(x)*B(-x))
-    reverse_index = [slice(None, None, -1) for i in range(ndim)]
+    reverse_index = tuple(slice(None, None, -1) for i in range(ndim))
     imgc = fftconvolve(img1, img2[reverse_index], mode='full')
 
     return imgc
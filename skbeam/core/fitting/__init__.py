@@ -54,4 +54,4 @@ lineshapes_list = sorted([gaussian, lorentzian, lorentzian2, voigt, pvoigt,
                           gaussian_tail, gausssian_step, elastic, compton],
                          key=lambda s: str(s))
 from .base.parameter_data import get_para
-from .funcs import fit_quad_to_peak
+from .funcs import fit_quad_to_peak, fit_nbinom_dist
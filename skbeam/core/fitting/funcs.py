@@ -1,5 +1,6 @@
 from __future__ import absolute_import, division, print_function
 import numpy as np
+from scipy.special import gammaln
 
 
 def fit_quad_to_peak(x, y):
@@ -43,3 +44,153 @@ def fit_quad_to_peak(x, y):
                 beta[2] - beta[0] * (beta[1] / (2 * beta[0])) ** 2)
 
     return ret_beta, 1 - SSerr / SStot
+
+
+def fit_nbinom_dist(histograms, num_samples=None, max_iter=50, tol=1e-10):
+    """
+    Maximum likelihood fit of the negative binomial distribution
+    (`nbinom_dist`) to many photon count histograms at once
+
+    The mean count K of the maximum likelihood fit is the mean of each
+    histogram. The number of modes M is found with Newton iterations on
+    ``log(M)``, for all histograms together.
+
+    Parameters
+    ----------
+    histograms : ndarray
+        probability densities (or counts) of detecting 0, 1, 2, ...
+        photons, shape (..., num_bins), e.g. (num_times, num_roi, num_bins).
+        An object array of 1D histograms of different lengths, as returned
+        by `skbeam.core.speckle.xsvs`, is also accepted
+    num_samples : float or ndarray, optional
+        the number of counts (e.g. pixels times images) behind each
+        histogram, to scale the uncertainties. Defaults to the sums of the
+        histograms, i.e. histograms of counts. Required for probability
+        densities, which sum to 1: a ValueError is raised if it is not
+        given and the histograms are not counts
+    max_iter : int, optional
+        the largest number of Newton iterations. Defaults to 50
+    tol : float, optional
+        the change of ``log(M)`` at which to stop. Defaults to 1e-10
+
+    Returns
+    -------
+    params : ndarray
+        the fitted K and M of each histogram, shape (..., 2). Histograms
+        without a variance above the Poisson variance K have no finite
+        maximum, their M is np.inf
+    covariance : ndarray
+        the covariance of K and M of each histogram, shape (..., 2, 2).
+        The uncertainty of an infinite M is np.nan
+    """
+    histograms = np.asarray(histograms)
+    if histograms.dtype == object:
+        # pad the histograms to the same length
+        num_bins = max(len(hist) for hist in histograms.ravel())
+        padded = np.zeros(histograms.shape + (num_bins, ))
+        for index, hist in np.ndenumerate(histograms):
+            padded[index][:len(hist)] = hist
+        histograms = padded
+    histograms = np.asarray(histograms, dtype=np.float64)
+    out_shape = histograms.shape[:-1]
+    hist = histograms.reshape(-1, histograms.shape[-1])
+    # leave out the empty bins at the end
+    nonzero = np.nonzero(hist.any(axis=0))[0]
+    num_bins = nonzero[-1] + 1 if len(nonzero) else 1
+    hist = hist[:, :num_bins]
+    counts = np.arange(num_bins)
+
+    totals = hist.sum(axis=1)
+    if num_samples is None:
+        if np.any(hist != np.round(hist)):
+            raise ValueError("The histograms are not counts (e.g. they are "
+                             "probability densities that sum to 1), pass "
+                             "the number of counts behind them as "
+                             "num_samples")
+        num_samples = totals
+    else:
+        num_samples = np.broadcast_to(num_samples, out_shape).ravel()
+    with np.errstate(divide='ignore', invalid='ignore'):
+        prob = hist / totals[:, np.newaxis]
+    prob = np.nan_to_num(prob)
+
+    K = prob.dot(counts)
+    var = prob.dot(counts**2) - K**2
+    M = np.full(len(hist), np.inf)
+    # method of moments starting values
+    fit = (var > K) & (K > 0)
+    M[fit] = K[fit]**2 / (var[fit] - K[fit])
+
+    log_m = np.log(M[fit])
+    active = np.ones(len(log_m), dtype=bool)
+    current = _nbinom_log_likelihood(prob[fit], K[fit], M[fit], counts)
+    for _ in range(max_iter):
+        p, k_mean = prob[fit][active], K[fit][active]
+        m = np.exp(log_m[active])
+        grad, hess = _nbinom_derivatives(p, k_mean, m, counts)
+        # Newton step in log(M), uphill steps of 1 where the log likelihood
+        # is not concave
+        grad_u = m * grad
+        hess_u = m**2 * hess + grad_u
+        concave = hess_u < 0
+        step = np.where(concave, -grad_u / np.where(concave, hess_u, 1),
+                        np.sign(grad_u))
+        # halve the steps that do not increase the likelihood (up to
+        # rounding)
+        before = current[active]
+        for _ in range(30):
+            trial = _nbinom_log_likelihood(p, k_mean, np.exp(log_m[active] +
+                                                             step), counts)
+            worse = ~(trial >= before - 1e-13 * np.abs(before))
+            if not worse.any():
+                break
+            step[worse] /= 2
+        step[worse] = 0
+        log_m[active] += step
+        current[active] = np.where(worse, before, trial)
+        active[active] = np.abs(step) >= tol
+        if not active.any():
+            break
+    M[fit] = np.exp(log_m)
+
+    covariance = np.zeros((len(hist), 2, 2))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        covariance[:, 0, 0] = K * (1 + K / M) / num_samples
+        covariance[:, 1, 1] = np.nan
+        # K and M are orthogonal, the covariance is diagonal
+        covariance[fit, 1, 1] = -1 / (num_samples[fit] *
+                                      _nbinom_derivatives(prob[fit], K[fit],
+                                                          M[fit], counts)[1])
+    params = np.stack([K, M], axis=-1)
+    return (params.reshape(out_shape + (2, )),
+            covariance.reshape(out_shape + (2, 2)))
+
+
+def _nbinom_log_likelihood(prob, K, M, counts):
+    """
+    The mean log likelihood of the negative binomial distribution of mean
+    `K` and `M` modes, for the histograms `prob` of `counts`, one row per
+    histogram
+    """
+    K = K[:, np.newaxis]
+    M = M[:, np.newaxis]
+    return np.sum(prob * (gammaln(counts + M) - gammaln(M) -
+                          gammaln(counts + 1) - M * np.log1p(K / M) +
+                          counts * np.log(K / (K + M))), axis=1)
+
+
+def _nbinom_derivatives(prob, K, M, counts):
+    """
+    The first and second derivatives by M of `_nbinom_log_likelihood`,
+    for K at its maximum likelihood value (the mean)
+
+    The differences of the digamma and trigamma functions are sums over
+    the counts, ``psi(k + M) - psi(M) = sum_{j < k} 1 / (M + j)``.
+    """
+    terms = 1 / (M[:, np.newaxis] + counts[:-1])
+    zero = np.zeros((len(M), 1))
+    digamma_diff = np.hstack([zero, np.cumsum(terms, axis=1)])
+    trigamma_diff = -np.hstack([zero, np.cumsum(terms**2, axis=1)])
+    grad = np.sum(prob * digamma_diff, axis=1) - np.log1p(K / M)
+    hess = np.sum(prob * trigamma_diff, axis=1) + 1 / M - 1 / (K + M)
+    return grad, hess
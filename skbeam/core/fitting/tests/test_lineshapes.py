@@ -37,13 +37,14 @@
 ########################################################################
 from __future__ import absolute_import, division, print_function
 import numpy as np
-from numpy.testing import (assert_array_almost_equal)
+from numpy.testing import (assert_array_almost_equal, assert_raises)
 
 from skbeam.core.fitting import (gaussian, gausssian_step, gaussian_tail,
                                  elastic, compton, lorentzian, lorentzian2,
                                  voigt, pvoigt)
 from skbeam.core.fitting import (ComptonModel, ElasticModel)
-from skbeam.core.fitting import (gamma_dist, nbinom_dist, poisson_dist)
+from skbeam.core.fitting import (gamma_dist, nbinom_dist, poisson_dist,
+                                 fit_nbinom_dist)
 
 
 def test_gauss_peak():
@@ -355,6 +356,56 @@ def test_dist():
                                         0.18795214, 0.21260011]))
 
 
+def test_fit_nbinom_dist():
+    np.random.seed(0)
+    K = np.array([[0.8, 2.5, 6.], [1.5, 4., 9.]])
+    M = np.array([[2., 7., 4.], [12., 1.5, 5.]])
+    num_bins = 120
+    hists = np.zeros(K.shape + (num_bins, ))
+    for index in np.ndindex(K.shape):
+        samples = np.random.negative_binomial(M[index],
+                                              M[index] / (M[index] + K[index]),
+                                              20000)
+        hists[index] = np.bincount(samples, minlength=num_bins)
+    params, cov = fit_nbinom_dist(hists)
+    assert params.shape == (2, 3, 2)
+    assert cov.shape == (2, 3, 2, 2)
+    assert_array_almost_equal(params[..., 0],
+                              hists.dot(np.arange(num_bins)) /
+                              hists.sum(axis=-1))
+    # within 4 standard deviations
+    assert np.all(np.abs(params[..., 0] - K) < 4 * cov[..., 0, 0]**.5)
+    assert np.all(np.abs(params[..., 1] - M) < 4 * cov[..., 1, 1]**.5)
+
+    # the maximum of the likelihood
+    counts = np.arange(num_bins)
+    for index in [(0, 1), (1, 2)]:
+        def neg_log_likelihood(m):
+            return -np.sum(hists[index] * np.log(
+                nbinom_dist(counts, params[index][0], m)))
+        m_fit = params[index][1]
+        assert neg_log_likelihood(m_fit) <= neg_log_likelihood(m_fit * 1.001)
+        assert neg_log_likelihood(m_fit) <= neg_log_likelihood(m_fit / 1.001)
+
+    # densities of different lengths, as from xsvs
+    densities = np.zeros(K.shape, dtype=object)
+    for index in np.ndindex(K.shape):
+        last = np.nonzero(hists[index])[0][-1]
+        densities[index] = hists[index][:last + 1] / hists[index].sum()
+    params_dens, cov_dens = fit_nbinom_dist(densities,
+                                            num_samples=hists.sum(axis=-1))
+    assert_array_almost_equal(params_dens, params)
+    assert_array_almost_equal(cov_dens, cov)
+    # the uncertainties of densities need the number of samples
+    assert_raises(ValueError, fit_nbinom_dist, densities)
+
+    # less variance than a poisson distribution
+    params, cov = fit_nbinom_dist(np.bincount(
+        np.random.binomial(10, 0.3, 1000)))
+    assert params[1] == np.inf
+    assert np.isnan(cov[1, 1])
+
+
 if __name__ == '__main__':
     import nose
     nose.runmodule(argv=['-s', '--with-doctest'], exit=False)
@@ -45,6 +45,8 @@ This module will provide XSVS analysis tools
 """
 
 from __future__ import (absolute_import, division, print_function)
+from collections import namedtuple, deque
+import multiprocessing
 import numpy as np
 import time
 
@@ -56,7 +58,7 @@ logger = logging.getLogger(__name__)
 
 
 def xsvs(image_sets, label_array, number_of_img, timebin_num=2,
-         max_cts=None):
+         max_cts=None, single_pass=False):
     """
     This function will provide the probability density of detecting photons
     for different integration times.
@@ -86,6 +88,11 @@ def xsvs(image_sets, label_array, number_of_img, timebin_num=2,
        the brightest pixel in any ROI in any image in the image set.
        defaults to using skbeam.core.roi.roi_max_counts to determine
        the brightest pixel in any of the ROIs
+    single_pass : bool, optional
+        If True and `max_cts` is not given, read the images only once: the
+        histograms grow as larger counts show up, instead of finding
+        `max_cts` with skbeam.core.roi.roi_max_counts first. The results
+        are the same, up to rounding. Defaults to False
 
     Returns
     -------
@@ -114,110 +121,979 @@ def xsvs(image_sets, label_array, number_of_img, timebin_num=2,
 
     """
     if max_cts is None:
+        if single_pass:
+            start_time = time.time()
+            prob_k_all, prob_k_pow_all, num_bins = _xsvs_single_pass(
+                image_sets, label_array, number_of_img, timebin_num)
+            prob_k_std_dev = (prob_k_pow_all - prob_k_all**2)**.5
+            logger.info("Processing time for XSVS took %s seconds."
+                        "", (time.time() - start_time))
+            return (_to_object_array(prob_k_all, num_bins),
+                    _to_object_array(prob_k_std_dev, num_bins))
         max_cts = roi.roi_max_counts(image_sets, label_array)
 
+    # probability density of detecting photons, and its square, averaged
+    # over the image sets
+    prob_k_all = None
+    prob_k_pow_all = None
+
+    start_time = time.time()  # used to log the computation time (optionally)
+
+    for i, images in enumerate(image_sets):
+        state = _init_state_xsvs(label_array, number_of_img, timebin_num,
+                                 max_cts)
+        if prob_k_all is None:
+            prob_k_all = np.zeros_like(state.prob_k)
+            prob_k_pow_all = np.zeros_like(state.prob_k_pow)
+
+        for img in images:
+            _xsvs_process_frame(state, img, timebin_num)
+
+            prob_k_all += (state.prob_k - prob_k_all)/(i + 1)
+            prob_k_pow_all += (state.prob_k_pow - prob_k_pow_all)/(i + 1)
+
+    prob_k_std_dev = (prob_k_pow_all - prob_k_all**2)**.5
+
+    logger.info("Processing time for XSVS took %s seconds."
+                "", (time.time() - start_time))
+    return (_to_object_array(prob_k_all, state.num_bins),
+            _to_object_array(prob_k_std_dev, state.num_bins))
+
+
+xsvs_results = namedtuple(
+    'xsvs_results',
+    ['prob_k', 'prob_k_std_dev', 'internal_state']
+)
+
+_xsvs_internal_state = namedtuple(
+    'xsvs_state',
+    ['buf',
+     'prob_k',
+     'prob_k_pow',
+     'track_level',
+     'track_bad',
+     'cur',
+     'img_per_level',
+     'roi_index',
+     'pixel_list',
+     'num_bins',
+     'max_cts']
+)
+
+
+def _init_state_xsvs(label_array, number_of_img, timebin_num, max_cts):
+    """Initialize a stateful namedtuple for the generator-based XSVS
+
+    Parameters
+    ----------
+    label_array : array
+        labeled array; 0 is background.
+    number_of_img : int
+        number of images, sets the number of integration times
+    timebin_num : int
+        integration time
+    max_cts : int
+        maximum pixel count
+
+    Returns
+    -------
+    internal_state : namedtuple
+        The namedtuple that contains all the state information that
+        `lazy_xsvs` requires so that it can be used to pick up
+        processing after it was interrupted
+    """
     # find the label's and pixel indices for ROI's
     labels, indices = roi.extract_label_indices(label_array)
 
-    # number of ROI's
-    u_labels = list(np.unique(labels))
+    # number of ROI's, and the ROI (0 -> num_roi - 1) of every pixel
+    u_labels, roi_index = np.unique(labels, return_inverse=True)
     num_roi = len(u_labels)
 
-    # create integration times
-    time_bin = geometric_series(timebin_num, number_of_img)
+    # number of integration times
+    num_times = len(geometric_series(timebin_num, number_of_img))
 
-    # number of times in the time bin
-    num_times = len(time_bin)
+    # the histograms of the integration times are kept in dense arrays of
+    # the largest size
+    num_bins = [_num_bins(max_cts, i) for i in range(num_times)]
 
-    # probability density of detecting photons
-    prob_k_all = np.zeros([num_times, num_roi], dtype=np.object)
+    # probability density of detecting photons, and its square
+    prob_k = np.zeros((num_times, num_roi, num_bins[-1]))
+    prob_k_pow = np.zeros_like(prob_k)
 
-    # square of probability density of detecting photons
-    prob_k_pow_all = np.zeros_like(prob_k_all)
+    # Ring buffer, a buffer with periodic boundary conditions.
+    # Images must be keep for up to maximum delay in buf.
+    buf = np.zeros((num_times, timebin_num, len(indices)))
 
-    # standard deviation of probability density of detecting photons
-    prob_k_std_dev = np.zeros_like(prob_k_all)
+    # to track processing each time level
+    track_level = np.zeros(num_times)
 
-    # get the bin edges for each time bin for each ROI
-    bin_edges = np.zeros(prob_k_all.shape[0], dtype=prob_k_all.dtype)
-    for i in range(num_times):
-        bin_edges[i] = np.arange(max_cts*2**i)
+    # to track bad images in each time level
+    track_bad = np.zeros(num_times)
 
-    start_time = time.time()  # used to log the computation time (optionally)
+    # to increment buffer
+    cur = np.full(num_times, timebin_num)
 
-    for i, images in enumerate(image_sets):
-        # Ring buffer, a buffer with periodic boundary conditions.
-        # Images must be keep for up to maximum delay in buf.
-        buf = np.zeros([num_times, timebin_num],
-                       dtype=np.object)  # matrix of buffers
+    # to track how many images processed in each level
+    img_per_level = np.zeros(num_times, dtype=np.int64)
+
+    return _xsvs_internal_state(
+        buf,
+        prob_k,
+        prob_k_pow,
+        track_level,
+        track_bad,
+        cur,
+        img_per_level,
+        roi_index,
+        indices,
+        num_bins,
+        max_cts,
+    )
+
+
+def lazy_xsvs(image_iterable, label_array, number_of_img, timebin_num=None,
+              max_cts=None, internal_state=None, yield_every=1):
+    """Generator implementation of XSVS for one set of images
+
+    The probability densities of detecting photons are updated frame by
+    frame, in memory bounded by the ring buffers of the integration times,
+    so that XSVS can follow the acquisition. The internal state can be
+    passed back in to pick up processing where it was left.
+
+    Bad images need to be represented as an array filled with np.nan.
+
+    Parameters
+    ----------
+    image_iterable : iterable of 2D arrays
+        the images
+    label_array : array
+        labeled array; 0 is background.
+        Each ROI is represented by a distinct label (i.e., integer).
+    number_of_img : int
+        number of images (how far to go with integration times when finding
+        the time_bin, using skbeam.utils.geometric function)
+    timebin_num : int, optional
+        integration time; default is 2, or the one of `internal_state`.
+        A ValueError is raised if it does not match the internal state
+    max_cts : int
+        the upper bound of the pixel counts. As in `xsvs`, the histograms
+        of single frames have the bin edges ``np.arange(max_cts)``, so
+        they hold the counts up to ``max_cts - 1``. Required unless
+        `internal_state` is given, the images are not known in advance.
+        An image with a larger count in a ROI raises a ValueError, before
+        it changes the internal state, instead of being left out of the
+        histograms
+    internal_state : namedtuple, optional
+        internal_state is a bucket for all of the internal state of the
+        generator. It is part of the `xsvs_results` object that is yielded
+        from this generator
+    yield_every : int or None, optional
+        only yield the probability densities after every `yield_every`
+        images and after the last one. If None, only the final result is
+        yielded. Defaults to 1
+
+    Yields
+    ------
+    namedtuple
+        A `xsvs_results` object, containing, in this order:
+
+        - `prob_k`: probability density of detecting photons, object array
+          of shape (num_times, num_roi), as returned by `xsvs`
+        - `prob_k_std_dev`: standard deviation of `prob_k`
+        - `internal_state`: all of the internal state. Can be passed back
+          in to `lazy_xsvs` as the `internal_state` parameter
+    """
+    if internal_state is None:
+        if max_cts is None:
+            raise ValueError("max_cts is required to histogram the images "
+                             "as they arrive")
+        if timebin_num is None:
+            timebin_num = 2
+        internal_state = _init_state_xsvs(label_array, number_of_img,
+                                          timebin_num, max_cts)
+    s = internal_state
+    # the ring buffers hold timebin_num frames
+    if timebin_num is None:
+        timebin_num = s.buf.shape[1]
+    elif timebin_num != s.buf.shape[1]:
+        raise ValueError("timebin_num={} does not match the internal state, "
+                         "which was created with timebin_num={}"
+                         "".format(timebin_num, s.buf.shape[1]))
+    if yield_every is not None and yield_every < 1:
+        raise ValueError("yield_every must be a positive integer or None. "
+                         "You provided %s" % yield_every)
+
+    num_processed = 0
+    for img in image_iterable:
+        # the histograms can not hold larger counts, which would bias the
+        # densities. The frames of the longer integration times are sums of
+        # the images, so they stay within their last bins too.
+        data = np.ravel(img)[s.pixel_list]
+        max_count = _num_bins(s.max_cts, 0)
+        if len(data) and not np.isnan(data).any() and data.max() > max_count:
+            raise ValueError("An image has a pixel count of {} in the ROIs, "
+                             "beyond the last bin edge {} of max_cts={}"
+                             "".format(data.max(), max_count, s.max_cts))
+        _xsvs_process_frame(s, img, timebin_num)
+        num_processed += 1
+        if yield_every is not None and num_processed % yield_every == 0:
+            yield _xsvs_results(s)
+    # always yield the final result
+    if num_processed and (yield_every is None or num_processed % yield_every):
+        yield _xsvs_results(s)
+
+
+def _xsvs_results(state):
+    """The probability densities of the internal state of `lazy_xsvs`"""
+    prob_k_std_dev = (state.prob_k_pow - state.prob_k**2)**.5
+    # copy, the state keeps being updated in place
+    return xsvs_results(_to_object_array(state.prob_k.copy(),
+                                         state.num_bins),
+                        _to_object_array(prob_k_std_dev, state.num_bins),
+                        state)
+
+
+def _xsvs_process_frame(state, img, timebin_num):
+    """
+    Internal helper function. This modifies the state in place.
+
+    Put one image into the ring buffers of all integration times and
+    histogram the new frames.
+
+    Parameters
+    ----------
+    state : namedtuple
+        The internal state of `lazy_xsvs`
+    img : array
+        the image
+    timebin_num : int
+        integration time
+    """
+    s = state
+    num_roi = s.prob_k.shape[1]
+    for level, buf_no in _integration_frames(s.buf, s.cur, s.track_level,
+                                             img, s.pixel_list, timebin_num):
+        _process(num_roi, level, buf_no, s.buf, s.img_per_level,
+                 s.roi_index, s.max_cts, s.prob_k, s.prob_k_pow, s.track_bad)
+
+
+def _integration_frames(buf, cur, track_level, img, pixel_list,
+                        timebin_num):
+    """
+    Internal helper function. This modifies the ring buffers in place.
+
+    Put one image into the ring buffer of the first integration time and
+    sum the frames of the longer integration times.
+
+    Parameters
+    ----------
+    buf : array
+        ring buffers, shape (num_times, timebin_num, num_pixels)
+    cur : array
+        current buffer number of each integration time
+    track_level : array
+        to track processing each time level
+    img : array
+        the image
+    pixel_list : array
+        the ROI pixels of the flattened image
+    timebin_num : int
+        integration time
 
-        # to track processing each time level
+    Yields
+    ------
+    level : int
+        the integration time of a new frame
+    buf_no : int
+        buffer number of the new frame in ``buf[level]``
+    """
+    num_times = len(buf)
+
+    cur[0] = (1 + cur[0]) % timebin_num
+    # read each frame
+    # Put the image into the ring buffer.
+    buf[0, cur[0] - 1] = (np.ravel(img))[pixel_list]
+    yield 0, cur[0] - 1
+
+    # check whether the number of levels is one, otherwise
+    # continue processing the next level
+    level = 1
+
+    while level < num_times:
+        if not track_level[level]:
+            track_level[level] = 1
+        else:
+            prev = 1 + (cur[level - 1] - 2) % timebin_num
+            cur[level] = 1 + cur[level] % timebin_num
+
+            buf[level, cur[level]-1] = (buf[level-1, prev-1] +
+                                        buf[level-1, cur[level - 1] - 1])
+            track_level[level] = 0
+
+            yield level, cur[level] - 1
+            level += 1
+
+
+def _xsvs_single_pass(image_sets, label_array, number_of_img, timebin_num):
+    """
+    XSVS without knowing the maximum pixel count in advance
+
+    The frames are histogrammed into unit count bins [k, k + 1), which
+    grow as larger counts show up. The count histograms of frames with
+    counts that may lie beyond the last bin of the final maximum count are
+    kept until the end. The densities and their running average over the
+    image sets are linear in the histograms of the frames, so they are
+    accumulated as sums and normalized to the bins of `xsvs` at the end.
+
+    Parameters
+    ----------
+    image_sets : array
+        sets of images
+    label_array : array
+        labeled array; 0 is background.
+    number_of_img : int
+        number of images
+    timebin_num : int
+        integration time
+
+    Returns
+    -------
+    prob_k_all : array
+        probability density of detecting photons,
+        shape (num_times, num_roi, max_bins)
+    prob_k_pow_all : array
+        the average squares of the probability densities
+    num_bins : list
+        number of bins of each integration time
+    """
+    # find the label's and pixel indices for ROI's
+    labels, indices = roi.extract_label_indices(label_array)
+    u_labels, roi_index = np.unique(labels, return_inverse=True)
+    num_roi = len(u_labels)
+    num_times = len(geometric_series(timebin_num, number_of_img))
+
+    # the maximum pixel count so far, as roi.roi_max_counts
+    max_cts = 0
+    # the densities of a set summed over its frames, and their running
+    # average over the frames and sets. Along the second axis are the
+    # densities, their squares and the products of neighbouring bins, to
+    # merge the last two bins at the end
+    set_sums = np.zeros((num_times, 3, num_roi, 16))
+    averages = np.zeros_like(set_sums)
+    # frames that may hold counts beyond the last bin:
+    # [level, set number, count histogram (see _unit_bin_counts), largest
+    # count, weight in averages]
+    pending = []
+
+    for i, images in enumerate(image_sets):
+        buf = np.zeros((num_times, timebin_num, len(indices)))
         track_level = np.zeros(num_times)
+        cur = np.full(num_times, timebin_num)
+        num_good = np.zeros(num_times, dtype=np.int64)
+        set_sums[:] = 0
+
+        for img in images:
+            for level, buf_no in _integration_frames(buf, cur, track_level,
+                                                     img, indices,
+                                                     timebin_num):
+                data = buf[level, buf_no]
+                if np.isnan(data).any():
+                    # bad image
+                    continue
+                num_good[level] += 1
+                data_max = max(0, data.max()) if len(data) else 0
+
+                if level == 0 and data_max > max_cts:
+                    max_cts = data_max
+                    num_bins = _num_bins(max_cts, num_times - 1)
+                    if num_bins + 2 > set_sums.shape[-1]:
+                        # double the capacity of the histograms
+                        capacity = max(num_bins + 2, 2 * set_sums.shape[-1])
+                        set_sums = _grow_last_axis(set_sums, capacity)
+                        averages = _grow_last_axis(averages, capacity)
+                    # these frames can not hold counts beyond the last bin
+                    # any more
+                    still_pending = []
+                    for p in pending:
+                        if p[3] <= _num_bins(max_cts, p[0]):
+                            _add_pending(p, i, max_cts, set_sums,
+                                         averages)
+                        else:
+                            still_pending.append(p)
+                    pending = still_pending
+
+                counts = _unit_bin_counts(data, roi_index, num_roi)
+                if data_max <= _num_bins(max_cts, level):
+                    set_sums[level] += _unit_bin_densities(
+                        counts, _num_bins(max_cts, level),
+                        set_sums.shape[-1])
+                else:
+                    pending.append([level, i, counts, data_max, 0.])
+
+            # prob_k_all += (prob_k - prob_k_all)/(i + 1), with prob_k the
+            # running average of the densities of the set
+            weight = i / (i + 1)
+            with np.errstate(divide='ignore'):
+                norm = np.where(num_good > 0, 1 / (i + 1) / num_good, 0)
+            averages *= weight
+            averages += norm[:, None, None, None] * set_sums
+            for p in pending:
+                p[4] = weight * p[4] + (norm[p[0]] if p[1] == i else 0)
+
+    for p in pending:
+        _add_pending(p, None, max_cts, set_sums, averages)
+
+    return _unit_bin_probabilities(averages, max_cts)
+
+
+def _xsvs_set_sums(images, label_array, number_of_img, timebin_num):
+    """
+    Histogram an image set into unit count bins [k, k + 1)
+
+    The densities of the frames of every integration time are summed up.
+    Frames with counts beyond the last bin of the largest count so far are
+    kept as count histograms, until a larger count shows up or the final
+    maximum count is known. The results of the sets are merged with
+    `_merge_xsvs_set_sums`.
+
+    Parameters
+    ----------
+    images : iterable
+        the images of the set
+    label_array : array
+        labeled array; 0 is background.
+    number_of_img : int
+        number of images
+    timebin_num : int
+        integration time
+
+    Returns
+    -------
+    num_good : array
+        number of good frames of each integration time
+    set_sums : array
+        the densities of the frames summed up, with their squares and the
+        products of neighbouring bins along the second axis, see
+        `_unit_bin_densities`. shape (num_times, 3, num_roi, capacity)
+    pending : list
+        [level, count histogram (see `_unit_bin_counts`), largest count]
+        of the frames that were not added to `set_sums`
+    max_cts : float
+        the largest count of the set, as roi.roi_max_counts
+    """
+    # find the label's and pixel indices for ROI's
+    labels, indices = roi.extract_label_indices(label_array)
+    u_labels, roi_index = np.unique(labels, return_inverse=True)
+    num_roi = len(u_labels)
+    num_times = len(geometric_series(timebin_num, number_of_img))
+
+    buf = np.zeros((num_times, timebin_num, len(indices)))
+    track_level = np.zeros(num_times)
+    cur = np.full(num_times, timebin_num)
+    num_good = np.zeros(num_times, dtype=np.int64)
+    # the maximum pixel count so far
+    max_cts = 0
+    set_sums = np.zeros((num_times, 3, num_roi, 16))
+    pending = []
+
+    for img in images:
+        for level, buf_no in _integration_frames(buf, cur, track_level, img,
+                                                 indices, timebin_num):
+            data = buf[level, buf_no]
+            if np.isnan(data).any():
+                # bad image
+                continue
+            num_good[level] += 1
+            data_max = max(0, data.max()) if len(data) else 0
+
+            if level == 0 and data_max > max_cts:
+                max_cts = data_max
+                num_bins = _num_bins(max_cts, num_times - 1)
+                if num_bins + 2 > set_sums.shape[-1]:
+                    # double the capacity of the histograms
+                    set_sums = _grow_last_axis(
+                        set_sums, max(num_bins + 2, 2 * set_sums.shape[-1]))
+                # these frames can not hold counts beyond the last bin any
+                # more
+                still_pending = []
+                for p_level, counts, p_max in pending:
+                    if p_max <= _num_bins(max_cts, p_level):
+                        set_sums[p_level] += _unit_bin_densities(
+                            counts, _num_bins(max_cts, p_level),
+                            set_sums.shape[-1])
+                    else:
+                        still_pending.append([p_level, counts, p_max])
+                pending = still_pending
+
+            counts = _unit_bin_counts(data, roi_index, num_roi)
+            if data_max <= _num_bins(max_cts, level):
+                set_sums[level] += _unit_bin_densities(
+                    counts, _num_bins(max_cts, level), set_sums.shape[-1])
+            else:
+                pending.append([level, counts, data_max])
+    return num_good, set_sums, pending, max_cts
+
+
+def _unit_bin_probabilities(densities, max_cts):
+    """
+    Merge (averaged) densities of `_unit_bin_densities` into the bins of
+    `xsvs` for the maximum count `max_cts`
+
+    Returns
+    -------
+    prob_k_all : array
+        probability density of detecting photons,
+        shape (num_times, num_roi, max_bins)
+    prob_k_pow_all : array
+        the average squares of the probability densities
+    num_bins : list
+        number of bins of each integration time
+    """
+    num_times, _, num_roi, _ = densities.shape
+    # merge the counts up to num_bins into the last bin, as np.histogram
+    num_bins = [_num_bins(max_cts, i) for i in range(num_times)]
+    prob_k_all = np.zeros((num_times, num_roi, num_bins[-1]))
+    prob_k_pow_all = np.zeros_like(prob_k_all)
+    for level, n in enumerate(num_bins):
+        if n < 1:
+            continue
+        dens, dens_pow, dens_next = densities[level, :, :, :n + 1]
+        prob_k_all[level, :, :n] = dens[:, :n]
+        prob_k_all[level, :, n - 1] += dens[:, n]
+        prob_k_pow_all[level, :, :n] = dens_pow[:, :n]
+        prob_k_pow_all[level, :, n - 1] += (dens_pow[:, n] +
+                                            2 * dens_next[:, n - 1])
+    return prob_k_all, prob_k_pow_all, num_bins
+
 
-        # to track bad images in each time level
-        track_bad = np.zeros(num_times)
-        #  bad images, represented as an array filled with np.nan
-        # (using bad_to_nan function in mask.py all the bad
-        # images are converted into np.nan arrays)
+def _add_pending(pending, set_no, max_cts, set_sums, averages):
+    """
+    Internal helper function. This modifies `set_sums` and `averages` in
+    place.
+
+    Add the densities of a frame of `_xsvs_single_pass` that was kept
+    until the maximum count was known.
+    """
+    level, frame_set_no, counts, _, weight = pending
+    densities = _unit_bin_densities(counts, _num_bins(max_cts, level),
+                                    set_sums.shape[-1])
+    if frame_set_no == set_no:
+        set_sums[level] += densities
+    averages[level] += weight * densities
+
+
+def _unit_bin_counts(data, labels, num_roi):
+    """
+    The histograms of the counts of each ROI in the unit bins [k, k + 1).
+    Each unit bin is split into the counts equal to k and the ones in
+    (k, k + 1), so that the counts up to any integer can be selected later
+
+    Returns
+    -------
+    counts : array
+        shape (num_roi, 2 * (largest count + 1)), the counts equal to k in
+        column 2 * k and the ones in (k, k + 1) in column 2 * k + 1
+    """
+    keep = data >= 0
+    data = data[keep]
+    bins = np.floor(data).astype(np.int64)
+    index = 2 * bins + (data > bins)
+    width = 2 * (bins.max() + 1) if len(bins) else 2
+    return np.bincount(labels[keep] * width + index,
+                       minlength=num_roi * width).reshape(num_roi, width)
+
+
+def _unit_bin_densities(counts, num_bins, capacity):
+    """
+    The densities of the counts in the unit bins [k, k + 1) of each ROI,
+    for the counts from 0 to `num_bins`, with their squares and the
+    products of neighbouring bins
+
+    Parameters
+    ----------
+    counts : array
+        the count histograms of `_unit_bin_counts`
+    num_bins : int
+        the largest count to keep
+    capacity : int
+        number of unit bins of the densities
+
+    Returns
+    -------
+    densities : array
+        shape (3, num_roi, capacity)
+    """
+    num_roi = len(counts)
+    # the counts up to num_bins, merged into the unit bins
+    kept = np.zeros((num_roi, 2 * capacity), dtype=counts.dtype)
+    num_kept = min(2 * num_bins + 1, counts.shape[1])
+    kept[:, :num_kept] = counts[:, :num_kept]
+    kept = kept.reshape(num_roi, capacity, 2).sum(axis=-1)
+    densities = np.zeros((3, num_roi, capacity))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        densities[0] = kept / kept.sum(axis=1)[:, np.newaxis]
+    densities[0] = np.nan_to_num(densities[0])
+    densities[1] = densities[0]**2
+    densities[2, :, :-1] = densities[0, :, :-1] * densities[0, :, 1:]
+    return densities
+
+
+def _grow_last_axis(arr, size):
+    """Pad the last axis of `arr` with zeros up to `size`"""
+    grown = np.zeros(arr.shape[:-1] + (size, ))
+    grown[..., :arr.shape[-1]] = arr
+    return grown
+
+
+def xsvs_contrast(image_sets, label_array, number_of_img, timebin_num=2,
+                  third_moment=False):
+    """
+    Speckle contrast for different integration times, from the moments of
+    the photon counts
+
+    Only the moments of the counts in each ROI are accumulated instead of
+    the full probability densities of `xsvs`, at a cost independent of
+    the count rate. The frames of the integration times are summed as in
+    `xsvs`.
+
+    Bad images need to be represented as an array filled with np.nan.
+
+    Parameters
+    ----------
+    image_sets : array
+        sets of images
+    label_array : array
+        labeled array; 0 is background.
+        Each ROI is represented by a distinct label (i.e., integer).
+    number_of_img : int
+        number of images (how far to go with integration times when finding
+        the time_bin, using skbeam.utils.geometric function)
+    timebin_num : int, optional
+        integration time; default is 2
+    third_moment : bool, optional
+        also compute the third moment of the counts. Defaults to False
+
+    Returns
+    -------
+    contrast : array
+        speckle contrast (beta), shape (num_times, num_roi)
+    moments : array
+        the mean counts <K>, <K^2> (and <K^3>) of each integration time and
+        ROI, shape (num_times, num_roi, 2 or 3)
 
-        # to increment buffer
+    Notes
+    -----
+    The moments are those of the probability density P(K) averaged over
+    all good frames, as `xsvs` would give without binning. The contrast
+    follows from the variance of the counts of a negative binomial
+    distribution [1]_
+
+    .. math::
+
+        \\beta = \\frac{<K^2> - <K>^2 - <K>}{<K>^2}
+
+    .. [1] L. Li, P. Kwasniewski, D. Oris, L Wiegart, L. Cristofolini,
+       C. Carona and A. Fluerasu , "Photon statistics and speckle visibility
+       spectroscopy with partially coherent x-rays" J. Synchrotron Rad.,
+       vol 21, p 1288-1295, 2014.
+    """
+    # find the label's and pixel indices for ROI's
+    labels, indices = roi.extract_label_indices(label_array)
+
+    # number of ROI's, and the ROI (0 -> num_roi - 1) of every pixel
+    u_labels, roi_index = np.unique(labels, return_inverse=True)
+    num_roi = len(u_labels)
+
+    # number of integration times
+    num_times = len(geometric_series(timebin_num, number_of_img))
+    num_moments = 3 if third_moment else 2
+
+    # the moments of each frame summed over the good frames
+    moment_sums = np.zeros((num_times, num_roi, num_moments))
+    num_good = np.zeros(num_times, dtype=np.int64)
+
+    start_time = time.time()  # used to log the computation time (optionally)
+
+    for images in image_sets:
+        buf = np.zeros((num_times, timebin_num, len(indices)))
+        track_level = np.zeros(num_times)
         cur = np.full(num_times, timebin_num)
 
-        # to track how many images processed in each level
-        img_per_level = np.zeros(num_times, dtype=np.int64)
+        for img in images:
+            for level, buf_no in _integration_frames(buf, cur, track_level,
+                                                     img, indices,
+                                                     timebin_num):
+                data = buf[level, buf_no]
+                if np.isnan(data).any():
+                    # bad image
+                    continue
+                num_good[level] += 1
+                moment_sums[level] += _roi_moments(data, roi_index, num_roi,
+                                                   num_moments)
 
-        prob_k = np.zeros_like(prob_k_all)
-        prob_k_pow = np.zeros_like(prob_k_all)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        moments = moment_sums / num_good[:, np.newaxis, np.newaxis]
+        mean = moments[..., 0]
+        contrast = (moments[..., 1] - mean**2 - mean) / mean**2
 
-        for n, img in enumerate(images):
-            cur[0] = (1 + cur[0]) % timebin_num
-            # read each frame
-            # Put the image into the ring buffer.
-            buf[0, cur[0] - 1] = (np.ravel(img))[indices]
+    logger.info("Processing time for XSVS took %s seconds."
+                "", (time.time() - start_time))
+    return contrast, moments
 
-            _process(num_roi, 0, cur[0] - 1, buf, img_per_level, labels,
-                     max_cts, bin_edges[0], prob_k, prob_k_pow, track_bad)
 
-            # check whether the number of levels is one, otherwise
-            # continue processing the next level
-            level = 1
+def _roi_moments(data, labels, num_roi, num_moments):
+    """
+    The mean of the powers 1 -> `num_moments` of the counts of each ROI,
+    0 for ROI's without counts
+
+    Returns
+    -------
+    moments : array
+        shape (num_roi, num_moments)
+    """
+    keep = data >= 0
+    data = data[keep]
+    labels = labels[keep]
+    num_pixels = np.bincount(labels, minlength=num_roi)
+    moments = np.zeros((num_roi, num_moments))
+    power = np.ones_like(data)
+    for n in range(num_moments):
+        power *= data
+        moments[:, n] = np.bincount(labels, weights=power, minlength=num_roi)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        moments /= num_pixels[:, np.newaxis]
+    return np.nan_to_num(moments)
 
-            while level < num_times:
-                if not track_level[level]:
-                    track_level[level] = 1
-                else:
-                    prev = 1 + (cur[level - 1] - 2) % timebin_num
-                    cur[level] = 1 + cur[level] % timebin_num
 
-                    buf[level, cur[level]-1] = (buf[level-1,
-                                                    prev-1] +
-                                                buf[level-1,
-                                                    cur[level - 1] - 1])
-                    track_level[level] = 0
+_xsvs_accumulator = namedtuple(
+    'xsvs_accumulator',
+    ['counts',
+     'prob_k_sum',
+     'prob_k_pow_sum',
+     'num_bins']
+)
 
-                    _process(num_roi, level, cur[level]-1, buf, img_per_level,
-                             labels, max_cts, bin_edges[level], prob_k,
-                             prob_k_pow, track_bad)
-                    level += 1
 
-            prob_k_all += (prob_k - prob_k_all)/(i + 1)
-            prob_k_pow_all += (prob_k_pow - prob_k_pow_all)/(i + 1)
+def parallel_xsvs(image_sets, label_array, number_of_img, timebin_num=2,
+                  max_cts=None, num_workers=None, executor='process'):
+    """
+    XSVS with the image sets histogrammed concurrently
 
-    prob_k_std_dev = np.power((prob_k_pow_all -
-                               np.power(prob_k_all, 2)), .5)
+    Every image set is histogrammed on its own by a worker, into the
+    number of good frames and the sums of the probability densities and
+    of their squares of each integration time. These accumulators of the
+    sets are then summed up. Without `max_cts`, the workers histogram the
+    sets into unit count bins that grow with the largest count, and the
+    maximum count is reduced along with the histograms, so the sets are
+    still only read and sent to the workers once.
+
+    Parameters
+    ----------
+    image_sets : iterable
+        sets of images. Bad images need to be represented as an array
+        filled with np.nan. With executor='process' every set is pickled
+        and sent to a worker process, so it has to be picklable, e.g. an
+        array or a list of arrays; generators of images are not
+    label_array : array
+        labeled array; 0 is background.
+        Each ROI is represented by a distinct label (i.e., integer).
+    number_of_img : int
+        number of images (how far to go with integration times when finding
+        the time_bin, using skbeam.utils.geometric function)
+    timebin_num : int, optional
+        integration time; default is 2
+    max_cts : int, optional
+       the brightest pixel in any ROI in any image in the image set.
+       defaults to the brightest pixel of the sets, as
+       skbeam.core.roi.roi_max_counts, found by the workers in the same
+       pass
+    num_workers : int, optional
+        number of workers. Defaults to the number of CPUs
+    executor : {'process', 'thread'}, optional
+        run the workers in processes or threads. Defaults to 'process'
+
+    Returns
+    -------
+    prob_k_all : array
+        probability density of detecting photons
+    prob_k_std_dev : array
+        standard deviation of probability density of detecting photons
+
+    Notes
+    -----
+    All good frames have the same weight, whichever set they belong to.
+    With a single image set the results are those of `xsvs`, up to
+    rounding. `xsvs` updates the average over the sets after every image,
+    which weights the sets (and their frames) differently.
+    """
+    from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+    if executor == 'process':
+        executor_class = ProcessPoolExecutor
+    elif executor == 'thread':
+        executor_class = ThreadPoolExecutor
+    else:
+        raise ValueError("executor must be 'process' or 'thread'. You "
+                         "provided %s" % executor)
+    if num_workers is None:
+        num_workers = multiprocessing.cpu_count()
+
+    start_time = time.time()  # used to log the computation time (optionally)
+
+    if max_cts is None:
+        worker = _xsvs_set_sums
+        args = (label_array, number_of_img, timebin_num)
+        merge = _merge_xsvs_set_sums
+    else:
+        worker = _accumulate_xsvs
+        args = (label_array, number_of_img, timebin_num, max_cts)
+        merge = _merge_xsvs_accumulators
+
+    with executor_class(max_workers=num_workers) as pool:
+        total = None
+        pending = deque()
+        for images in image_sets:
+            pending.append(pool.submit(worker, images, *args))
+            # do not let the image sets queue up faster than they are
+            # processed
+            while len(pending) > 2 * num_workers:
+                total = merge(total, pending.popleft().result())
+        for future in pending:
+            total = merge(total, future.result())
+
+    if total is None:
+        raise ValueError("There are no image sets")
+    if max_cts is None:
+        total = _xsvs_set_sums_accumulator(*total)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        counts = total.counts[:, np.newaxis, np.newaxis]
+        prob_k_all = np.nan_to_num(total.prob_k_sum / counts)
+        prob_k_pow_all = np.nan_to_num(total.prob_k_pow_sum / counts)
+    prob_k_std_dev = (prob_k_pow_all - prob_k_all**2)**.5
 
     logger.info("Processing time for XSVS took %s seconds."
                 "", (time.time() - start_time))
-    return prob_k_all, prob_k_std_dev
+    return (_to_object_array(prob_k_all, total.num_bins),
+            _to_object_array(prob_k_std_dev, total.num_bins))
+
+
+def _accumulate_xsvs(images, label_array, number_of_img, timebin_num,
+                     max_cts):
+    """
+    Histogram one image set into the fields of a `_xsvs_accumulator`
+
+    Returns
+    -------
+    accumulator : tuple
+        the number of good frames of each integration time, the sums of
+        the probability densities and of their squares over the frames and
+        the number of bins. A plain tuple, to be sent back from a process
+    """
+    state = _init_state_xsvs(label_array, number_of_img, timebin_num,
+                             max_cts)
+    for img in images:
+        _xsvs_process_frame(state, img, timebin_num)
+    counts = state.img_per_level - state.track_bad
+    return (counts, state.prob_k * counts[:, None, None],
+            state.prob_k_pow * counts[:, None, None], state.num_bins)
+
+
+def _merge_xsvs_accumulators(first, second):
+    """
+    Sum up a `_xsvs_accumulator` and the fields of another one, as
+    returned by `_accumulate_xsvs`. `first` may be None
+    """
+    second = _xsvs_accumulator(*second)
+    if first is None:
+        return second
+    if list(first.num_bins) != list(second.num_bins):
+        raise ValueError("The accumulators have different bins, they "
+                         "were made with different max_cts")
+    return _xsvs_accumulator(first.counts + second.counts,
+                             first.prob_k_sum + second.prob_k_sum,
+                             first.prob_k_pow_sum + second.prob_k_pow_sum,
+                             first.num_bins)
+
+
+def _merge_xsvs_set_sums(first, second):
+    """
+    Sum up the results of `_xsvs_set_sums` of two image sets, `first` may
+    be None
+
+    The pending frames of both that fit into the bins of the larger
+    maximum count are added to the sums.
+    """
+    if first is None:
+        return second
+    num_good, sums, pending, max_cts = first
+    capacity = max(sums.shape[-1], second[1].shape[-1])
+    sums = (_grow_last_axis(sums, capacity) +
+            _grow_last_axis(second[1], capacity))
+    max_cts = max(max_cts, second[3])
+    still_pending = []
+    for level, counts, data_max in pending + second[2]:
+        if data_max <= _num_bins(max_cts, level):
+            sums[level] += _unit_bin_densities(
+                counts, _num_bins(max_cts, level), capacity)
+        else:
+            still_pending.append([level, counts, data_max])
+    return num_good + second[0], sums, still_pending, max_cts
+
+
+def _xsvs_set_sums_accumulator(num_good, sums, pending, max_cts):
+    """
+    The `_xsvs_accumulator` of the merged results of `_xsvs_set_sums` of
+    all image sets, with `max_cts` the final maximum count
+    """
+    for level, counts, _ in pending:
+        sums[level] += _unit_bin_densities(
+            counts, _num_bins(max_cts, level), sums.shape[-1])
+    # the merged bins are linear in the densities, so the sums can be
+    # merged as well as their averages
+    prob_k_sum, prob_k_pow_sum, num_bins = _unit_bin_probabilities(sums,
+                                                                   max_cts)
+    return _xsvs_accumulator(num_good, prob_k_sum, prob_k_pow_sum, num_bins)
+
+
+def _to_object_array(hists, num_bins):
+    """
+    Split dense histograms into an object array of histograms of the
+    lengths of each integration time
+
+    Parameters
+    ----------
+    hists : array
+        shape (num_times, num_roi, max_bins)
+    num_bins : array
+        number of bins of each integration time
+
+    Returns
+    -------
+    hists : array
+        object array of shape (num_times, num_roi)
+    """
+    obj = np.zeros(hists.shape[:2], dtype=object)
+    for i, n in enumerate(num_bins):
+        for j in range(hists.shape[1]):
+            obj[i, j] = hists[i, j, :n]
+    return obj
+
+
+def _num_bins(max_cts, level):
+    """
+    The number of histogram bins of a time level, for the bin edges
+    ``np.arange(max_cts*2**level)``
+    """
+    return int(np.ceil(max_cts * 2**level)) - 1
 
 
 def _process(num_roi, level, buf_no, buf, img_per_level, labels,
-             max_cts, bin_edges, prob_k, prob_k_pow, track_bad):
+             max_cts, prob_k, prob_k_pow, track_bad):
     """
     Internal helper function. This modifies inputs in place.
 
     This helper function calculate probability of detecting photons for
-    each integration time.
+    each integration time. The histograms of all ROI's are computed at
+    once, with one ``np.bincount``.
 
     .. warning :: This function mutates the input values.
 
@@ -234,39 +1110,46 @@ def _process(num_roi, level, buf_no, buf, img_per_level, labels,
     img_per_level : int
         to track how many images processed in each level
     labels : array
-        labels of the required region of interests(ROI's)
+        ROI (0 -> num_roi - 1) of each pixel
     max_cts: int
         maximum pixel count
-    bin_edges : array
-        bin edges for each integration times and each ROI
     prob_k : array
-        probability density of detecting photons
+        probability density of detecting photons,
+        shape (num_times, num_roi, max_bins)
     prob_k_pow : array
         squares of probability density of detecting photons
     track_bad : array
         to track bad images in each level
     """
     img_per_level[level] += 1
-    u_labels = list(np.unique(labels))
 
     #  Check if there are any bad images, represented as an array filled
     #  with np.nan (using bad_to_nan function in mask.py all the bad
     # images are converted into np.nan arrays)
-    if np.isnan(buf[level, buf_no]).any():
+    data = buf[level, buf_no]
+    if np.isnan(data).any():
         track_bad[level] += 1
         return
 
-    for j, label in enumerate(u_labels):
-        roi_data = buf[level, buf_no][labels == label]
-        spe_hist, bin_edges = np.histogram(roi_data, bins=bin_edges,
-                                           density=True)
-        spe_hist = np.nan_to_num(spe_hist)
-        prob_k[level, j] += ((spe_hist - prob_k[level, j]) /
-                             (img_per_level[level] - track_bad[level]))
-        prob_k_pow[level, j] += ((np.power(spe_hist, 2) -
-                                  prob_k_pow[level, j]) /
-                                 (img_per_level[level] -
-                                  track_bad[level]))
+    # the bins are [k, k + 1) for the counts k = 0 -> num_bins - 1, the
+    # last one includes num_bins, as in np.histogram
+    num_bins = _num_bins(max_cts, level)
+    keep = (data >= 0) & (data <= num_bins)
+    bins = np.minimum(np.floor(data[keep]).astype(np.int64), num_bins - 1)
+    counts = np.bincount(labels[keep] * num_bins + bins,
+                         minlength=num_roi * num_bins).reshape(num_roi,
+                                                               num_bins)
+    # the density of unit bins, np.nan (0) for empty ROI's
+    with np.errstate(divide='ignore', invalid='ignore'):
+        spe_hist = counts / counts.sum(axis=1)[:, np.newaxis]
+    spe_hist = np.nan_to_num(spe_hist)
+
+    normalize = img_per_level[level] - track_bad[level]
+    prob_k[level, :, :num_bins] += ((spe_hist - prob_k[level, :, :num_bins]) /
+                                    normalize)
+    prob_k_pow[level, :, :num_bins] += ((np.power(spe_hist, 2) -
+                                         prob_k_pow[level, :, :num_bins]) /
+                                        normalize)
 
 
 def normalize_bin_edges(num_times, num_rois, mean_roi, max_cts):
@@ -33,22 +33,35 @@
 # POSSIBILITY OF SUCH DAMAGE.                                          #
 ########################################################################
 from __future__ import absolute_import, division, print_function
+import copy
 import logging
+import pickle
 
 import numpy as np
-from numpy.testing import assert_array_almost_equal
+from numpy.testing import assert_array_almost_equal, assert_array_equal
 from nose.tools import assert_raises, assert_equal
 
 import skbeam.core.utils as utils
+from skbeam.core import correlation
 from skbeam.core.correlation import (multi_tau_auto_corr,
                                      auto_corr_scat_factor,
-                                     lazy_one_time,
+                                     fit_auto_corr_scat_factor,
+                                     lazy_one_time, lazy_one_time_events,
+                                     lazy_one_time_lags,
+                                     linear_auto_corr,
                                      lazy_two_time, two_time_corr,
+                                     blocked_two_time_corr,
+                                     lazy_two_time_window,
+                                     parallel_one_time_corr,
+                                     roi_g2_from_pixels,
+                                     lazy_one_time_preview,
                                      two_time_state_to_results,
                                      one_time_from_two_time,
-                                     CrossCorrelator)
+                                     age_resolved_one_time,
+                                     CrossCorrelator, lazy_cross_corr)
 from skbeam.core.mask import bad_to_nan_gen
 from skbeam.core.roi import ring_edges, segmented_rings
+from skbeam.testing.decorators import skip_if
 
 
 logger = logging.getLogger(__name__)
@@ -158,6 +171,309 @@ def test_lazy_one_time():
                   second_half_result.g2)
 
 
+def test_lazy_one_time_blocks():
+    setup()
+    images = np.asarray(list(bad_to_nan_gen(img_stack, [3, 21, 35, 48])))
+    for backend in ['numpy', 'cython', None]:
+        if backend == 'cython' and correlation._correlation is None:
+            continue
+        for frame_result in lazy_one_time(images, num_levels, num_bufs, rois,
+                                          backend=backend):
+            pass
+        # blocks of uneven size, including single frames, passed
+        # along with individual images
+        blocks = [images[:1], images[1:3], images[3], images[4:40],
+                  images[40:41], images[41:]]
+        block_results = list(lazy_one_time(blocks, num_levels, num_bufs,
+                                           rois, backend=backend))
+        # one result per block
+        assert_equal(len(block_results), len(blocks))
+        assert np.all(frame_result.g2 == block_results[-1].g2)
+        assert np.all(frame_result.lag_steps == block_results[-1].lag_steps)
+
+
+def test_lazy_one_time_yield_every():
+    setup()
+    every_frame = list(lazy_one_time(img_stack, num_levels, num_bufs, rois))
+    assert_equal(len(every_frame), stack_size)
+
+    throttled = list(lazy_one_time(img_stack, num_levels, num_bufs, rois,
+                                   yield_every=30))
+    # after frames 30, 60, 90 and the final one
+    assert_equal(len(throttled), 4)
+    for n, result in zip([30, 60, 90], throttled):
+        assert np.all(result.g2 == every_frame[n - 1].g2)
+        assert np.all(result.lag_steps == every_frame[n - 1].lag_steps)
+
+    final = list(lazy_one_time(img_stack, num_levels, num_bufs, rois,
+                               yield_every=None))
+    assert_equal(len(final), 1)
+    for result in [throttled[-1], final[-1]]:
+        assert np.all(result.g2 == every_frame[-1].g2)
+        assert np.all(result.lag_steps == every_frame[-1].lag_steps)
+
+    assert_raises(ValueError, list, lazy_one_time(img_stack, num_levels,
+                                                  num_bufs, rois,
+                                                  yield_every=0))
+
+
+def test_lazy_one_time_lags():
+    setup()
+    images = list(bad_to_nan_gen(img_stack, [3, 21, 22, 60]))
+    full = list(lazy_one_time(images, 1, stack_size, rois,
+                              yield_every=None))[-1]
+
+    lag_steps = [50, 1, 7, 0, 99]
+    result = list(lazy_one_time_lags(images, lag_steps, rois,
+                                     yield_every=None))[-1]
+    assert np.all(result.lag_steps == [0, 1, 7, 50, 99])
+    assert np.all(result.g2 == full.g2[result.lag_steps])
+
+    # pick up the correlation where it was interrupted, lags that have not
+    # been seen yet are nan
+    first = list(lazy_one_time_lags(images[:40], lag_steps, rois))
+    assert_equal(len(first), 40)
+    assert np.all(np.isnan(first[-1].g2[3:]))
+    second = list(lazy_one_time_lags(images[40:], lag_steps, rois,
+                                     internal_state=first[-1].internal_state))
+    assert np.all(second[-1].g2 == result.g2)
+
+    assert_raises(ValueError, list, lazy_one_time_lags(images, [-1, 2], rois))
+    assert_raises(ValueError, list, lazy_one_time_lags(images, [1], rois,
+                                                       yield_every=0))
+
+
+def test_lazy_one_time_per_pixel(tmpdir):
+    setup()
+    images = list(bad_to_nan_gen(img_stack, [3, 21]))
+    g2, lag_steps = multi_tau_auto_corr(num_levels, num_bufs, rois, images)
+
+    for memmap_dir in [None, str(tmpdir)]:
+        all_results = list(lazy_one_time(images, num_levels, num_bufs, rois,
+                                         per_pixel=True,
+                                         memmap_dir=memmap_dir))
+        # memory-mapped sums are only normalized at the end by default
+        assert_equal(len(all_results),
+                     len(images) if memmap_dir is None else 1)
+        result = all_results[-1]
+        assert_equal(result.g2.shape,
+                     (len(lag_steps), len(result.internal_state.pixel_list)))
+        assert_equal(result.g2.dtype, np.float32)
+
+        roi_g2, roi_err, roi_lags = roi_g2_from_pixels(result.internal_state,
+                                                       rois, block_size=1000)
+        assert_array_almost_equal(roi_g2, g2, decimal=5)
+        assert np.all(roi_lags == lag_steps)
+        # uncorrelated random images
+        assert np.all(np.isfinite(roi_err))
+        assert np.all(roi_err[1:-1] > 0)
+        assert np.all(roi_err < 0.05)
+    assert tmpdir.join('G.npy').check()
+
+    assert_raises(ValueError, roi_g2_from_pixels, result.internal_state,
+                  np.ones_like(rois))
+
+    # the mode is kept in the state, also through save_state/load_state
+    for first in lazy_one_time(images[:50], num_levels, num_bufs, rois,
+                               yield_every=None, per_pixel=True):
+        pass
+    path = str(tmpdir.join('per_pixel.npz'))
+    utils.save_state(first.internal_state, path)
+    for resumed in lazy_one_time(images[50:], num_levels, num_bufs, rois,
+                                 internal_state=utils.load_state(path)):
+        pass
+    assert_array_equal(resumed.g2, result.g2)
+    assert_raises(ValueError, list, lazy_one_time(
+        images[50:], num_levels, num_bufs, rois, per_pixel=False,
+        internal_state=first.internal_state))
+
+    roi_state = list(lazy_one_time(images[:50], num_levels, num_bufs,
+                                   rois))[-1].internal_state
+    assert_raises(ValueError, list, lazy_one_time(
+        images[50:], num_levels, num_bufs, rois, per_pixel=True,
+        internal_state=roi_state))
+    assert_raises(ValueError, roi_g2_from_pixels, roi_state, rois)
+
+
+def test_lazy_one_time_preview():
+    setup()
+    g2, lag_steps = multi_tau_auto_corr(num_levels, num_bufs, rois, img_stack)
+    roi_sizes = np.bincount(rois.ravel())[np.unique(rois)[1:]]
+
+    previews = list(lazy_one_time_preview(img_stack, num_levels, num_bufs,
+                                          rois, fractions=[0.05, 0.5, 1],
+                                          seed=2))
+    assert_equal(len(previews), 3)
+    assert np.all(previews[0].num_pixels ==
+                  np.maximum(np.ceil(0.05 * roi_sizes), 10))
+    # the estimates improve as pixels are added
+    mean_err = [np.mean(preview.g2_err[1:-1]) for preview in previews]
+    assert mean_err[0] > mean_err[1] > mean_err[2]
+    for preview in previews:
+        assert np.all(preview.lag_steps == lag_steps)
+        # the last lag has a single pair of frames, without any scatter
+        assert np.all(np.abs(preview.g2 - g2)[:-1] <
+                      5 * preview.g2_err[:-1] + 1e-6)
+    assert np.all(previews[-1].num_pixels == roi_sizes)
+    assert_array_almost_equal(previews[-1].g2, g2, decimal=5)
+
+    # the passes only correlate the pixels they add
+    states = previews[1].internal_state
+    assert_equal(len(states), 2)
+    pixels = np.concatenate([state.pixel_list for state in states])
+    assert_equal(len(pixels), previews[1].num_pixels.sum())
+    subset = np.zeros_like(rois)
+    subset.flat[pixels] = rois.flat[pixels]
+    direct = list(lazy_one_time(img_stack, num_levels, num_bufs, subset,
+                                yield_every=None, per_pixel=True))[-1]
+    for expected, result in zip(
+            roi_g2_from_pixels(direct.internal_state, subset),
+            roi_g2_from_pixels(states, subset)):
+        assert_array_almost_equal(expected, result, decimal=10)
+    assert_array_almost_equal(previews[1].g2,
+                              roi_g2_from_pixels(direct.internal_state,
+                                                 subset)[0], decimal=10)
+
+    # frames that are bad (np.nan) in only some of the pixels
+    images = img_stack.astype(float)
+    images[7, 0, 0] = np.nan
+    images[30, 30, 60] = np.nan
+    previews = list(lazy_one_time_preview(images, num_levels, num_bufs,
+                                          rois, fractions=[0.05, 0.5, 1],
+                                          seed=2))
+    assert_equal(len(previews), 3)
+    assert np.all(np.isfinite(previews[-1].g2))
+
+    within_pass = list(lazy_one_time_preview(img_stack, num_levels, num_bufs,
+                                             rois, fractions=[0.1],
+                                             yield_every=50))
+    assert_equal(len(within_pass), 2)
+
+    assert_raises(ValueError, list, lazy_one_time_preview(
+        img_stack, num_levels, num_bufs, rois, fractions=[0.5, 0.1]))
+    assert_raises(ValueError, list, lazy_one_time_preview(
+        iter(img_stack), num_levels, num_bufs, rois, fractions=[0.1, 1]))
+
+
+def test_parallel_one_time_corr():
+    setup()
+    labels = rois.copy()
+    labels[xdim//2:, ydim//2:] = 1
+    labels[xdim//2:, :10] = 8
+    images = list(bad_to_nan_gen(img_stack, [3, 21, 35, 48]))
+    g2, lag_steps = multi_tau_auto_corr(num_levels, num_bufs, labels, images)
+
+    for executor in ['thread', 'process']:
+        result = parallel_one_time_corr(images, num_levels, num_bufs, labels,
+                                        num_workers=3, executor=executor)
+        assert_equal(result.g2.shape, (len(lag_steps), 4))
+        assert np.all(result.g2 == g2)
+        assert np.all(result.lag_steps == lag_steps)
+
+    # the merged state can be used to continue the correlation
+    result = parallel_one_time_corr(np.asarray(images[:50]), num_levels,
+                                    num_bufs, labels, num_workers=2,
+                                    executor='thread')
+    for final in lazy_one_time(images[50:], num_levels, num_bufs, labels,
+                               internal_state=result.internal_state):
+        pass
+    assert np.all(final.g2 == g2)
+
+    assert_raises(ValueError, parallel_one_time_corr, images, num_levels,
+                  num_bufs, labels, executor='mpi')
+
+    # a frame that is only partially bad is skipped by some partitions only
+    partial = [image.astype(float) for image in images[:20]]
+    partial[7][labels == 1] = np.nan
+    assert_raises(ValueError, parallel_one_time_corr, partial, num_levels,
+                  num_bufs, labels, num_workers=3, executor='thread')
+
+
+def test_save_load_state(tmpdir):
+    setup()
+    images = list(bad_to_nan_gen(img_stack, [3, 21, 35, 48]))
+    for full_result in lazy_one_time(images, num_levels, num_bufs, rois):
+        pass
+    for full_state in lazy_two_time(rois, img_stack, stack_size, num_bufs,
+                                    num_levels):
+        pass
+
+    for path in [str(tmpdir.join('one_time.npz')),
+                 str(tmpdir.join('one_time'))]:
+        for result in lazy_one_time(images[:50], num_levels, num_bufs, rois):
+            pass
+        utils.save_state(result.internal_state, path)
+        state = utils.load_state(path, mmap_mode='c')
+        for result in lazy_one_time(images[50:], num_levels, num_bufs, rois,
+                                    internal_state=state):
+            pass
+        assert np.all(full_result.g2 == result.g2)
+
+    for path in [str(tmpdir.join('two_time.npz')),
+                 str(tmpdir.join('two_time'))]:
+        for state in lazy_two_time(rois, img_stack[:51], stack_size, num_bufs,
+                                   num_levels):
+            pass
+        utils.save_state(state, path)
+        state = utils.load_state(path, mmap_mode='r+')
+        for state in lazy_two_time(rois, img_stack[51:], stack_size, num_bufs,
+                                   num_levels, two_time_internal_state=state):
+            pass
+        assert np.all(full_state.g2 == state.g2)
+        assert_equal(full_state.time_ind, state.time_ind)
+
+
+def test_lazy_one_time_events():
+    setup()
+    rs = np.random.RandomState(42)
+    # sparse images, with a few bad (np.nan) ones
+    images = rs.poisson(0.05, img_stack.shape).astype(float)
+    images[[3, 21, 35]] = np.nan
+    events = []
+    for image in images:
+        pixel_indices = np.flatnonzero(np.ravel(image))
+        events.append((pixel_indices, np.ravel(image)[pixel_indices]))
+    # repeated pixel indices are summed
+    pixel_indices, counts = events[10]
+    counts = counts.copy()
+    counts[:5] -= 0.5
+    events[10] = (np.r_[pixel_indices, pixel_indices[:5]],
+                  np.r_[counts, 0.5 * np.ones(5)])
+
+    for dense in lazy_one_time(images, num_levels, num_bufs, rois,
+                               backend='numpy'):
+        pass
+    event_results = list(lazy_one_time_events(events, num_levels, num_bufs,
+                                              rois, yield_every=None))
+    assert_equal(len(event_results), 1)
+    assert np.all(dense.g2 == event_results[-1].g2)
+    assert np.all(dense.lag_steps == event_results[-1].lag_steps)
+
+
+def test_linear_auto_corr(tmpdir):
+    setup()
+    images = np.asarray(list(bad_to_nan_gen(img_stack, [3, 21, 35, 48])))
+    # a memory-mapped image stack
+    stack = np.lib.format.open_memmap(str(tmpdir.join('stack.npy')),
+                                      mode='w+', dtype=images.dtype,
+                                      shape=images.shape)
+    stack[:] = images
+    for num_lags in [stack_size, 10]:
+        g2, lag_steps = multi_tau_auto_corr(1, num_lags, rois, images)
+        g2_fft, lag_steps_fft = linear_auto_corr(stack, rois,
+                                                 num_lags=num_lags,
+                                                 block_size=300)
+        assert_array_almost_equal(g2_fft, g2, decimal=10)
+        assert np.all(lag_steps_fft == lag_steps)
+
+    # with the last image bad, no pair of good images is a whole stack apart
+    images[-1] = np.nan
+    with np.errstate(all='raise'):
+        g2_fft, lag_steps_fft = linear_auto_corr(images, rois)
+    assert np.all(np.isnan(g2_fft[-1]))
+    assert np.all(np.isfinite(g2_fft[:-1]))
+
+
 def test_two_time_corr():
     setup()
     y = []
@@ -172,6 +488,128 @@ def test_two_time_corr():
                   num_bufs=25, num_levels=1)
 
 
+def test_two_time_storage(tmpdir):
+    setup()
+    num_frames = 40
+    images = img_stack[:num_frames]
+    for num_lev, num_buf in [(1, num_frames), (3, 8)]:
+        dense = two_time_corr(rois, images, num_frames, num_buf, num_lev)
+        num_rois = dense.g2.shape[0]
+        t1, t2 = np.tril_indices(num_frames)
+
+        packed = two_time_corr(rois, images, num_frames, num_buf, num_lev,
+                               storage='packed', memmap_dir=str(tmpdir))
+        assert_equal(packed.g2.shape,
+                     (num_rois, num_frames * (num_frames + 1) // 2))
+        assert np.all(packed.g2 == dense.g2[:, t1, t2])
+        assert tmpdir.join('g2.npy').check()
+
+        banded = two_time_corr(rois, images, num_frames, num_buf, num_lev,
+                               storage='banded', max_lag=10)
+        assert_equal(banded.g2.shape, (num_rois, 11, num_frames))
+        t1, t2 = t1[t1 - t2 <= 10], t2[t1 - t2 <= 10]
+        assert np.all(banded.g2[:, t1 - t2, t2] == dense.g2[:, t1, t2])
+
+        one_time = one_time_from_two_time(dense.g2)
+        assert_array_almost_equal(
+            one_time_from_two_time(packed.g2, storage='packed'), one_time)
+        assert_array_almost_equal(
+            one_time_from_two_time(banded.g2, storage='banded'),
+            one_time[:, :11])
+
+    assert_raises(ValueError, two_time_corr, rois, images, num_frames,
+                  num_frames, storage='banded')
+    assert_raises(ValueError, two_time_corr, rois, images, num_frames,
+                  num_frames, storage='sparse')
+    assert_raises(ValueError, one_time_from_two_time, dense.g2,
+                  storage='sparse')
+
+
+def test_blocked_two_time_corr(tmpdir):
+    setup()
+    num_frames = 44
+    images = np.asarray(list(bad_to_nan_gen(img_stack[:num_frames], [7])))
+    expected = two_time_corr(rois, images, num_frames, num_frames, 1)
+
+    for tile_size in [num_frames, 8]:
+        result = blocked_two_time_corr(rois, images, tile_size=tile_size)
+        assert_array_almost_equal(result.g2, expected.g2)
+        assert np.all(result.lag_steps == expected.lag_steps)
+
+        t1, t2 = np.tril_indices(num_frames)
+        packed = blocked_two_time_corr(rois, images, tile_size=tile_size,
+                                       storage='packed',
+                                       memmap_dir=str(tmpdir))
+        assert_array_almost_equal(packed.g2, expected.g2[:, t1, t2])
+
+        banded = blocked_two_time_corr(rois, images, tile_size=tile_size,
+                                       storage='banded', max_lag=12)
+        t1, t2 = t1[t1 - t2 <= 12], t2[t1 - t2 <= 12]
+        assert_array_almost_equal(banded.g2[:, t1 - t2, t2],
+                                  expected.g2[:, t1, t2])
+
+    # every tile is read from the image stack only once
+    class CountingStack(object):
+        def __init__(self, images):
+            self.images = images
+            self.num_read = 0
+
+        def __len__(self):
+            return len(self.images)
+
+        def __getitem__(self, key):
+            tile = self.images[key]
+            self.num_read += len(tile)
+            return tile
+
+    stack = CountingStack(images)
+    result = blocked_two_time_corr(rois, stack, tile_size=8)
+    assert_equal(stack.num_read, num_frames)
+    assert_array_almost_equal(result.g2, expected.g2)
+
+    assert_raises(ValueError, blocked_two_time_corr, rois, images,
+                  tile_size=0)
+
+
+def test_lazy_two_time_window():
+    setup()
+    num_frames = 30
+    window = 7
+    images = list(bad_to_nan_gen(img_stack[:num_frames], [11]))
+    dense = two_time_corr(rois, images, num_frames, num_frames, 1).g2
+
+    strips = list(lazy_two_time_window(rois, images, window, strip_size=4))
+    # the 24 complete ages in strips of 4, then the 6 incomplete ones
+    assert_equal(len(strips), 7)
+    assert_equal(strips[-1].g2.shape, (dense.shape[0], 6, window))
+    g2 = np.concatenate([strip.g2 for strip in strips], axis=1)
+    ages = np.concatenate([strip.ages for strip in strips])
+    assert np.all(ages == np.arange(num_frames))
+    assert np.all(strips[0].lag_steps == np.arange(window))
+
+    age, lag = np.meshgrid(ages, np.arange(window), indexing='ij')
+    valid = age + lag < num_frames
+    assert_array_almost_equal(g2[:, valid],
+                              dense[:, (age + lag)[valid], age[valid]])
+    assert np.all(np.isnan(g2[:, ~valid]))
+
+    # pick up the correlation where it was interrupted
+    first = list(lazy_two_time_window(rois, images[:13], window,
+                                      strip_size=4))
+    # ages 0 -> 3 are complete, 4 -> 6 are waiting for the strip to fill
+    # up and 7 -> 12 are incomplete
+    assert_equal([len(strip.ages) for strip in first], [4, 9])
+    second = list(lazy_two_time_window(
+        rois, images[13:], window, internal_state=first[-1].internal_state))
+    resumed = np.concatenate([strip.g2 for strip in first[:-1] + second],
+                             axis=1)
+    assert np.all((resumed == g2) | np.isnan(g2))
+
+    assert_raises(ValueError, list, lazy_two_time_window(rois, images, 0))
+    assert_raises(ValueError, list, lazy_two_time_window(rois, images, 4,
+                                                         strip_size=0))
+
+
 def test_auto_corr_scat_factor():
     num_levels, num_bufs = 3, 4
     tot_channels, lags, dict_lags = utils.multi_tau_lags(num_levels, num_bufs)
@@ -185,6 +623,66 @@ def test_auto_corr_scat_factor():
                                             1.0, 1.0, 1.0]), decimal=8)
 
 
+def test_fit_auto_corr_scat_factor():
+    from scipy.optimize import curve_fit
+    np.random.seed(1)
+    lags = np.r_[np.arange(1, 8), 2**np.arange(3, 12)].astype(float)
+    beta = np.random.uniform(.1, .3, (4, 3))
+    rate = 10**np.random.uniform(-3, -1, (4, 3))
+    baseline = np.random.uniform(.98, 1.02, (4, 3))
+    exact = auto_corr_scat_factor(lags[:, np.newaxis, np.newaxis], beta, rate,
+                                  baseline)
+
+    params, covariance = fit_auto_corr_scat_factor(lags, exact)
+    assert_equal(params.shape, (4, 3, 3))
+    assert_equal(covariance.shape, (4, 3, 3, 3))
+    assert_array_almost_equal(params[..., 0], beta)
+    assert_array_almost_equal(params[..., 1] / rate, np.ones_like(rate))
+    assert_array_almost_equal(params[..., 2], baseline)
+
+    # the same fits as curve_fit
+    noisy = exact + np.random.normal(0, .005, exact.shape)
+    noisy[3, 0, 0] = np.nan
+    sigma = np.full(noisy.shape, .005)
+    for sig in [None, sigma]:
+        params, covariance = fit_auto_corr_scat_factor(lags, noisy,
+                                                       sigma=sig)
+        for n, m in [(0, 0), (1, 2), (3, 1)]:
+            valid = np.isfinite(noisy[:, n, m])
+            expected, expected_cov = curve_fit(
+                auto_corr_scat_factor, lags[valid], noisy[valid, n, m],
+                p0=params[n, m], sigma=None if sig is None else
+                sig[valid, n, m], absolute_sigma=sig is not None)
+            assert_array_almost_equal(params[n, m] / expected, np.ones(3),
+                                      decimal=4)
+            assert_array_almost_equal(covariance[n, m] / expected_cov,
+                                      np.ones((3, 3)), decimal=2)
+
+    # fixed baseline
+    params, covariance = fit_auto_corr_scat_factor(lags, exact[:, 0] -
+                                                   baseline[0] + 1,
+                                                   baseline=1)
+    assert np.all(params[:, 2] == 1)
+    assert np.all(covariance[:, 2] == 0)
+    assert_array_almost_equal(params[:, 0], beta[0])
+
+    # curves with too few points for the free parameters
+    sparse = exact[:, 0].copy()
+    sparse[2:, 0] = np.nan
+    sparse[:, 1] = np.nan
+    sparse[4:, 2] = np.nan
+    params, covariance = fit_auto_corr_scat_factor(lags, sparse)
+    assert np.all(np.isnan(params[:2]))
+    assert np.all(np.isnan(covariance[:2]))
+    assert np.all(np.isfinite(params[2:]))
+    assert np.all(np.isfinite(covariance[2:]))
+    params, covariance = fit_auto_corr_scat_factor(lags, sparse, baseline=1)
+    assert np.all(np.isnan(params[:2]))
+    assert np.all(np.isfinite(params[2:]))
+
+    assert_raises(ValueError, fit_auto_corr_scat_factor, lags[1:], exact)
+
+
 def test_bad_images():
     setup()
     g2, lag_steps = multi_tau_auto_corr(4, num_bufs,
@@ -224,6 +722,69 @@ def test_one_time_from_two_time():
                                                         0.2, 0.1]))
 
 
+def test_age_resolved_one_time(tmpdir):
+    setup()
+    num_frames = 24
+    images = list(bad_to_nan_gen(img_stack[:num_frames], [5]))
+    dense = two_time_corr(rois, images, num_frames, num_frames, 1).g2
+    windows = [(0, num_frames), (3, 10), (20, 30), (4, 4)]
+
+    expected = np.full((dense.shape[0], len(windows), num_frames), np.nan)
+    for k, (start, end) in enumerate(windows):
+        for lag in range(num_frames):
+            ages = np.arange(start, min(end, num_frames - lag))
+            if len(ages):
+                expected[:, k, lag] = np.nanmean(dense[:, ages + lag, ages],
+                                                 axis=1)
+    g2 = age_resolved_one_time(dense, windows)
+    assert_equal(g2.shape, expected.shape)
+    assert_array_almost_equal(g2, expected)
+
+    packed = two_time_corr(rois, images, num_frames, num_frames, 1,
+                           storage='packed', memmap_dir=str(tmpdir)).g2
+    assert_array_almost_equal(
+        age_resolved_one_time(packed, windows, storage='packed'), expected)
+    banded = two_time_corr(rois, images, num_frames, num_frames, 1,
+                           storage='banded', max_lag=5).g2
+    assert_array_almost_equal(
+        age_resolved_one_time(banded, windows, storage='banded'),
+        expected[:, :, :6])
+
+    assert_raises(ValueError, age_resolved_one_time, dense, [(5, 2)])
+    assert_raises(ValueError, age_resolved_one_time, dense, windows,
+                  storage='sparse')
+
+
+@skip_if(correlation._correlation is None,
+         'compiled correlation kernel is not available')
+def test_cython_backend():
+    setup()
+    # introduce bad images, these are treated by the kernels as well
+    images = list(bad_to_nan_gen(img_stack, [3, 21, 35, 48]))
+    for imgs in [img_stack, images]:
+        g2, lag_steps = multi_tau_auto_corr(num_levels, num_bufs, rois, imgs,
+                                            backend='numpy')
+        g2_c, lag_steps_c = multi_tau_auto_corr(num_levels, num_bufs, rois,
+                                                imgs, backend='cython')
+        assert np.all(g2 == g2_c)
+        assert np.all(lag_steps == lag_steps_c)
+
+    two_time = two_time_corr(rois, img_stack, stack_size, num_bufs,
+                             num_levels, backend='numpy')
+    two_time_c = two_time_corr(rois, img_stack, stack_size, num_bufs,
+                               num_levels, backend='cython')
+    assert np.all(two_time.g2 == two_time_c.g2)
+
+
+def test_backend_badinputs():
+    setup()
+    assert_raises(ValueError, multi_tau_auto_corr, num_levels, num_bufs,
+                  rois, img_stack, backend='fortran')
+    if correlation._correlation is None:
+        assert_raises(ImportError, multi_tau_auto_corr, num_levels, num_bufs,
+                      rois, img_stack, backend='cython')
+
+
 def test_CrossCorrelator1d():
     ''' Test the 1d version of the cross correlator with these methods:
         -method='regular', no mask
@@ -368,6 +929,174 @@ def testCrossCorrelator2d():
                               )
 
 
+def _reference_cross_corr(cc, img1, img2=None):
+    """CrossCorrelator, computed with plain full fftconvolve correlations"""
+    if cc.ndim == 1:
+        img1 = img1.reshape((1, -1))
+        if img2 is not None:
+            img2 = img2.reshape((1, -1))
+    ccorrs = []
+    for i in range(cc.nids):
+        index_start, index_stop = cc.idpos[i], cc.idpos[i + 1]
+        ppiis = cc.ppii[index_start:index_stop]
+        ppjjs = cc.ppjj[index_start:index_stop]
+        pis = cc.pi[index_start:index_stop]
+        pjs = cc.pj[index_start:index_stop]
+        submask = cc.submasks[i]
+        tmpimg = np.zeros(cc.shapes[i, :])
+        tmpimg[ppiis, ppjjs] = img1[pis, pjs]
+        tmpimg2 = tmpimg
+        if img2 is not None:
+            tmpimg2 = np.zeros_like(tmpimg)
+            tmpimg2[ppiis, ppjjs] = img2[pis, pjs]
+
+        maskcorr = correlation._cross_corr(submask)
+        maskcorr[maskcorr < .5] = np.nan
+        ccorr = correlation._cross_corr(tmpimg, tmpimg2)
+        if 'symavg' in cc.normalization:
+            ccorr *= (maskcorr / correlation._cross_corr(tmpimg, submask) /
+                      correlation._cross_corr(submask, tmpimg2))
+        if 'regular' in cc.normalization:
+            ccorr /= (maskcorr * np.average(tmpimg[ppiis, ppjjs]) *
+                      np.average(tmpimg2[ppiis, ppjjs]))
+        ccorrs.append(ccorr.reshape(-1) if cc.ndim == 1 else ccorr)
+    return ccorrs[0] if len(ccorrs) == 1 else ccorrs
+
+
+def test_CrossCorrelator_reference():
+    # the spectra of CrossCorrelator against direct full correlations
+    np.random.seed(0)
+    ids = np.zeros((20, 30), dtype=int)
+    ids[2:10, 3:20] = 1
+    ids[12:19, 10:28] = 2
+    ids[5, 25] = 3
+    ids_1D = np.zeros(50, dtype=int)
+    ids_1D[3:20] = 1
+    ids_1D[25:47:2] = 2
+
+    for shape, mask in [((20, 30), None), ((20, 30), ids),
+                        ((50,), None), ((50,), ids_1D)]:
+        img1 = 1 + np.random.rand(*shape)
+        img2 = 1 + np.random.rand(*shape)
+        for normalization in ['regular', 'symavg']:
+            cc = CrossCorrelator(shape, mask=mask,
+                                 normalization=normalization)
+            for other in [None, img2]:
+                result = cc(img1, other)
+                expected = _reference_cross_corr(cc, img1, other)
+                if cc.nids == 1:
+                    result, expected = [result], [expected]
+                assert_equal(len(result), len(expected))
+                for res, exp in zip(result, expected):
+                    assert_equal(res.shape, exp.shape)
+                    assert_array_almost_equal(res, exp, decimal=10)
+
+
+def test_CrossCorrelator_stack():
+    np.random.seed(0)
+    stack = np.random.rand(7, 20, 30)
+    stack2 = np.random.rand(7, 20, 30)
+    ids = np.zeros((20, 30), dtype=int)
+    ids[2:10, 3:20] = 1
+    ids[12:19, 10:28] = 2
+
+    for normalization in ['regular', 'symavg']:
+        cc = CrossCorrelator(ids.shape, mask=ids,
+                             normalization=normalization)
+        for imgs2 in [None, stack2]:
+            frames = [cc(img, None if imgs2 is None else imgs2[n])
+                      for n, img in enumerate(stack)]
+            result = cc(stack, imgs2, batch_size=3)
+            averaged = cc(stack, imgs2, average=True)
+            for i in range(2):
+                expected = np.array([frame[i] for frame in frames])
+                assert_array_almost_equal(result[i], expected)
+                assert_array_almost_equal(averaged[i],
+                                          np.mean(expected, axis=0))
+
+        # the ids in parallel, in the same order
+        cc_threads = CrossCorrelator(ids.shape, mask=ids,
+                                     normalization=normalization, workers=3)
+        for imgs2 in [None, stack2]:
+            for expected, result in zip(cc(stack, imgs2),
+                                        cc_threads(stack, imgs2)):
+                assert_array_equal(expected, result)
+        # the threads are kept between the calls
+        executor = cc_threads._executor
+        cc_threads(stack)
+        assert cc_threads._executor is executor
+        cc_threads.close()
+        assert cc_threads._executor is None
+
+    with CrossCorrelator(ids.shape, mask=ids, normalization=cc.normalization,
+                         workers=2) as cc_threads:
+        for expected, result in zip(cc(stack), cc_threads(stack)):
+            assert_array_equal(expected, result)
+        # a running correlator can be pickled, e.g. for process pools
+        for copied in [pickle.loads(pickle.dumps(cc_threads)),
+                       copy.deepcopy(cc_threads)]:
+            assert copied._executor is None
+            for expected, result in zip(cc(stack), copied(stack)):
+                assert_array_equal(expected, result)
+            copied.close()
+    assert cc_threads._executor is None
+
+    # curves
+    cc1D = CrossCorrelator((30,), normalization='symavg')
+    curves = np.random.rand(4, 30)
+    result = cc1D(curves)
+    assert_equal(result.shape, (4, 59))
+    assert_array_almost_equal(result[2], cc1D(curves[2]))
+
+    with assert_raises(ValueError):
+        cc1D(curves, curves[:3])
+
+
+def test_lazy_cross_corr():
+    np.random.seed(0)
+    stack = np.random.rand(12, 20, 30)
+    stack[5] = np.nan
+    ids = np.zeros((20, 30), dtype=int)
+    ids[2:10, 3:20] = 1
+    ids[12:19, 10:28] = 2
+    deltas = [3, 0, 1]
+
+    for normalization in ['regular', 'symavg']:
+        cc = CrossCorrelator(ids.shape, mask=ids,
+                             normalization=normalization)
+        result = list(lazy_cross_corr(stack, cc, deltas,
+                                      yield_every=None))[-1]
+        assert np.all(result.deltas == [0, 1, 3])
+        for n, delta in enumerate(result.deltas):
+            pairs = [cc(stack[t], stack[t + delta])
+                     for t in range(len(stack) - delta)
+                     if t != 5 and t + delta != 5]
+            for i in range(2):
+                assert_array_almost_equal(
+                    result.ccorrs[i][n],
+                    np.mean([pair[i] for pair in pairs], axis=0))
+
+        # pick up where it was interrupted
+        first = list(lazy_cross_corr(stack[:2], cc, deltas))
+        assert_equal(len(first), 2)
+        assert np.all(np.isnan(first[-1].ccorrs[0][2]))
+        resumed = list(lazy_cross_corr(
+            stack[2:], cc, deltas, internal_state=first[-1].internal_state))
+        for expected, ccorr in zip(result.ccorrs, resumed[-1].ccorrs):
+            assert_array_equal(expected, ccorr)
+
+    # curves
+    cc1D = CrossCorrelator((30,))
+    curves = np.random.rand(4, 30)
+    result = list(lazy_cross_corr(curves, cc1D, [2]))[-1]
+    assert_array_almost_equal(result.ccorrs[0],
+                              np.mean([cc1D(curves[0], curves[2]),
+                                       cc1D(curves[1], curves[3])], axis=0))
+
+    assert_raises(ValueError, list, lazy_cross_corr(curves, cc1D, [-1]))
+    assert_raises(ValueError, list, lazy_cross_corr(stack, cc1D, [1]))
+
+
 def test_CrossCorrelator_badinputs():
     with assert_raises(ValueError):
         CrossCorrelator((1, 1, 1))
@@ -383,6 +1112,9 @@ def test_CrossCorrelator_badinputs():
         a2 = np.ones((10, 11))
         cc(a, a2)
 
+    with assert_raises(ValueError):
+        CrossCorrelator((10, 10), workers=0)
+
 
 if __name__ == '__main__':
     import nose
@@ -36,11 +36,13 @@ from __future__ import absolute_import, division, print_function
 import logging
 
 import numpy as np
-from numpy.testing import assert_array_almost_equal
+from numpy.testing import assert_array_almost_equal, assert_array_equal
+from nose.tools import assert_raises
 
 import skbeam.core.speckle as xsvs
 import skbeam.core.mask as mask
 from skbeam.core import roi
+from skbeam.core.utils import save_state, load_state
 
 logger = logging.getLogger(__name__)
 
@@ -85,6 +87,209 @@ def test_xsvs():
                               np.array([0., 0.2, 0.2, 0.2, 0.4]))
 
 
+def test_xsvs_histograms():
+    np.random.seed(0)
+    images = np.random.poisson(3, (8, 20, 20)).astype(float)
+    label_array = np.zeros((20, 20), dtype=np.int64)
+    label_array[:8] = 7
+    label_array[10:, 5:15] = 3
+
+    prob_k_all, std = xsvs.xsvs((images, ), label_array, timebin_num=2,
+                                number_of_img=8, max_cts=7.5)
+    assert prob_k_all.shape == (3, 2)
+    edges = np.arange(8)
+    for j, label in enumerate([3, 7]):
+        hists = [np.histogram(img[label_array == label], bins=edges,
+                              density=True)[0] for img in images]
+        assert_array_almost_equal(prob_k_all[0, j], np.mean(hists, axis=0))
+        assert_array_almost_equal(std[0, j], np.std(hists, axis=0))
+        assert_array_almost_equal(prob_k_all[1, j].sum(), 1)
+
+
+def test_xsvs_single_pass():
+    np.random.seed(0)
+    image_sets = [np.random.poisson(lam, (n, 20, 20)).astype(float)
+                  for lam, n in [(2, 9), (4, 6), (3, 11)]]
+    image_sets[1] = list(mask.bad_to_nan_gen(list(image_sets[1]), [2]))
+    label_array = np.zeros((20, 20), dtype=np.int64)
+    label_array[:8] = 1
+    label_array[10:, 5:15] = 2
+
+    prob_k, std = xsvs.xsvs(image_sets, label_array, number_of_img=11,
+                            timebin_num=3)
+    # the images are only read once, they can come from generators
+    prob_k_single, std_single = xsvs.xsvs(
+        [(img for img in images) for images in image_sets], label_array,
+        number_of_img=11, timebin_num=3, single_pass=True)
+
+    assert prob_k_single.shape == prob_k.shape
+    for i, j in np.ndindex(prob_k.shape):
+        assert_array_almost_equal(prob_k_single[i, j], prob_k[i, j])
+        assert_array_almost_equal(std_single[i, j], std[i, j])
+
+
+def test_parallel_xsvs():
+    np.random.seed(0)
+    image_sets = [np.random.poisson(lam, (n, 20, 20)).astype(float)
+                  for lam, n in [(2, 9), (4, 6), (3, 11)]]
+    image_sets[1] = np.array(list(mask.bad_to_nan_gen(list(image_sets[1]),
+                                                      [2])))
+    label_array = np.zeros((20, 20), dtype=np.int64)
+    label_array[:8] = 1
+    label_array[10:, 5:15] = 2
+    max_cts = roi.roi_max_counts(image_sets, label_array)
+
+    # a single set is the same as xsvs
+    prob_k, std = xsvs.xsvs(image_sets[:1], label_array, number_of_img=11,
+                            max_cts=max_cts)
+    prob_k_par, std_par = xsvs.parallel_xsvs(image_sets[:1], label_array,
+                                             number_of_img=11,
+                                             max_cts=max_cts, num_workers=2)
+    for i, j in np.ndindex(prob_k.shape):
+        assert_array_almost_equal(prob_k_par[i, j], prob_k[i, j])
+        assert_array_almost_equal(std_par[i, j], std[i, j])
+
+    # the frames of all sets are pooled. lazy_xsvs needs bins that hold
+    # the largest count
+    finals = [list(xsvs.lazy_xsvs(images, label_array, number_of_img=11,
+                                  max_cts=max_cts + 1, yield_every=None))[0]
+              for images in image_sets]
+    for executor in ['process', 'thread']:
+        prob_k_par, std_par = xsvs.parallel_xsvs(image_sets, label_array,
+                                                 number_of_img=11,
+                                                 max_cts=max_cts + 1,
+                                                 num_workers=2,
+                                                 executor=executor)
+        for i, j in np.ndindex(prob_k.shape):
+            counts = [r.internal_state.img_per_level[i] -
+                      r.internal_state.track_bad[i] for r in finals]
+            expected = np.average([r.prob_k[i, j] for r in finals], axis=0,
+                                  weights=counts)
+            expected_pow = np.average(
+                [r.prob_k_std_dev[i, j]**2 + r.prob_k[i, j]**2
+                 for r in finals], axis=0, weights=counts)
+            assert_array_almost_equal(prob_k_par[i, j], expected)
+            assert_array_almost_equal(std_par[i, j],
+                                      (expected_pow - expected**2)**.5)
+
+    # without max_cts the maximum count is found in the same pass, as
+    # roi.roi_max_counts
+    prob_k_max, std_max = xsvs.parallel_xsvs(image_sets, label_array,
+                                             number_of_img=11,
+                                             max_cts=max_cts, num_workers=2)
+    for executor in ['process', 'thread']:
+        prob_k_par, std_par = xsvs.parallel_xsvs(image_sets, label_array,
+                                                 number_of_img=11,
+                                                 num_workers=2,
+                                                 executor=executor)
+        for i, j in np.ndindex(prob_k_max.shape):
+            assert_array_almost_equal(prob_k_par[i, j], prob_k_max[i, j])
+            assert_array_almost_equal(std_par[i, j], std_max[i, j])
+
+    assert_raises(ValueError, xsvs.parallel_xsvs, image_sets, label_array,
+                  11, executor='cluster')
+    assert_raises(ValueError, xsvs.parallel_xsvs, [], label_array, 11,
+                  max_cts=max_cts)
+
+
+def test_xsvs_contrast():
+    np.random.seed(0)
+    # speckle with a contrast of 1 / 4
+    image_sets = [np.random.poisson(np.random.gamma(4, 1, (n, 40, 40)))
+                  .astype(float) for n in [12, 9]]
+    image_sets[1] = np.array(list(mask.bad_to_nan_gen(list(image_sets[1]),
+                                                      [3])))
+    label_array = np.zeros((40, 40), dtype=np.int64)
+    label_array[:15] = 1
+    label_array[20:, 5:35] = 2
+
+    contrast, moments = xsvs.xsvs_contrast(image_sets, label_array,
+                                           number_of_img=12,
+                                           third_moment=True)
+    assert contrast.shape == (4, 2)
+    assert moments.shape == (4, 2, 3)
+    assert_array_almost_equal(contrast[0], [0.25, 0.25], decimal=1)
+
+    # the moments of the (unbinned) probability densities
+    max_cts = roi.roi_max_counts(image_sets, label_array) + 2
+    prob_k, std = xsvs.parallel_xsvs(image_sets, label_array,
+                                     number_of_img=12, max_cts=max_cts,
+                                     executor='thread')
+    for i, j in np.ndindex(prob_k.shape):
+        counts = np.arange(len(prob_k[i, j]))
+        assert_array_almost_equal(
+            moments[i, j], [np.dot(prob_k[i, j], counts**n)
+                            for n in [1, 2, 3]])
+        mean, second = moments[i, j, :2]
+        assert_array_almost_equal(contrast[i, j],
+                                  (second - mean**2 - mean) / mean**2)
+
+
+def test_lazy_xsvs(tmpdir):
+    np.random.seed(0)
+    images = np.random.poisson(3, (10, 20, 20)).astype(float)
+    images = list(mask.bad_to_nan_gen(list(images), [4]))
+    label_array = np.zeros((20, 20), dtype=np.int64)
+    label_array[:8] = 1
+    label_array[10:, 5:15] = 2
+
+    prob_k, std = xsvs.xsvs((images, ), label_array, number_of_img=10,
+                            max_cts=12)
+
+    path = str(tmpdir.join('state.npz'))
+    results = []
+    for res in xsvs.lazy_xsvs(images, label_array, number_of_img=10,
+                              max_cts=12):
+        results.append(res)
+        if len(results) == 6:
+            # checkpoint, to resume from below
+            save_state(res.internal_state, path)
+    assert len(results) == 10
+    resumed = list(xsvs.lazy_xsvs(images[6:], label_array, number_of_img=10,
+                                  internal_state=load_state(path),
+                                  yield_every=None))
+    assert len(resumed) == 1
+    assert_raises(ValueError, next, xsvs.lazy_xsvs(
+        images[6:], label_array, number_of_img=10, timebin_num=4,
+        internal_state=load_state(path)))
+    # another timebin_num is taken from the state
+    prob_k4, std4 = xsvs.xsvs((images, ), label_array, number_of_img=10,
+                              timebin_num=4, max_cts=12)
+    first = list(xsvs.lazy_xsvs(images[:5], label_array, number_of_img=10,
+                                timebin_num=4, max_cts=12))[-1]
+    resumed4 = list(xsvs.lazy_xsvs(images[5:], label_array,
+                                   number_of_img=10,
+                                   internal_state=first.internal_state))[-1]
+    for i, j in np.ndindex(prob_k4.shape):
+        assert_array_equal(resumed4.prob_k[i, j], prob_k4[i, j])
+    for res in [results[-1], resumed[0]]:
+        for i, j in np.ndindex(prob_k.shape):
+            assert_array_equal(res.prob_k[i, j], prob_k[i, j])
+            assert_array_equal(res.prob_k_std_dev[i, j], std[i, j])
+
+    # counts beyond max_cts can not be histogrammed
+    bright = images[0].copy()
+    bright[0, 0] = 12
+    gen = xsvs.lazy_xsvs(images[:3] + [bright], label_array,
+                         number_of_img=10, max_cts=12)
+    for _ in range(3):
+        state = next(gen).internal_state
+    img_per_level = state.img_per_level.copy()
+    prob_k_state = state.prob_k.copy()
+    assert_raises(ValueError, next, gen)
+    assert_array_equal(state.img_per_level, img_per_level)
+    assert_array_equal(state.prob_k, prob_k_state)
+    # outside of the ROIs they do not matter
+    bright[9, 0] = 100
+    bright[0, 0] = 0
+    assert len(list(xsvs.lazy_xsvs([bright], label_array, number_of_img=10,
+                                   max_cts=12))) == 1
+
+    assert_raises(ValueError, next, xsvs.lazy_xsvs(images, label_array, 10))
+    assert_raises(ValueError, next, xsvs.lazy_xsvs(images, label_array, 10,
+                                                   max_cts=12, yield_every=0))
+
+
 def test_normalize_bin_edges():
     num_times = 3
     num_rois = 2
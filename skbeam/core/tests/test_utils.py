@@ -36,6 +36,7 @@ from __future__ import absolute_import, division, print_function
 
 import six
 import numpy as np
+import os
 import sys
 
 import numpy.testing as npt
@@ -551,6 +552,32 @@ def test_geometric_series():
     assert_array_equal(time_series, [1, 5, 25, 125])
 
 
+def test_save_load_state(tmpdir):
+    from skbeam.core.dpc import dpc_internal_state
+    state = dpc_internal_state(*[np.random.random((3, 4)) for _ in range(4)] +
+                               [np.fft.ifft(np.arange(5)),
+                                np.fft.ifft(np.arange(6)), [7]])
+    for path in [str(tmpdir.join('dpc.npz')), str(tmpdir.join('dpc'))]:
+        core.save_state(state, path)
+        loaded = core.load_state(path)
+        assert_equal(type(loaded), type(state))
+        for value, loaded_value in zip(state, loaded):
+            assert_array_equal(value, loaded_value)
+        assert_equal(loaded.index, [7])
+
+        # a checkpoint can be saved over the one it was resumed from
+        loaded = core.load_state(path, mmap_mode='c')
+        loaded.ax[:] = 0
+        core.save_state(loaded, path)
+        assert_array_equal(core.load_state(path).ax, 0)
+        assert not os.path.exists(path + '.tmp')
+        assert not os.path.exists(path + '.old')
+
+    # only the states of the lazy generators are supported
+    npt.assert_raises(ValueError, core.save_state, (1, 2),
+                      str(tmpdir.join('tuple.npz')))
+
+
 @known_fail_if(not pf)
 def test_bin_grid():
     geo = Geometry(
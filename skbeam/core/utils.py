@@ -42,6 +42,8 @@ import six
 from six.moves import zip
 from six import string_types
 
+import os
+import shutil
 import time
 import sys
 
@@ -1272,3 +1274,143 @@ def bin_grid(image, r_array, pixel_sizes, statistic='mean', mask=None,
     bin_centers = bin_edges_to_centers(bin_edge)
 
     return bin_centers, int_stat
+
+
+def _state_types():
+    """The namedtuple classes of the internal states of the lazy generators
+    that can be saved with `save_state`, by type name"""
+    # imported here, these modules depend on this one
+    from . import correlation, dpc, speckle
+    state_types = [correlation._internal_state,
+                   correlation._two_time_internal_state,
+                   correlation._two_time_window_state,
+                   correlation._lags_internal_state,
+                   dpc.dpc_internal_state,
+                   speckle._xsvs_internal_state]
+    return {state_type.__name__: state_type for state_type in state_types}
+
+
+def save_state(state, path):
+    """Save the internal state of a lazy generator to disk
+
+    This checkpoints long running computations, e.g. the state yielded by
+    `skbeam.core.correlation.lazy_one_time`,
+    `skbeam.core.correlation.lazy_two_time` or `skbeam.core.dpc.lazy_dpc`.
+    The state can be read back with `load_state` and passed back in to the
+    generator to resume processing.
+
+    Parameters
+    ----------
+    state : namedtuple
+        internal state of a lazy generator
+    path : str
+        If it ends with '.npz', the state is saved into a single numpy
+        ``.npz`` archive. Otherwise `path` is a directory (created if
+        needed) that gets one ``.npy`` file per array, which `load_state`
+        can memory-map.
+
+    Notes
+    -----
+    The state is written next to `path` first and then moved over it, so
+    a previous checkpoint at `path` survives a crash during the save.
+    """
+    if type(state).__name__ not in _state_types():
+        raise ValueError("Don't know how to save a %s" % type(state))
+    arrays = {'__state__': np.array(type(state).__name__)}
+    kinds = []
+    for name, value in zip(state._fields, state):
+        if isinstance(value, np.ndarray):
+            kinds.append('array')
+            arrays[name] = value
+        elif isinstance(value, dict):
+            # e.g. the lists of bad images for each multi-tau level, there
+            # is one (ragged) array per key
+            kinds.append('dict')
+            keys = sorted(value)
+            arrays[name + '.keys'] = np.array(keys)
+            for key in keys:
+                arrays[name + '.' + str(key)] = np.asarray(value[key])
+        elif isinstance(value, (list, tuple)):
+            kinds.append('list')
+            arrays[name] = np.asarray(value)
+        else:
+            kinds.append('scalar')
+            arrays[name] = np.asarray(value)
+    arrays['__kinds__'] = np.array(kinds)
+
+    path = os.path.normpath(path)
+    tmp_path = path + '.tmp'
+    if path.endswith('.npz'):
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, **arrays)
+        # os.rename does not replace files on windows (and python 2 has no
+        # os.replace)
+        getattr(os, 'replace', os.rename)(tmp_path, path)
+    else:
+        if os.path.isdir(tmp_path):
+            shutil.rmtree(tmp_path)
+        os.makedirs(tmp_path)
+        for name, arr in arrays.items():
+            np.save(os.path.join(tmp_path, name + '.npy'), arr)
+        # directories can not be replaced in one step, keep the previous
+        # checkpoint until the new one is in place
+        old_path = path + '.old'
+        if os.path.isdir(path):
+            if os.path.isdir(old_path):
+                shutil.rmtree(old_path)
+            os.rename(path, old_path)
+        os.rename(tmp_path, path)
+        if os.path.isdir(old_path):
+            shutil.rmtree(old_path)
+
+
+def load_state(path, mmap_mode=None):
+    """Load the internal state of a lazy generator saved with `save_state`
+
+    Parameters
+    ----------
+    path : str
+        the ``.npz`` file or the directory the state was saved to
+    mmap_mode : {None, 'r+', 'r', 'c'}, optional
+        memory-map the arrays of a state saved to a directory instead of
+        reading them, see `numpy.load`. Use 'c' (copy-on-write) to resume
+        processing without changing the files, and save the state again
+        with `save_state` to checkpoint it. With 'r+' the arrays are
+        updated in the files, but the rest of the state (e.g. counters and
+        the lists of bad images) is not, so the files do not hold a
+        consistent state until it is saved again. Ignored for ``.npz``
+        files.
+
+    Returns
+    -------
+    state : namedtuple
+        the internal state, ready to be passed back in to its generator
+    """
+    if os.path.isdir(path):
+        def read(name):
+            return np.load(os.path.join(path, name + '.npy'),
+                           mmap_mode=mmap_mode)
+        archive = None
+    else:
+        archive = np.load(path)
+        read = archive.__getitem__
+    try:
+        state_type = _state_types()[str(read('__state__'))]
+        values = []
+        for name, kind in zip(state_type._fields, read('__kinds__')):
+            if kind == 'array':
+                values.append(read(name))
+            elif kind == 'dict':
+                keys = read(name + '.keys').tolist()
+                values.append({key: read(name + '.' + str(key)).tolist()
+                               for key in keys})
+            elif kind == 'list':
+                values.append(read(name).tolist())
+            else:
+                # back to a python scalar, e.g. two time correlation checks
+                # for ints
+                values.append(read(name).item())
+    finally:
+        if archive is not None:
+            archive.close()
+    return state_type(*values)